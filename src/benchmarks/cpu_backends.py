@@ -0,0 +1,81 @@
+"""Benchmark the generation speed of the local LLM on the cpu backends.
+
+Compares the default huggingface eager fp32 path against bf16 (when the cpu supports it) and int8 dynamic
+quantization. The example questions are answered one at a time via the generation engine and the
+generated tokens per second is reported along with the number of intra-op threads.
+
+Usage:
+    python -m src.benchmarks.cpu_backends --threads 8 --num-prompts 4
+"""
+import json
+import time
+import argparse
+from typing import Dict, List
+
+import torch
+
+from src.constants import *
+from src.local_llm.cpu import is_bf16_supported, set_cpu_threads
+from src.local_llm.engine import GenerationEngine
+from src.local_llm.model import get_model, get_tokenizer
+from .local_llm_throughput import get_prompts
+
+BACKENDS = {
+    "eager-fp32": {"cpu_quantization": None, "cpu_dtype": "float32"},
+    "bf16": {"cpu_quantization": None, "cpu_dtype": "bfloat16"},
+    "int8-dynamic": {"cpu_quantization": "int8", "cpu_dtype": "float32"},
+}
+
+
+def run(engine: GenerationEngine, prompts: List[str]) -> Dict[str, float]:
+    """Generate the responses one prompt at a time and measure the generation speed."""
+
+    start_time = time.time()
+    num_tokens = sum(engine.generate(prompt)[1]["actual_new_tokens"] for prompt in prompts)
+    duration = time.time() - start_time
+
+    return {"seconds": duration, "generated_tokens": num_tokens, "tokens_per_second": num_tokens / duration}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-name", default=MODEL_NAME)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--num-prompts", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    args = parser.parse_args()
+
+    set_cpu_threads(args.threads)
+    tokenizer = get_tokenizer(args.model_name)
+    prompts = get_prompts(tokenizer, args.num_prompts)
+
+    for backend in args.backends:
+        if backend == "bf16" and not is_bf16_supported():
+            print(json.dumps({"backend": backend, "skipped": "cpu doesn't support bf16"}))
+            continue
+
+        model = get_model(
+            model_name=args.model_name,
+            device="cpu",
+            gradient_checkpointing=False,
+            artifact_dir=None,
+            **BACKENDS[backend],
+        )
+        engine = GenerationEngine(
+            model=model,
+            tokenizer=tokenizer,
+            model_name=args.model_name,
+            max_new_tokens=args.max_new_tokens,
+            max_batch_size=1,
+        )
+
+        result = run(engine, prompts)
+        result.update({"backend": backend, "threads": torch.get_num_threads()})
+        print(json.dumps(result))
+
+        del engine, model
+
+
+if __name__ == "__main__":
+    main()
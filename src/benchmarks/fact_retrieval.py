@@ -0,0 +1,218 @@
+"""Benchmark the retrieval of the bio's facts against sending the whole bio on every request.
+
+For each labelled question, the API client's prompt is built with the whole INSTRUCTION_TEMPLATE and with only the
+retrieved facts, and the benchmark reports:
+    - the prompt tokens of both the prompts, for a first query and for a follow up query after a few turns
+    - the latency of building both the prompts and of the retrieval alone
+    - whether the fact the question asks about is retrieved, as the recall over the labelled questions
+    - the facts retrieved apart from the pinned facts and the fact asked about, Eg: a 'name' question pulling in a fact mentioning 'name'
+    - the questions answered with the whole bio since no fact other than the pinned facts is relevant to them
+With --api, both the prompts are also answered at temperature 0 and the answers are compared for parity as an exact
+match and as the overlap of thier words. Set MISTRAL_API_BASE_URL to run it against the fake server.
+
+Runs offline otherwise, using the pre-serialized tokenizer at TOKENIZER_PATH (exported via
+`python -m src.llm_api.tokenizer`). Exits with a non zero status if the recall is below --min-recall.
+
+Usage:
+    python -m src.benchmarks.fact_retrieval
+    python -m src.benchmarks.fact_retrieval --top-k 2 4 8 --api
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+from typing import Dict, List, Optional, Tuple
+
+from src.constants import *
+from src.utils import create_logger
+from src.facts import FactRetriever, is_fact_of
+from src.llm_api.tokenizer import MistralChatTokenizer
+from .hot_paths import EXAMPLE_QUESTIONS, get_api_client
+
+#Questions along with the topic of the fact they ask about. None if no fact is needed to answer.
+LABELLED_QUESTIONS: List[Tuple[str, Optional[str]]] = [
+    (EXAMPLE_QUESTIONS[0], None),
+    (EXAMPLE_QUESTIONS[1], "current job"),
+    (EXAMPLE_QUESTIONS[2], "favourite food"),
+    (EXAMPLE_QUESTIONS[3], "hobbies"),
+    ("What is his favorite movie?", "Movies"),
+    ("Where did Aakash study?", "educational qualifications"),
+    ("How old is Aakash?", "Date of Birth"),
+    ("Does he have a girlfriend?", "Relationship"),
+    ("What is his email id?", "email"),
+    ("Who is his role model?", "Role Model"),
+    ("Which team does he support?", "Sports Team"),
+    ("Where is he from?", "native place"),
+    ("How tall is he?", "Height"),
+    ("What books does he read?", "books"),
+    ("Can you share his github?", "Github"),
+    ("Is he religious?", "Religious"),
+    ("Who is Aakash?", "current job"),
+    ("Tell me about Aakash", "native place"),
+    ("Give me his contact details", "email"),
+    ("What are his skills?", "Skillset"),
+    ("How much does he weigh?", "Weight"),
+    ("Is he married?", "Relationship"),
+    ("Does he have a wife?", "Relationship"),
+    ("When was he born?", "Date of Birth"),
+    ("What is his favourite color?", None),
+]
+
+#Turns before the follow up query. The history's questions are the example questions.
+FOLLOW_UP_TURNS = 3
+
+_ANSWER = "Well, that is something my boss Aakash would love to talk about. What else would you like to know?"
+
+
+def count_prompt_tokens(tokenizer: MistralChatTokenizer, messages: List) -> int:
+    return len(tokenizer.apply_chat_template([{"role": message.role, "content": message.content} for message in messages]))
+
+
+def measure_microseconds(call, repeat: int) -> float:
+    """Median latency of the call."""
+
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter_ns()
+        call()
+        timings.append((time.perf_counter_ns() - start_time) / 1000)
+
+    return statistics.median(timings)
+
+
+def get_history(num_turns: int) -> List[Tuple[str, str]]:
+    return [(EXAMPLE_QUESTIONS[index % len(EXAMPLE_QUESTIONS)], _ANSWER) for index in range(num_turns)]
+
+
+def is_retrieved(retriever: FactRetriever, question: str, topic: Optional[str]) -> Optional[bool]:
+    """Whether the fact of the topic is retrieved for the question. None if the question has no topic."""
+
+    if topic is None:
+        return None
+
+    return any(is_fact_of(fact, (topic,)) for fact in retriever.retrieve(question))
+
+
+def get_unrelated_facts(retriever: FactRetriever, question: str, topic: Optional[str]) -> List[str]:
+    """Topics of the retrieved facts which are neither pinned nor the fact the question asks about."""
+
+    return [
+        fact.partition(":")[0] for fact in retriever.retrieve(question)
+        if fact not in retriever.pinned_facts and (topic is None or not is_fact_of(fact, (topic,)))
+    ]
+
+
+def get_word_overlap(text: str, other_text: str) -> float:
+    """Jaccard overlap of the lower cased words of both the texts."""
+
+    words, other_words = set(re.findall(r"\w+", text.lower())), set(re.findall(r"\w+", other_text.lower()))
+    if not words and not other_words:
+        return 1.0
+
+    return len(words & other_words) / len(words | other_words)
+
+
+def answer(client, messages: List) -> str:
+    response = client.chat(model=API_ENDPOINT_NAME, messages=messages, temperature=0)
+
+    return response.choices[0].message.content
+
+
+def run(top_k: int, tokenizer: MistralChatTokenizer, chat_client, args: argparse.Namespace) -> Dict:
+    """Compare the prompts with the retrieved facts against the prompts with the whole bio."""
+
+    full_client = get_api_client(tokenizer)
+    full_client.fact_retriever = FactRetriever(top_k=None)
+    retrieval_client = get_api_client(tokenizer)
+    retrieval_client.fact_retriever = FactRetriever(top_k=top_k)
+
+    history = get_history(FOLLOW_UP_TURNS)
+    results = []
+    for question, topic in LABELLED_QUESTIONS:
+        result = {"top_k": top_k, "question": question, "topic": topic}
+
+        for name, client in (("full", full_client), ("retrieval", retrieval_client)):
+            messages = client._get_inference_prompt(question, [])
+            result[f"{name}_prompt_tokens"] = count_prompt_tokens(tokenizer, messages)
+            result[f"{name}_follow_up_prompt_tokens"] = count_prompt_tokens(tokenizer, client._get_inference_prompt(question, history))
+            result[f"{name}_prompt_microseconds"] = measure_microseconds(lambda: client._get_inference_prompt(question, []), args.repeat)
+
+            if chat_client is not None:
+                result[f"{name}_answer"] = answer(chat_client, messages)
+
+        result["retrieval_microseconds"] = measure_microseconds(lambda: retrieval_client.fact_retriever.retrieve(question), args.repeat)
+        result["retrieved_facts"] = [fact.partition(":")[0] for fact in retrieval_client.fact_retriever.retrieve(question)]
+        result["is_retrieved"] = is_retrieved(retrieval_client.fact_retriever, question, topic)
+        result["is_full_bio"] = len(retrieval_client.fact_retriever.retrieve(question)) == len(retrieval_client.fact_retriever.facts)
+        result["unrelated_facts"] = [] if result["is_full_bio"] else get_unrelated_facts(retrieval_client.fact_retriever, question, topic)
+
+        if chat_client is not None:
+            result["exact_match"] = result["full_answer"] == result["retrieval_answer"]
+            result["word_overlap"] = get_word_overlap(result["full_answer"], result["retrieval_answer"])
+
+        results.append(result)
+        print(json.dumps(result))
+
+    labelled = [result["is_retrieved"] for result in results if result["is_retrieved"] is not None]
+    summary = {
+        "top_k": top_k,
+        "recall": sum(labelled) / len(labelled),
+        "questions_with_unrelated_facts": sum(bool(result["unrelated_facts"]) for result in results),
+        "full_bio_questions": sum(result["is_full_bio"] for result in results),
+        "mean_full_prompt_tokens": statistics.fmean(result["full_prompt_tokens"] for result in results),
+        "mean_retrieval_prompt_tokens": statistics.fmean(result["retrieval_prompt_tokens"] for result in results),
+        "mean_full_follow_up_prompt_tokens": statistics.fmean(result["full_follow_up_prompt_tokens"] for result in results),
+        "mean_retrieval_follow_up_prompt_tokens": statistics.fmean(result["retrieval_follow_up_prompt_tokens"] for result in results),
+        "median_full_prompt_microseconds": statistics.median(result["full_prompt_microseconds"] for result in results),
+        "median_retrieval_prompt_microseconds": statistics.median(result["retrieval_prompt_microseconds"] for result in results),
+        "median_retrieval_microseconds": statistics.median(result["retrieval_microseconds"] for result in results),
+    }
+    summary["prompt_token_reduction"] = 1 - summary["mean_retrieval_prompt_tokens"] / summary["mean_full_prompt_tokens"]
+
+    if chat_client is not None:
+        summary["exact_match_rate"] = statistics.fmean(result["exact_match"] for result in results)
+        summary["mean_word_overlap"] = statistics.fmean(result["word_overlap"] for result in results)
+
+    return {"summary": summary, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top-k", type=int, nargs="+", default=[FACT_RETRIEVAL_TOP_K])
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--api", action="store_true", help="Answer both the prompts via the API and compare the answers.")
+    parser.add_argument("--min-recall", type=float, default=0.9, help="Lowest recall of the labelled facts allowed.")
+    parser.add_argument("--tokenizer-path", default=TOKENIZER_PATH)
+    parser.add_argument("--output", default=f"logs/fact_retrieval_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.tokenizer_path):
+        parser.error(f"{args.tokenizer_path} not found. Export it via `python -m src.llm_api.tokenizer` first.")
+
+    create_logger(LOGFILE_PATH).setLevel(logging.WARNING)
+
+    chat_client = None
+    if args.api:
+        from mistralai.client import MistralClient
+        chat_client = MistralClient(api_key=os.environ.get("MISTRAL_API_KEY", "fake"), endpoint=API_BASE_URL)
+
+    tokenizer = MistralChatTokenizer(args.tokenizer_path)
+    runs = [run(top_k, tokenizer, chat_client, args) for top_k in args.top_k]
+    for report in runs:
+        print(json.dumps({"summary": report["summary"]}))
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as output_file:
+        json.dump(runs, output_file, indent=2)
+    print(f"Saved the results onto {args.output}")
+
+    if any(report["summary"]["recall"] < args.min_recall for report in runs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""Microbenchmark the prompt construction and post-processing hot paths.
+
+Sweeps the length of the chat history and the size of its messages and measures the per call latency and the
+peak memory allocated per call of:
+    - filter_old_messages, parse_chat_history_as_tuples and convert_chat_history_as_string
+    - MistralAPIClient._get_inference_prompt and LLMChain._get_inference_prompt, building the whole history and
+      building a new turn after the previous turn's history is memoized
+    - post_process_output and the incremental framing of a streamed response
+
+Runs offline. The API client's cases use the pre-serialized tokenizer at TOKENIZER_PATH (exported via
+`python -m src.llm_api.tokenizer`). The local LLM chain's case uses the huggingface tokenizer from the local cache
+and is skipped if it isn't cached. The logging of the measured functions is silenced so that only thier own cost
+is measured.
+
+The results are saved as JSON along with the details of the run, so that the runs can be compared over time.
+With --baseline, the median latencies are compared against a saved run and the cases slower by more than the
+threshold are flagged as regressions, in which case the exit status is non zero.
+
+Usage:
+    python -m src.benchmarks.hot_paths --turns 1 10 50 100 200 --message-chars 50 500 2000
+    python -m src.benchmarks.hot_paths --baseline logs/hot_paths_baseline.json --threshold 0.2
+"""
+import os
+
+#Never reach the huggingface hub. Set before transformers is imported.
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import statistics
+import subprocess
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from src.constants import *
+from src.utils import (
+    create_logger,
+    filter_old_messages,
+    parse_chat_history_as_tuples,
+    convert_chat_history_as_string,
+    post_process_output,
+)
+from src.streaming import ResponseFramer, iter_response_frames
+from src.llm_api.tokenizer import MistralChatTokenizer
+
+#Latencies below this are within the timer's noise and never flagged as regressions.
+MIN_REGRESSION_MICROSECONDS = 2.0
+
+CASE_NAMES = [
+    "filter_old_messages",
+    "parse_chat_history_as_tuples",
+    "convert_chat_history_as_string",
+    "api_get_inference_prompt",
+    "local_get_inference_prompt",
+    "api_next_turn_prompt",
+    "local_next_turn_prompt",
+    "post_process_output",
+    "stream_framing",
+]
+
+#Questions of the app's examples. Not imported from the other benchmarks as they import torch.
+EXAMPLE_QUESTIONS = [
+    "Hi There! What is your name?",
+    "Where does Aakash Currently Works?",
+    "What is the favourite food of Aakash?",
+    "What does Aakash loves to do in his free time?",
+]
+
+_FILLER = "Aakash loves to read books, play cricket and explore new places with his friends. "
+
+
+def get_message(index: int, num_chars: int) -> str:
+    """A message of about num_chars characters which starts with an example question."""
+
+    text = EXAMPLE_QUESTIONS[index % len(EXAMPLE_QUESTIONS)] + " " + _FILLER * (num_chars // len(_FILLER) + 1)
+
+    return text[:num_chars]
+
+
+def get_history_tuples(num_turns: int, num_chars: int) -> List[Tuple[str, str]]:
+    return [(get_message(index, num_chars), get_message(index + 1, num_chars)) for index in range(num_turns)]
+
+
+def get_history_messages(num_turns: int, num_chars: int) -> List:
+    from langchain.schema.messages import HumanMessage, AIMessage
+
+    return [
+        message
+        for question, answer in get_history_tuples(num_turns, num_chars)
+        for message in (HumanMessage(content=question), AIMessage(content=answer))
+    ]
+
+
+def get_prompt_messages(num_turns: int, num_chars: int) -> List[Dict[str, str]]:
+    messages = []
+    for index, (question, answer) in enumerate(get_history_tuples(num_turns, num_chars)):
+        content = (INSTRUCTION_TEMPLATE if not index else "") + f"<<<\nQUESTION: {question} >>>.\n\n\n\n\n"
+        messages.extend([{"role": "user", "content": content}, {"role": "assistant", "content": answer}])
+
+    return messages
+
+
+def get_api_client(tokenizer: MistralChatTokenizer, memoize: bool = False):
+    """The API client with only what its prompt construction needs. The client isn't connected to the API.
+       The whole history is built on every call unless memoize is set."""
+
+    from src.facts import get_fact_retriever
+    from src.prompt_memo import PromptMemo
+    from src.llm_api.llm_api_client import MistralAPIClient
+
+    client = MistralAPIClient.__new__(MistralAPIClient)
+    client.tokenizer = tokenizer
+    client.fact_retriever = get_fact_retriever()
+    client.prompt_memo = PromptMemo() if memoize else PromptMemo(max_bytes=0)
+
+    return client
+
+
+def get_local_chain(memoize: bool = False):
+    """The local LLM chain without a generation engine. None if the tokenizer isn't in the local cache.
+       The whole history is built on every call unless memoize is set."""
+
+    from src.prompt_memo import PromptMemo
+    from src.local_llm.chains import LLMChain
+
+    chain = LLMChain.construct(prompt_memo=PromptMemo() if memoize else None)
+    try:
+        chain.build_prompt_encoder()
+    except OSError:
+        return None
+
+    return chain
+
+
+def get_cases(tokenizer: MistralChatTokenizer) -> Dict[str, Callable[[int, int], Optional[Callable[[], Any]]]]:
+    """Each case prepares its inputs for the number of turns and the message size and returns the call to measure.
+       A case returns None if it can't be run."""
+
+    api_client = get_api_client(tokenizer)
+    local_chain = get_local_chain()
+    memo_api_client = get_api_client(tokenizer, memoize=True)
+    memo_local_chain = get_local_chain(memoize=True) if local_chain is not None else None
+
+    def filter_messages_case(num_turns: int, num_chars: int):
+        messages = get_prompt_messages(num_turns, num_chars)
+        return lambda: filter_old_messages(messages, tokenizer)
+
+    def parse_history_case(num_turns: int, num_chars: int):
+        messages = get_history_messages(num_turns, num_chars)
+        return lambda: parse_chat_history_as_tuples(messages)
+
+    def convert_history_case(num_turns: int, num_chars: int):
+        messages = get_history_messages(num_turns, num_chars)
+        return lambda: convert_chat_history_as_string(messages)
+
+    def api_prompt_case(num_turns: int, num_chars: int):
+        chat_history = get_history_tuples(num_turns, num_chars)
+        return lambda: api_client._get_inference_prompt("Who is Aakash?", chat_history)
+
+    def local_prompt_case(num_turns: int, num_chars: int):
+        if local_chain is None:
+            return None
+        sample = {"question": "Who is Aakash?", "chat_history": get_history_messages(num_turns, num_chars)}
+        return lambda: local_chain._get_inference_prompt(sample)
+
+    #The history of the previous turn is memoized once and the entry of the new turn is dropped before each call,
+    #so that every call builds the new turn alone as on a live conversation.
+    def api_next_turn_case(num_turns: int, num_chars: int):
+        chat_history = get_history_tuples(num_turns, num_chars)
+        memo_api_client._get_inference_prompt("Who is Aakash?", chat_history[:-1])
+
+        def call():
+            memo_api_client.prompt_memo.discard(chat_history)
+            return memo_api_client._get_inference_prompt("Who is Aakash?", chat_history)
+
+        return call
+
+    def local_next_turn_case(num_turns: int, num_chars: int):
+        if memo_local_chain is None:
+            return None
+        chat_history = get_history_messages(num_turns, num_chars)
+        memo_local_chain._get_inference_prompt({"question": "Who is Aakash?", "chat_history": chat_history[:-2]})
+        history_tuples = parse_chat_history_as_tuples(chat_history)
+        sample = {"question": "Who is Aakash?", "chat_history": chat_history}
+
+        def call():
+            memo_local_chain.prompt_memo.discard(history_tuples)
+            return memo_local_chain._get_inference_prompt(sample)
+
+        return call
+
+    #The response is of the size of the history's messages.
+    def post_process_case(num_turns: int, num_chars: int):
+        response = "Diya: " + get_message(0, num_chars)
+        return lambda: post_process_output(response)
+
+    def stream_framing_case(num_turns: int, num_chars: int):
+        response = "Diya: " + get_message(0, num_chars)
+        tokens = [response[index:index+4] for index in range(0, len(response), 4)]
+        return lambda: list(iter_response_frames(tokens, ResponseFramer("cumulative", interval_seconds=0.05, max_chars=64)))
+
+    return {
+        "filter_old_messages": filter_messages_case,
+        "parse_chat_history_as_tuples": parse_history_case,
+        "convert_chat_history_as_string": convert_history_case,
+        "api_get_inference_prompt": api_prompt_case,
+        "local_get_inference_prompt": local_prompt_case,
+        "api_next_turn_prompt": api_next_turn_case,
+        "local_next_turn_prompt": local_next_turn_case,
+        "post_process_output": post_process_case,
+        "stream_framing": stream_framing_case,
+    }
+
+
+def measure(call: Callable[[], Any], repeat: int, warmup: int) -> Dict[str, float]:
+    """Measure the latency of each call and the peak memory it allocates."""
+
+    for _ in range(warmup):
+        call()
+
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter_ns()
+        call()
+        timings.append((time.perf_counter_ns() - start_time) / 1000)
+
+    #Tracing slows down the calls and so the allocations are measured on separate calls.
+    tracemalloc.start()
+    peaks = []
+    for _ in range(min(repeat, 5)):
+        base_memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        call()
+        peaks.append(tracemalloc.get_traced_memory()[1] - base_memory)
+    tracemalloc.stop()
+
+    timings.sort()
+
+    return {
+        "calls": repeat,
+        "mean_microseconds": statistics.fmean(timings),
+        "p50_microseconds": timings[len(timings) // 2],
+        "p95_microseconds": timings[min(int(len(timings) * 0.95), len(timings) - 1)],
+        "peak_allocated_bytes": max(peaks),
+    }
+
+
+def get_run_details(tokenizer_path: str) -> Dict[str, str]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "tokenizer_path": tokenizer_path,
+    }
+
+
+def get_result_key(result: Dict) -> Tuple[str, int, int]:
+    return result["case"], result["turns"], result["message_chars"]
+
+
+def find_regressions(results: List[Dict], baseline: Dict, threshold: float) -> List[Dict]:
+    """Cases whose median latency is slower than the baseline by more than the threshold."""
+
+    baseline_results = {get_result_key(result): result for result in baseline["results"] if "p50_microseconds" in result}
+
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get(get_result_key(result))
+        if baseline_result is None or "p50_microseconds" not in result:
+            continue
+
+        latency, baseline_latency = result["p50_microseconds"], baseline_result["p50_microseconds"]
+        if latency > baseline_latency * (1 + threshold) and latency - baseline_latency > MIN_REGRESSION_MICROSECONDS:
+            regressions.append({
+                "case": result["case"],
+                "turns": result["turns"],
+                "message_chars": result["message_chars"],
+                "baseline_p50_microseconds": baseline_latency,
+                "p50_microseconds": latency,
+                "slowdown": latency / baseline_latency,
+            })
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, nargs="+", default=[1, 10, 50, 100, 200])
+    parser.add_argument("--message-chars", type=int, nargs="+", default=[50, 500, 2000])
+    parser.add_argument("--cases", nargs="+", default=None, choices=CASE_NAMES, help="Cases to run. All the cases are run by default.")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--tokenizer-path", default=TOKENIZER_PATH)
+    parser.add_argument("--output", default=f"logs/hot_paths_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    parser.add_argument("--baseline", default=None, help="Results of a previous run to flag the regressions against.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown of the median latency.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.tokenizer_path):
+        parser.error(f"{args.tokenizer_path} not found. Export it via `python -m src.llm_api.tokenizer` first.")
+
+    create_logger(LOGFILE_PATH).setLevel(logging.WARNING)
+
+    cases = get_cases(MistralChatTokenizer(args.tokenizer_path))
+    case_names = args.cases if args.cases else CASE_NAMES
+
+    results = []
+    for name in case_names:
+        for num_turns in args.turns:
+            for num_chars in args.message_chars:
+                result = {"case": name, "turns": num_turns, "message_chars": num_chars}
+                call = cases[name](num_turns, num_chars)
+                result.update(measure(call, args.repeat, args.warmup) if call is not None else {"skipped": True})
+                results.append(result)
+                print(json.dumps(result))
+
+    report = {"run": get_run_details(args.tokenizer_path), "results": results}
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            report["regressions"] = find_regressions(results, json.load(baseline_file), args.threshold)
+        for regression in report["regressions"]:
+            print(json.dumps({"regression": regression}))
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Saved the results onto {args.output}")
+
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Benchmark the aggregate generation throughput of the local LLM under concurrent chats.
+
+Compares the continuous batching scheduler against generating one request at a time.
+
+Usage:
+    python -m src.benchmarks.local_llm_throughput --concurrency 8 16 32
+"""
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from src.constants import *
+from src.local_llm.engine import GenerationEngine
+from src.local_llm.model import get_model, get_tokenizer
+
+EXAMPLE_QUESTIONS = [
+    "Hi There! What is your name?",
+    "Where does Aakash Currently Works?",
+    "What is the favourite food of Aakash?",
+    "What does Aakash loves to do in his free time?",
+]
+
+
+def get_prompts(tokenizer, num_prompts: int) -> List[str]:
+    """Prepare first turn prompts for the example questions in the LLM's template."""
+
+    return [
+        tokenizer.apply_chat_template(
+            [{"role": "user", "content": INSTRUCTION_TEMPLATE + f"<<<\nQUESTION: {EXAMPLE_QUESTIONS[index % len(EXAMPLE_QUESTIONS)]} >>>.\n\n\n\n\n"}],
+            tokenize=False,
+        )
+        for index in range(num_prompts)
+    ]
+
+
+def run(engine: GenerationEngine, prompts: List[str]) -> Dict[str, float]:
+    """Generate the responses for all the prompts concurrently and measure the throughput."""
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+        results = list(executor.map(engine.generate, prompts))
+    duration = time.time() - start_time
+
+    num_tokens = sum(usage["actual_new_tokens"] for _, usage in results)
+
+    return {"seconds": duration, "generated_tokens": num_tokens, "tokens_per_second": num_tokens / duration}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-name", default=MODEL_NAME)
+    parser.add_argument("--device", default=DEVICE)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    args = parser.parse_args()
+
+    model = get_model(model_name=args.model_name, device=args.device, gradient_checkpointing=False)
+    model.eval()
+    tokenizer = get_tokenizer(args.model_name)
+
+    for concurrency in args.concurrency:
+        prompts = get_prompts(tokenizer, concurrency)
+
+        for max_batch_size in (1, concurrency):
+            engine = GenerationEngine(
+                model=model,
+                tokenizer=tokenizer,
+                model_name=args.model_name,
+                max_new_tokens=args.max_new_tokens,
+                max_batch_size=max_batch_size,
+            )
+            result = run(engine, prompts)
+            result.update({"concurrency": concurrency, "max_batch_size": max_batch_size})
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
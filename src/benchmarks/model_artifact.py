@@ -0,0 +1,68 @@
+"""Benchmark the model artifact cache of get_model on cpu with a tiny randomly initialized Mistral model.
+
+Saves a tiny Mistral checkpoint, converts it into an artifact and reports the load time of get_model from the
+checkpoint and from the artifact. The artifact's correctness checks are in tests/test_model_artifact.py.
+
+Usage:
+    python -m src.benchmarks.model_artifact --hidden-size 64 --num-layers 2
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+
+import torch
+from transformers import AutoModelForCausalLM, MistralConfig
+
+from src.local_llm.artifacts import save_model_artifact, is_model_artifact_valid, get_quantization_config
+from src.local_llm.model import get_model
+
+
+def save_tiny_checkpoint(checkpoint_dir: str, hidden_size: int, num_layers: int):
+    """Save a randomly initialized Mistral model with a tiny config."""
+
+    config = MistralConfig(
+        vocab_size=1000,
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=512,
+    )
+    torch.manual_seed(0)
+    AutoModelForCausalLM.from_config(config).save_pretrained(checkpoint_dir, safe_serialization=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--num-layers", type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        checkpoint_dir = os.path.join(temp_dir, "checkpoint")
+        artifact_dir = os.path.join(temp_dir, "artifact")
+        save_tiny_checkpoint(checkpoint_dir, args.hidden_size, args.num_layers)
+        save_model_artifact(model_name=checkpoint_dir, artifact_dir=artifact_dir, device="cpu")
+
+        start_time = time.perf_counter()
+        get_model(checkpoint_dir, device="cpu", gradient_checkpointing=False, artifact_dir=None)
+        checkpoint_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        get_model(checkpoint_dir, device="cpu", gradient_checkpointing=False, artifact_dir=artifact_dir)
+        artifact_seconds = time.perf_counter() - start_time
+
+        results = {
+            "checkpoint_load_seconds": checkpoint_seconds,
+            "artifact_load_seconds": artifact_seconds,
+            "artifact_valid": is_model_artifact_valid(artifact_dir, checkpoint_dir, get_quantization_config("cpu")),
+        }
+
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Verify and benchmark the token-id-native prompt assembly of the local LLM chain.
+
+Builds prompts for conversations of increasing length and checks that the token ids assembled from the
+pre-tokenized prompt segments are identical to the ids of the tokenizer's chat template. Exits with a
+non zero status on any mismatch. Also compares the time taken against templating the prompt as tensors,
+decoding it and tokenizing the prompt text again, which was done before.
+
+Usage:
+    python -m src.benchmarks.prompt_encoding --max-turns 20 --repeat 20
+"""
+import sys
+import json
+import time
+import argparse
+from typing import Dict, List
+
+from langchain.schema.messages import HumanMessage, AIMessage
+
+from src.constants import *
+from src.local_llm.chains import LLMChain
+from .local_llm_throughput import EXAMPLE_QUESTIONS
+
+EXAMPLE_ANSWERS = [
+    "Hi there! My name is Aakash. How can I help you today?",
+    "Aakash currently works as a Machine Learning Engineer.\n\nHe works on building and deploying LLM applications.",
+    "Aakash loves to eat biryani!",
+    "In his free time, Aakash likes to read books, play cricket and  explore new places.",
+]
+
+
+def get_chat_history(num_turns: int) -> List:
+    """Chat history of the given number of turns built from the example questions and answers."""
+
+    chat_history = []
+    for index in range(num_turns):
+        chat_history.append(HumanMessage(content=EXAMPLE_QUESTIONS[index % len(EXAMPLE_QUESTIONS)]))
+        chat_history.append(AIMessage(content=EXAMPLE_ANSWERS[index % len(EXAMPLE_ANSWERS)]))
+
+    return chat_history
+
+
+def run(chain: LLMChain, num_turns: int, repeat: int) -> Dict[str, float]:
+    """Compare the assembled prompt ids against the chat template and time both the paths."""
+
+    sample = {"question": EXAMPLE_QUESTIONS[num_turns % len(EXAMPLE_QUESTIONS)], "chat_history": get_chat_history(num_turns)}
+    tokenizer = chain.tokenizer
+
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        prompt = chain._get_inference_prompt(sample)
+    encoder_milliseconds = (time.perf_counter() - start_time) * 1000 / repeat
+
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        prompt_text = tokenizer.decode(tokenizer.apply_chat_template(prompt["messages"], return_tensors="pt")[0])
+        tokenizer(prompt_text, return_tensors="pt")
+    template_milliseconds = (time.perf_counter() - start_time) * 1000 / repeat
+
+    return {
+        "turns": num_turns,
+        "prompt_tokens": len(prompt["input_ids"]),
+        "identical": prompt["input_ids"].tolist() == tokenizer.apply_chat_template(prompt["messages"]),
+        "encoder_milliseconds": encoder_milliseconds,
+        "template_round_trip_milliseconds": template_milliseconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-turns", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    #Only the prompt building methods are used, so the chain is created without a generation engine.
+    chain = LLMChain.construct()
+    chain.build_prompt_encoder()
+
+    if not chain.prompt_encoder.is_verified:
+        print("Pre-tokenized prompt segments don't match the chat template of the probe conversations")
+        sys.exit(1)
+
+    results = [run(chain, num_turns, args.repeat) for num_turns in range(args.max_turns + 1)]
+    for result in results:
+        print(json.dumps(result))
+
+    if not all(result["identical"] for result in results):
+        print("Assembled prompt token ids don't match the chat template")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Verify and benchmark speculative decoding of the local LLM.
+
+Answers the example questions one at a time with plain greedy decoding and with speculative decoding, either
+using a draft model or prompt lookup decoding which copies from the prompt. Checks that the responses are identical
+and reports the accepted tokens per forward pass of the model, the acceptance rate of the draft model's tokens and
+the end-to-end speedup. The acceptance rate isn't reported for prompt lookup decoding, which has no draft model.
+Exits with a non zero status if any response differs.
+
+With --tiny, a tiny randomly initialized Mistral model and a draft model made of its first layer are used on cpu
+instead of the given models, so that the check can be run without a GPU.
+
+Usage:
+    python -m src.benchmarks.speculative_decoding --mode draft --draft-model-name <draft model> --device cuda:0
+    python -m src.benchmarks.speculative_decoding --mode prompt-lookup --prompt-lookup-num-tokens 10
+    python -m src.benchmarks.speculative_decoding --mode draft --tiny --max-new-tokens 32
+"""
+import sys
+import json
+import time
+import argparse
+from typing import Dict, List, Tuple
+
+import torch
+from transformers import AutoModelForCausalLM, MistralConfig
+
+from src.constants import *
+from src.local_llm.engine import GenerationEngine
+from src.local_llm.model import get_model, get_tokenizer
+from .local_llm_throughput import get_prompts
+
+
+def get_tiny_models(vocab_size: int) -> Tuple[AutoModelForCausalLM, AutoModelForCausalLM]:
+    """A tiny randomly initialized Mistral model and a draft model with its embeddings, first layer and head."""
+
+    config = MistralConfig(
+        vocab_size=vocab_size,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    torch.manual_seed(0)
+    model = AutoModelForCausalLM.from_config(config).eval()
+
+    draft_config = MistralConfig(**{**config.to_dict(), "num_hidden_layers": 1})
+    draft_model = AutoModelForCausalLM.from_config(draft_config).eval()
+    draft_model.load_state_dict(model.state_dict(), strict=False)
+
+    return model, draft_model
+
+
+def run(engine: GenerationEngine, prompts: List[str]) -> Tuple[List[str], Dict[str, float]]:
+    """Generate the responses one prompt at a time and measure the generation speed."""
+
+    start_time = time.time()
+    results = [engine.generate(prompt) for prompt in prompts]
+    duration = time.time() - start_time
+
+    num_tokens = sum(usage["actual_new_tokens"] for _, usage in results)
+
+    return [response for response, _ in results], {"seconds": duration, "tokens_per_second": num_tokens / duration}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["draft", "prompt-lookup"], default="draft")
+    parser.add_argument("--model-name", default=MODEL_NAME)
+    parser.add_argument("--draft-model-name", default=DRAFT_MODEL_NAME)
+    parser.add_argument("--device", default=DEVICE)
+    parser.add_argument("--tiny", action="store_true", help="Use tiny random models on cpu.")
+    parser.add_argument("--num-prompts", type=int, default=4)
+    parser.add_argument("--num-draft-tokens", type=int, default=SPECULATIVE_NUM_DRAFT_TOKENS)
+    parser.add_argument("--prompt-lookup-num-tokens", type=int, default=PROMPT_LOOKUP_NUM_TOKENS or 10)
+    parser.add_argument("--max-matching-ngram-size", type=int, default=PROMPT_LOOKUP_MAX_NGRAM_SIZE)
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    args = parser.parse_args()
+
+    tokenizer = get_tokenizer(args.model_name)
+    prompts = get_prompts(tokenizer, args.num_prompts)
+
+    draft_model = None
+    if args.tiny:
+        model, draft_model = get_tiny_models(len(tokenizer))
+    else:
+        model = get_model(args.model_name, device=args.device, gradient_checkpointing=False).eval()
+        if args.mode == "draft":
+            if args.draft_model_name is None:
+                parser.error("--draft-model-name is required for the draft mode unless --tiny is used")
+            draft_model = get_model(args.draft_model_name, device=args.device, gradient_checkpointing=False, artifact_dir=None).eval()
+
+    if args.mode == "draft":
+        speculative_kwargs = {"draft_model": draft_model, "num_draft_tokens": args.num_draft_tokens}
+    else:
+        speculative_kwargs = {
+            "prompt_lookup_num_tokens": args.prompt_lookup_num_tokens,
+            "max_matching_ngram_size": args.max_matching_ngram_size,
+        }
+
+    engine_kwargs = {
+        "model": model,
+        "tokenizer": tokenizer,
+        "model_name": args.model_name,
+        "max_new_tokens": args.max_new_tokens,
+        "temperature": 0.0,
+        "use_streamer": False,
+        "stop_ids": [tokenizer.eos_token_id],
+        "max_batch_size": 1,
+        "prompt_lookup_num_tokens": None,
+    }
+
+    baseline_responses, baseline = run(GenerationEngine(**engine_kwargs), prompts)
+
+    speculative_engine = GenerationEngine(**{**engine_kwargs, **speculative_kwargs})
+    speculative_responses, speculative = run(speculative_engine, prompts)
+
+    result = {
+        "mode": args.mode,
+        "baseline_tokens_per_second": baseline["tokens_per_second"],
+        "speculative_tokens_per_second": speculative["tokens_per_second"],
+        "speedup": baseline["seconds"] / speculative["seconds"],
+        "identical": baseline_responses == speculative_responses,
+        **speculative_engine.speculative_stats.stats(),
+    }
+    print(json.dumps(result))
+
+    if not result["identical"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
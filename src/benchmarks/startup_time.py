@@ -0,0 +1,85 @@
+"""Benchmark the cold start of the apps.
+
+Reports the time taken to import each module in a fresh interpreter along with the heavy packages the import
+pulled in, and the time taken by the app to start serving its UI. The app needs the same environment variables
+as in deployment (Eg: MISTRAL_API_KEY, COMET_PROJECT_NAME) to start serving.
+
+Usage:
+    python -m src.benchmarks.startup_time --modules src.llm_api.llm_api_client src.local_llm.chains --app src.llm_api.app_ui
+"""
+import sys
+import json
+import time
+import argparse
+import subprocess
+import urllib.request
+from typing import Dict, List, Optional
+
+HEAVY_PACKAGES = ["torch", "transformers", "langchain", "comet_llm", "tokenizers", "gradio"]
+
+_IMPORT_SCRIPT = """
+import sys, json, time
+start_time = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start_time
+print(json.dumps({{"seconds": seconds, "imported": [name for name in {packages} if name in sys.modules]}}))
+"""
+
+
+def measure_import(module: str) -> Dict:
+    """Import the module in a fresh interpreter and measure the time taken."""
+
+    output = subprocess.run(
+        [sys.executable, "-c", _IMPORT_SCRIPT.format(module=module, packages=HEAVY_PACKAGES)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+
+    return {"module": module, "import_seconds": result["seconds"], "heavy_packages_imported": result["imported"]}
+
+
+def measure_ready_to_serve(app: str, url: str, timeout_seconds: float) -> Optional[float]:
+    """Start the app and measure the time taken untill its UI responds. Returns None if it doesn't within the timeout."""
+
+    start_time = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", app], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        while time.perf_counter() - start_time < timeout_seconds:
+            if process.poll() is not None:
+                return None
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start_time
+            except OSError:
+                time.sleep(0.1)
+        return None
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=["src.llm_api.llm_api_client", "src.local_llm.chains"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--app", default=None, help="App module to start and time untill it serves. Skipped if not given.")
+    parser.add_argument("--url", default="http://127.0.0.1:7860/")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        results = [measure_import(module) for _ in range(args.repeat)]
+        result = min(results, key=lambda result: result["import_seconds"])
+        print(json.dumps(result))
+
+    if args.app is not None:
+        seconds = measure_ready_to_serve(args.app, args.url, args.timeout)
+        print(json.dumps({"app": args.app, "ready_to_serve_seconds": seconds}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Benchmark the frames streamed to the UI for a response against the previous per token cumulative streaming.
+
+A response of the given number of tokens is streamed with a simulated token interval and framed with:
+    - per-token: The previous behaviour. Post-processes the whole response and yields it on every token.
+    - cumulative: Incremental post-processing with the tokens coalesced into frames carrying the whole response.
+    - delta: Incremental post-processing with the tokens coalesced into frames carrying only the new text.
+Reports the messages sent, the bytes sent and the cpu time spent framing the response. Checks that the UI ends up
+with the same final text in every mode and exits with a non zero status otherwise.
+
+Usage:
+    python -m src.benchmarks.streaming --num-tokens 100 500 2000 --token-interval-ms 20
+"""
+import sys
+import json
+import time
+import argparse
+from typing import Dict, Iterator, List
+
+from src.constants import *
+from src.utils import post_process_output
+from src.streaming import ResponseFramer, iter_response_frames
+
+#Answer of the few shot examples, repeated to the length of the response.
+EXAMPLE_RESPONSE = (
+    "Well Aakash is my charming boss who is currently working as a Junior Research Engineer at BUDDI AI, Chennai, "
+    "India. Born and grown up in Pudukkottai he is currently residing in Chennai for his professional career. "
+    "What else would like to know about my boss? "
+)
+
+
+class SimulatedClock:
+    """Clock advanced by the simulated token stream, so that the frames don't depend on the speed of the machine."""
+
+    def __init__(self):
+        self.now = 0.0
+
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def get_tokens(num_tokens: int) -> List[str]:
+    """Split a 'Diya:' prefixed response into token sized pieces of about 4 characters."""
+
+    text = " Diya: " + EXAMPLE_RESPONSE * (num_tokens * 4 // len(EXAMPLE_RESPONSE) + 1)
+
+    return [text[index:index+4] for index in range(0, num_tokens * 4, 4)]
+
+
+def stream_tokens(tokens: List[str], clock: SimulatedClock, token_interval: float) -> Iterator[str]:
+    for token in tokens:
+        clock.now += token_interval
+        yield token
+
+
+def stream_per_token(tokens: Iterator[str]) -> Iterator[str]:
+    """Previous behaviour of both the backends."""
+
+    response = ""
+    for token in tokens:
+        response += token
+        yield post_process_output(response)
+
+
+def run(mode: str, tokens: List[str], args: argparse.Namespace) -> Dict[str, float]:
+    """Stream the response in the mode and measure the frames sent and the cpu time."""
+
+    frames, cpu_seconds = [], 0.0
+    for _ in range(args.repeat):
+        clock = SimulatedClock()
+        deltas = stream_tokens(tokens, clock, args.token_interval_ms / 1000)
+
+        if mode == "per-token":
+            stream = stream_per_token(deltas)
+        else:
+            framer = ResponseFramer(mode, args.frame_interval_ms / 1000, args.frame_max_chars, clock=clock)
+            stream = iter_response_frames(deltas, framer)
+
+        start_time = time.process_time()
+        frames = list(stream)
+        cpu_seconds += time.process_time() - start_time
+
+    final_text = "".join(frames) if mode == "delta" else frames[-1]
+
+    return {
+        "mode": mode,
+        "messages": len(frames),
+        "bytes": sum(len(frame.encode("utf-8")) for frame in frames),
+        "cpu_milliseconds": cpu_seconds / args.repeat * 1000,
+        "correct_final_text": final_text == post_process_output("".join(tokens)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-tokens", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument("--token-interval-ms", type=float, default=20.0)
+    parser.add_argument("--frame-interval-ms", type=float, default=STREAM_FRAME_INTERVAL_SECONDS * 1000)
+    parser.add_argument("--frame-max-chars", type=int, default=STREAM_FRAME_MAX_CHARS)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    is_correct = True
+    for num_tokens in args.num_tokens:
+        tokens = get_tokens(num_tokens)
+        for mode in ("per-token", "cumulative", "delta"):
+            result = run(mode, tokens, args)
+            result["num_tokens"] = num_tokens
+            is_correct &= result["correct_final_text"]
+            print(json.dumps(result))
+
+    if not is_correct:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,67 @@
+import os
+
 MODEL_NAME = 'mistralai/Mistral-7B-Instruct-v0.2'
 API_ENDPOINT_NAME = "open-mistral-7b"
 MAX_NEW_TOKENS = 200
-DEVICE = 'cuda:0'
+DEVICE = os.environ.get('LLM_DEVICE', 'cuda:0') #Device for the local LLM. Set 'cpu' to run on the cpu backend.
 TEMPERATURE = 0.0
 LOGFILE_PATH = 'logs/outputs.log'
+SESSION_KV_CACHE_MAX_BYTES = 2 * 1024**3 #Memory budget for retaining the KV cache of the conversations between the turns.
+SESSION_KV_CACHE_DEVICE = None #Device to retain the conversation's KV cache on. Eg: 'cpu'. Uses the model's device if None.
+MAX_BATCH_SIZE = 16 #Maximum number of requests decoded together by the local LLM's generation scheduler. Requests are generated one at a time if 1.
+GENERATION_WORKERS = MAX_BATCH_SIZE #Number of requests the local LLM chatbot processes concurrently. Sized to fill a decode batch.
+GRADIO_CONCURRENCY_COUNT = GENERATION_WORKERS #Number of requests the gradio queue of the local LLM app serves concurrently.
+RESPONSE_CACHE_MAX_ENTRIES = 1024 #Maximum number of responses in the in-memory tier of the response cache.
+RESPONSE_CACHE_TTL_SECONDS = 24 * 60 * 60 #Time to live of a cached response.
+RESPONSE_CACHE_DISK_PATH = None #Path of the sqlite file for the on-disk tier of the response cache. Eg: 'logs/response_cache.sqlite'. Disabled if None.
+MAX_CONCURRENT_API_REQUESTS = 256 #Maximum number of concurrent connections of the async mistral API client.
+API_GRADIO_CONCURRENCY_COUNT = 256 #Number of requests the gradio queue of the LLM API app serves concurrently.
+API_REQUEST_DEADLINE_SECONDS = 60.0 #Time within which a streamed response from the mistral API should complete.
+API_FIRST_TOKEN_TIMEOUT_SECONDS = 5.0 #Time to wait for the first token of the mistral API response before sending a hedged request.
+API_HEDGE_REQUESTS = True #Whether to send a hedged duplicate request on first token timeout. The request is retried instead if False.
+API_MAX_RETRIES = 2 #Maximum retries of the mistral API request on connection errors before any output is sent.
+API_RETRY_BACKOFF_SECONDS = 0.5 #Base delay of the jittered exponential backoff between the retries.
+API_BASE_URL = os.environ.get("MISTRAL_API_BASE_URL", "https://api.mistral.ai") #Endpoint of the mistral API. Point it at the fake server (src.llm_api.fake_server) for reproducible performance tests.
+PROMPT_LOG_QUEUE_SIZE = 1000 #Maximum number of prompt log records waiting to be logged onto comet-ml.
+PROMPT_LOG_BATCH_SIZE = 32 #Maximum number of prompt log records taken off the queue at once. comet-ml logs a single record per call.
+PROMPT_LOG_FLUSH_SECONDS = 2.0 #Maximum time a prompt log record waits for its group to fill.
+PROMPT_LOG_OVERFLOW_POLICY = 'spool' #What the background thread does with a prompt log record which didn't fit in the queue. One of 'spool', 'drop' or 'buffer' (logged after the queued records).
+PROMPT_LOG_OVERFLOW_SIZE = 1000 #Maximum number of prompt log records waiting on the overflow buffer when the queue is full. Records are dropped beyond it.
+PROMPT_LOG_SPOOL_PATH = 'logs/prompt_log_spool.jsonl' #Local file to spool the prompt log records on when comet-ml is slow or down.
+PROMPT_LOG_SLOW_SINK_SECONDS = 5.0 #A comet-ml call longer than this is treated as a slow sink.
+PROMPT_LOG_RETRY_SECONDS = 30.0 #Time to spool the records for before trying comet-ml again after a failure or a slow call.
+PROMPT_LOG_SHUTDOWN_SECONDS = 10.0 #Time to wait for the pending prompt log records to be flushed on shutdown.
+TOKENIZER_PATH = 'resources/tokenizer/tokenizer.json' #Pre-serialized fast tokenizer of MODEL_NAME used by the API client for counting tokens.
+MODEL_ARTIFACT_DIR = 'artifacts/model' #Directory of the pre-quantized model artifact. Created via `python -m src.local_llm.artifacts`.
+MODEL_ARTIFACT_VERIFY_CHECKSUMS = False #Whether to verify the checksums of all the model artifact's files on every boot. Else only the files whose modification time has changed are verified.
+QUANTIZED_MODEL_DTYPE = 'bfloat16' #dtype of the modules of the 4-bit model which aren't quantized and its compute dtype. Same for the model artifact and the model quantized while loading.
+CPU_QUANTIZATION = 'int8' #Quantization of the model on cpu. 'int8' for dynamic quantization of the linear layers or None.
+CPU_DTYPE = 'auto' #dtype of the unquantized model on cpu. 'auto' uses bfloat16 where the cpu supports it else float32.
+CPU_NUM_THREADS = None #Number of intra-op threads used on cpu. torch's default (number of physical cores) is used if None.
+DRAFT_MODEL_NAME = None #Small model sharing MODEL_NAME's tokenizer used as the draft model for speculative decoding. Disabled if None.
+SPECULATIVE_NUM_DRAFT_TOKENS = 5 #Number of tokens the draft model proposes in each step of speculative decoding.
+PROMPT_LOOKUP_NUM_TOKENS = None #Tokens proposed per step by prompt lookup decoding, which copies from the prompt. Eg: 10. Disabled if None.
+PROMPT_LOOKUP_MAX_NGRAM_SIZE = 3 #Longest n-gram of the latest tokens matched against the prompt in prompt lookup decoding.
+STOP_STRINGS = ["QUESTION:"] #Responses are cut at these strings. The model rambles on into fake turns of the few shot examples otherwise.
+STREAM_MODE = "cumulative" #Frames of a streamed response carry the whole response so far ('cumulative') as the gradio chat interface needs, or only the new text ('delta').
+STREAM_FRAME_INTERVAL_SECONDS = 0.05 #Minimum time between the frames of a streamed response. Tokens arriving in between are coalesced into a single frame.
+STREAM_FRAME_MAX_CHARS = 64 #Characters collected which sends a frame of a streamed response before the interval.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100)) or None #Port of the prometheus metrics endpoint served at /metrics next to the gradio server. Set METRICS_PORT=0 to disable it.
+METRICS_HOST = os.environ.get("METRICS_HOST", "0.0.0.0") #Host the prometheus metrics endpoint binds to.
+METRICS_RATE_WINDOW_SECONDS = 10.0 #Window over which the tokens generated per second is reported.
+PROFILE_EVERY_N_REQUESTS = int(os.environ.get("PROFILE_EVERY_N_REQUESTS", 0)) #Profile one in these many requests with the sampling profiler. Disabled if 0.
+PROFILE_ALL_REQUESTS = os.environ.get("PROFILE_REQUESTS", "0") == "1" #Profile every request. Set PROFILE_REQUESTS=1 to turn it on while chasing a latency spike.
+PROFILE_REQUEST_HEADER = os.environ.get("PROFILE_REQUEST_HEADER", "x-profile-request") #Header which profiles a single request when set to 1. Strip it at the proxy if the app is public.
+PROFILE_INTERVAL_SECONDS = 0.005 #Time between the stack samples of a profiled request.
+PROFILE_DIR = 'logs/profiles' #Directory of the collapsed stack profiles of the profiled requests. Open them with flamegraph.pl or speedscope.
+PROFILE_MAX_FILES = 100 #Number of latest profiles retained in PROFILE_DIR.
+CONVERSATION_STORE_MAX_BYTES = 256 * 1024**2 #Memory budget for all the conversations held by the server-side conversation store.
+CONVERSATION_MAX_BYTES = 4 * 1024**2 #Memory budget for a single conversation of the conversation store.
+PROMPT_MEMO_MAX_BYTES = 64 * 1024**2 #Memory budget for the prompt messages of the chat histories memoized across the turns.
+FACT_RETRIEVAL_TOP_K = 4 #Facts of the bio in INSTRUCTION_TEMPLATE put in the prompt, picked by thier relevance to the question. The whole bio is sent if None.
+FACT_RETRIEVAL_MIN_SCORE = 2.0 #BM25 score a fact of the bio needs to be retrieved. The whole bio is sent when no fact other than the pinned facts scores this much.
+FACT_RETRIEVAL_PINNED_TOPICS = ("current job", "native place") #Topics of the bio's facts always put in the prompt along with the retrieved facts, so that questions like 'Who is Aakash?' can be answered.
+MAX_ACCEPTED_TOKENS = 3500 #Token budget for the chat history in the prompt. Mistral Instruct model has a context length of 4096.
 
 
 INSTRUCTION_TEMPLATE = f"""You are my sarcastic personal lady assistant named Diya and I am Aakash who is your boss. Keep all your answers in a sarcastic and funny tone such that it will make people to laugh.
@@ -0,0 +1,265 @@
+import sys
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from src.constants import *
+from src.utils import create_logger
+
+logger = create_logger(LOGFILE_PATH)
+
+#Approximate memory of a turn and of a segment apart from thier text and token ids. Eg: the tuple and dict slots.
+TURN_OVERHEAD_BYTES = 128
+SEGMENT_OVERHEAD_BYTES = 160
+
+#Key of a prompt segment as used by the prompt encoder. (Whether it is the first segment of the prompt, segment text)
+SegmentKey = Tuple[bool, str]
+
+
+class TokenSegments:
+    """
+    Token ids of the prompt segments of a conversation which aren't fixed, Eg: its queries and responses. Each
+    segment is tokenized on the turn it first appears and its ids are kept as a compact array for the later turns.
+    """
+
+    def __init__(self):
+        self._ids: Dict[SegmentKey, array] = {}
+        self.num_bytes = 0
+
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+    def get(self, key: SegmentKey) -> Optional[array]:
+        return self._ids.get(key)
+
+
+    def put(self, key: SegmentKey, token_ids: Sequence[int]) -> array:
+        segment_ids = array("i", token_ids)
+        if key not in self._ids:
+            self.num_bytes += len(key[1]) + segment_ids.itemsize * len(segment_ids) + SEGMENT_OVERHEAD_BYTES
+        self._ids[key] = segment_ids
+
+        return segment_ids
+
+
+    def clear(self):
+        self._ids.clear()
+        self.num_bytes = 0
+
+
+class Conversation:
+    """
+    A conversation held by the ConversationStore. Its turns are (query, response) pairs of interned strings and
+    the rolling hash of the history is extended with every turn, so a new turn costs the same irrespective of
+    the length of the conversation.
+
+    Args:
+        session_id (str): Id of the UI session the conversation belongs to.
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.turns: List[Tuple[str, str]] = []
+        self.segments = TokenSegments()
+        self.text_bytes = 0
+
+        #Running hash of the turns, same as the keys of the prompt memo. See get_history_keys.
+        self._hasher = hashlib.sha256()
+        self._keys = (self._hasher.digest(), self._hasher.digest())
+
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+
+    @property
+    def num_bytes(self) -> int:
+        """Approximate memory held by the conversation."""
+
+        return self.text_bytes + self.segments.num_bytes
+
+
+    @property
+    def history_keys(self) -> Tuple[bytes, bytes]:
+        """Rolling hash of the history without its latest turn and of the whole history."""
+
+        return self._keys
+
+
+    def as_string(self) -> str:
+        """The conversation as 'Human:' and 'AI:' lines, same as convert_chat_history_as_string. Used while logging the prompt."""
+
+        return "".join(f"Human: {question.strip()}\nAI: {response.strip()}\n" for question, response in self.turns)
+
+
+    def append(self, question: str, response: str):
+        """Add a turn to the conversation. Repeated texts, Eg: the example queries, are stored once."""
+
+        question, response = sys.intern(question), sys.intern(response)
+        self.turns.append((question, response))
+        self.text_bytes += len(question) + len(response) + TURN_OVERHEAD_BYTES
+
+        self._hasher.update(f"{question}\0{response}\0".encode("utf-8"))
+        self._keys = (self._keys[1], self._hasher.digest())
+
+
+class ConversationStore:
+    """
+    Server-side store of the conversations of the UI sessions. The UI passes the whole history on every turn but
+    the store takes only the turn added since the previous request, so the work per request and the objects
+    created for it don't grow with the length of the conversation. The store is a cache of the UI's history:
+    a conversation which doesn't follow the stored one, Eg: after the chat is cleared, is rebuilt from the history.
+
+    The store doesn't shrink the request itself. Gradio's ChatInterface still sends the whole history from the
+    browser on every turn and the history is still deserialized, so the payload grows with the conversation.
+
+    A conversation whose token ids exceed the per-session budget drops them first and is dropped as a whole if
+    its text alone exceeds the budget. Conversations are evicted in least recently used order when the memory
+    of all the conversations exceeds the global budget.
+
+    Args:
+        max_bytes (int, optional): Memory budget for all the conversations. Defaults to CONVERSATION_STORE_MAX_BYTES.
+        max_session_bytes (int, optional): Memory budget for a single conversation. Defaults to CONVERSATION_MAX_BYTES.
+        strip_texts (bool, optional): Strip the whitespaces around the queries and responses. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = CONVERSATION_STORE_MAX_BYTES,
+        max_session_bytes: int = CONVERSATION_MAX_BYTES,
+        strip_texts: bool = False,
+    ):
+        self.max_bytes = max_bytes
+        self.max_session_bytes = max_session_bytes
+        self.strip_texts = strip_texts
+
+        self._conversations = OrderedDict() #session_id -> (Conversation, bytes accounted for it)
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+
+        self.appends = 0
+        self.reuses = 0
+        self.rebuilds = 0
+        self.evictions = 0
+        self.oversized = 0
+
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+
+    def _get_pair(self, pair: Sequence[str]) -> Tuple[str, str]:
+        question, response = pair[0], pair[1]
+        if self.strip_texts:
+            return question.strip(), response.strip()
+
+        return question, response
+
+
+    def _follows(self, conversation: Conversation, chat_history: Sequence[Sequence[str]]) -> bool:
+        """Whether the history is the stored conversation with atmost one more turn. Only the latest stored
+           turn is compared, since the UI only ever adds a turn or clears the whole chat."""
+
+        num_turns = len(conversation)
+        if num_turns not in (len(chat_history), len(chat_history) - 1):
+            return False
+
+        return not num_turns or conversation.turns[-1] == self._get_pair(chat_history[num_turns - 1])
+
+
+    def sync(self, session_id: str, chat_history: Sequence[Sequence[str]]) -> Optional[Conversation]:
+        """Get the session's conversation for the history passed by the UI. Only the turn added since the previous
+           request is taken from the history if the conversation is stored.
+
+        Args:
+            session_id (str): Id of the UI session.
+            chat_history (Sequence[Sequence[str]]): Past conversation as (query, response) pairs.
+
+        Returns:
+            Optional[Conversation]: The conversation. None if it exceeds the per-session budget, in which case
+                                    the history is to be used as such.
+        """
+
+        with self._lock:
+            conversation, accounted_bytes = self._conversations.pop(session_id, (None, 0))
+            self.total_bytes -= accounted_bytes
+
+        if conversation is not None and self._follows(conversation, chat_history):
+            if len(conversation) < len(chat_history):
+                conversation.append(*self._get_pair(chat_history[-1]))
+                with self._lock:
+                    self.appends += 1
+            else:
+                with self._lock:
+                    self.reuses += 1
+        else:
+            conversation = Conversation(session_id)
+            for pair in chat_history:
+                conversation.append(*self._get_pair(pair))
+            with self._lock:
+                self.rebuilds += 1
+
+        self._put(conversation)
+
+        return conversation if conversation.text_bytes <= self.max_session_bytes else None
+
+
+    def _put(self, conversation: Conversation):
+        """Store the conversation within the budgets and evict the least recently used conversations."""
+
+        if conversation.num_bytes > self.max_session_bytes:
+            conversation.segments.clear()
+        if conversation.num_bytes > self.max_session_bytes:
+            with self._lock:
+                self.oversized += 1
+            logger.info(f"Conversation of the session {conversation.session_id} exceeds the per-session memory budget. Not storing it")
+            return
+
+        with self._lock:
+            previous_conversation, previous_bytes = self._conversations.pop(conversation.session_id, (None, 0))
+            self.total_bytes -= previous_bytes
+
+            self._conversations[conversation.session_id] = (conversation, conversation.num_bytes)
+            self.total_bytes += conversation.num_bytes
+
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._conversations.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+                self.evictions += 1
+
+
+    def update(self, conversation: Conversation):
+        """Account for the memory the conversation has taken since it was synced. Eg: the token ids of its segments."""
+
+        with self._lock:
+            if conversation.session_id not in self._conversations:
+                return
+
+        self._put(conversation)
+
+
+    def discard(self, session_id: str):
+        """Drop the conversation of the session, Eg: once the session is closed."""
+
+        with self._lock:
+            _, accounted_bytes = self._conversations.pop(session_id, (None, 0))
+            self.total_bytes -= accounted_bytes
+
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Returns the counters and the memory occupied by the store."""
+
+        return {
+            "sessions": len(self._conversations),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "appends": self.appends,
+            "reuses": self.reuses,
+            "rebuilds": self.rebuilds,
+            "evictions": self.evictions,
+            "oversized": self.oversized,
+        }
@@ -0,0 +1,285 @@
+import re
+import math
+import functools
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from src.constants import *
+
+#Heading of the bio section of the INSTRUCTION_TEMPLATE. The section runs untill the next heading.
+BIO_HEADING = "### INFORMATION ABOUT ME(AAKASH):"
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+#Words which say nothing about the fact asked for. Aakash is in every fact and his name is known without any fact.
+_STOPWORDS = frozenset(
+    "a an and are about at be by can could did do does for from give has have he her his him how i in is it its me "
+    "my of on or please tell that the their there this to was what when where which who whom whose why will with "
+    "would you your aakash aakashs s know hi hello hey name detail info information share more some any also "
+    "all other thing like want wanna let us we they them get got much many".split()
+)
+
+
+#Words of the questions mapped to the words the bio uses for the same topic. Applied before removing the stopwords.
+QUERY_SYNONYMS = {
+    "study": "education college school",
+    "studied": "education college school",
+    "degree": "education",
+    "college": "education",
+    "old": "age birth",
+    "birthday": "birth",
+    "from": "native hometown",
+    "live": "native residing",
+    "work": "job",
+    "works": "job",
+    "company": "job",
+    "contact": "email instagram linkedin",
+    "music": "song",
+    "skill": "skillset expertise",
+    "skills": "skillset expertise",
+    "expert": "expertise",
+    "married": "relationship",
+    "marriage": "relationship",
+    "wife": "relationship",
+    "single": "relationship",
+    "dating": "relationship",
+    "born": "birth",
+    "weigh": "weight",
+}
+
+
+def stem(word: str) -> str:
+    """Reduce a word to a crude stem so that the plural, -ing and -ed forms and the british spellings match."""
+
+    word = word.replace("favorite", "favourite")
+
+    if word.endswith("ies") and len(word) > 4:
+        word = word[:-3] + "i"
+    elif word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        word = word[:-1]
+
+    if word.endswith("ing") and len(word) > 5:
+        word = word[:-3]
+    elif word.endswith("ed") and len(word) > 4:
+        word = word[:-2]
+
+    if word.endswith("y") and len(word) > 3:
+        word = word[:-1] + "i"
+    elif word.endswith("e") and len(word) > 3:
+        word = word[:-1]
+
+    return word
+
+
+_STOPWORD_STEMS = frozenset(stem(word) for word in _STOPWORDS)
+
+
+def tokenize(text: str, expand_synonyms: bool = False) -> List[str]:
+    """Lower cased word stems of the text without the stopwords. The query's words are expanded with QUERY_SYNONYMS."""
+
+    words = _WORD.findall(text.lower().replace("'", ""))
+    if expand_synonyms:
+        words += [synonym for word in words for synonym in QUERY_SYNONYMS.get(word, "").split()]
+
+    stems = [stem(word) for word in words if word not in _STOPWORDS]
+
+    #The stopwords are matched after stemming as well. Eg: 'details' and 'names'.
+    return [word for word in stems if word not in _STOPWORD_STEMS]
+
+
+def split_instruction_template(template: str = INSTRUCTION_TEMPLATE) -> Tuple[str, List[str]]:
+    """Split the instruction template into the persona instructions without the bio section and the facts of the bio.
+
+    Returns:
+        Tuple[str, List[str]]: The instructions and the facts, one line each.
+    """
+
+    start = template.find(BIO_HEADING)
+    if start == -1:
+        return template, []
+
+    end = template.find("\n###", start + len(BIO_HEADING))
+    end = len(template) if end == -1 else end + 1
+
+    facts = [line.strip() for line in template[start + len(BIO_HEADING):end].splitlines() if line.strip()]
+
+    return template[:start] + template[end:], facts
+
+
+def format_facts(facts: List[str]) -> str:
+    """Format the facts as the bio section of the prompt. Empty if there are no facts."""
+
+    if not facts:
+        return ""
+
+    return BIO_HEADING + "\n" + "\n".join(facts) + "\n\n"
+
+
+def is_fact_of(fact: str, topics: Tuple[str, ...]) -> bool:
+    """Whether the topic of the fact, the part before its ':', mentions any of the topics."""
+
+    fact_topic = fact.partition(":")[0].lower()
+
+    return any(topic.lower() in fact_topic for topic in topics)
+
+
+class FactIndex:
+    """
+    In-process BM25 index over the facts of the bio. The topic of a fact, the part before its ':', is counted twice
+    since it names what the fact is about. A search costs a dictionary lookup per query term and fact.
+
+    Args:
+        facts (List[str]): Facts to index.
+        k1 (float, optional): Term frequency saturation of BM25. Defaults to 1.2.
+        b (float, optional): Length normalization of BM25. Defaults to 0.75.
+    """
+
+    def __init__(self, facts: List[str], k1: float = 1.2, b: float = 0.75):
+        self.facts = facts
+        self.k1 = k1
+        self.b = b
+
+        documents = []
+        for fact in facts:
+            topic, _, _ = fact.partition(":")
+            documents.append(tokenize(topic) * 2 + tokenize(fact))
+
+        self._term_counts: List[Counter] = [Counter(document) for document in documents]
+        self._lengths = [len(document) for document in documents]
+        self._average_length = sum(self._lengths) / len(documents) if documents else 0.0
+
+        document_frequency = Counter(term for counts in self._term_counts for term in counts)
+        self._idf: Dict[str, float] = {
+            term: math.log(1 + (len(documents) - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+
+    def score(self, query: str) -> List[float]:
+        """BM25 score of every fact for the query."""
+
+        terms = [term for term in tokenize(query, expand_synonyms=True) if term in self._idf]
+        scores = [0.0] * len(self.facts)
+
+        for index, (counts, length) in enumerate(zip(self._term_counts, self._lengths)):
+            normalization = self.k1 * (1 - self.b + self.b * length / self._average_length)
+            for term in terms:
+                frequency = counts.get(term)
+                if frequency:
+                    scores[index] += self._idf[term] * frequency * (self.k1 + 1) / (frequency + normalization)
+
+        return scores
+
+
+    def search(
+        self,
+        query: str,
+        top_k: int,
+        context: Optional[str] = None,
+        context_weight: float = 0.5,
+        min_relative_score: float = 0.5,
+        min_score: float = 0.0,
+    ) -> List[str]:
+        """Facts relevant to the query, in thier order in the bio.
+
+        Args:
+            query (str): Text to find the facts for. Eg: The question.
+            top_k (int): Maximum number of facts.
+            context (str, optional): Text which is matched with a lower weight. Eg: The previous question, for the
+                                     follow up questions like 'What about his favourite movie?'. Defaults to None.
+            context_weight (float, optional): Weight of the context's scores. Defaults to 0.5.
+            min_relative_score (float, optional): Facts scoring below this fraction of the best score are left out. Defaults to 0.5.
+            min_score (float, optional): Facts scoring below this are left out. Eg: Facts matching only a generic word like 'favourite'. Defaults to 0.0.
+
+        Returns:
+            List[str]: Up to top_k facts. Empty if nothing matches.
+        """
+
+        scores = self.score(query)
+        if context:
+            scores = [score + context_weight * context_score for score, context_score in zip(scores, self.score(context))]
+
+        best_score = max(scores, default=0.0)
+        if best_score <= 0 or best_score < min_score:
+            return []
+
+        ranked = sorted(range(len(scores)), key=lambda index: scores[index], reverse=True)[:top_k]
+        selected = sorted(index for index in ranked if scores[index] >= max(min_relative_score * best_score, min_score))
+
+        return [self.facts[index] for index in selected]
+
+
+class FactRetriever:
+    """
+    Builds the instructions of the prompt with only the facts of the bio relevant to the question. The persona
+    instructions are fixed and are put first so that they remain a static prompt prefix. The relevant facts are
+    put right before the current question, so that the earlier turns of the conversation stay the same across turns.
+    The facts of the pinned topics, Eg: who Aakash is, are put on every question along with the relevant facts.
+    The whole bio is put when no other fact scores atleast min_score, since the question may still be about a fact
+    which isn't matched by its words. Eg: 'Who is Aakash?' or a question using a word the bio doesn't.
+
+    Args:
+        template (str, optional): Instruction template with the bio section. Defaults to INSTRUCTION_TEMPLATE.
+        top_k (int, optional): Maximum facts put in the prompt apart from the pinned facts. The whole template is used as such if None. Defaults to FACT_RETRIEVAL_TOP_K.
+        pinned_topics (Tuple[str, ...], optional): Topics of the facts always put in the prompt. Defaults to FACT_RETRIEVAL_PINNED_TOPICS.
+        min_score (float, optional): BM25 score a fact needs to be put in the prompt. Defaults to FACT_RETRIEVAL_MIN_SCORE.
+    """
+
+    def __init__(
+        self,
+        template: str = INSTRUCTION_TEMPLATE,
+        top_k: Optional[int] = FACT_RETRIEVAL_TOP_K,
+        pinned_topics: Tuple[str, ...] = FACT_RETRIEVAL_PINNED_TOPICS,
+        min_score: float = FACT_RETRIEVAL_MIN_SCORE,
+    ):
+        self.top_k = top_k
+        self.min_score = min_score
+
+        if top_k is None:
+            self.instructions, self.facts = template, []
+        else:
+            self.instructions, self.facts = split_instruction_template(template)
+
+        self.index = FactIndex(self.facts)
+        self.pinned_facts = [fact for fact in self.facts if is_fact_of(fact, pinned_topics)]
+
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.top_k is not None and bool(self.facts)
+
+
+    @property
+    def prompt_signature(self) -> str:
+        """Text identifying the instructions and the facts the prompts are built with."""
+
+        return self.instructions + format_facts(self.facts) + format_facts(self.pinned_facts) + f"top_k={self.top_k},min_score={self.min_score}"
+
+
+    def retrieve(self, question: str, previous_question: Optional[str] = None) -> List[str]:
+        """Pinned facts and the facts relevant to the question, in thier order in the bio. All the facts if none
+           other than the pinned facts are relevant. The previous question helps the follow up questions."""
+
+        if not self.is_enabled:
+            return []
+
+        relevant_facts = set(self.index.search(question, self.top_k, context=previous_question, min_score=self.min_score))
+        if not relevant_facts - set(self.pinned_facts):
+            return self.facts
+
+        relevant_facts |= set(self.pinned_facts)
+
+        return [fact for fact in self.facts if fact in relevant_facts]
+
+
+    def get_facts_prompt(self, question: str, previous_question: Optional[str] = None) -> str:
+        """Bio section of the prompt with the pinned facts and the facts relevant to the question, or the whole bio if none are."""
+
+        return format_facts(self.retrieve(question, previous_question))
+
+
+@functools.lru_cache(maxsize=None)
+def get_fact_retriever(top_k: Optional[int] = FACT_RETRIEVAL_TOP_K) -> FactRetriever:
+    """Returns the fact retriever of the INSTRUCTION_TEMPLATE shared by the whole process."""
+
+    return FactRetriever(INSTRUCTION_TEMPLATE, top_k)
@@ -1,28 +1,34 @@
 import warnings
 warnings.filterwarnings("ignore")
 
+import uuid
 import gradio as gr
 from typing import List
 
+from src.constants import API_GRADIO_CONCURRENCY_COUNT, METRICS_PORT, METRICS_HOST
+from src.metrics import start_metrics_server
+from src.profiler import is_profile_requested
 from .llm_api_client import MistralAPIClient
 
 #Instantiate a LLMAPI client
 client = MistralAPIClient()
 
-def predict(message: str, history: List[List[str]], about_me: str):
+async def predict(message: str, history: List[List[str]], session_id: str, request: gr.Request):
     """
     Predicts a response to a given query using the LLM Client.
 
     Args:
         message (str): The query provdided by the user for response generation.
         history (List[List[str]]): A list of previous conversations.
+        session_id (str): Id of the browser session. The server keeps the session's conversation and takes only its new turn.
+        request (gr.Request): The HTTP request. The request is profiled if its PROFILE_REQUEST_HEADER is set to 1.
         
     Returns:
         str: The response generated by the model.
     """
     
-    #Stream the answer to the query from the LLM client
-    for text in client.stream_answer(message, history):
+    #Stream the answer to the query from the LLM client without holding a worker thread.
+    async for text in client.astream_answer(message, history, profile=is_profile_requested(request), session_id=session_id):
         yield text
 
 
@@ -53,6 +59,7 @@ demo = gr.ChatInterface(
             "What does Aakash loves to do in his free time?"
         ]
     ],
+    additional_inputs=[gr.State(lambda: uuid.uuid4().hex)], #A new session id on every page load.
     cache_examples=False,
     retry_btn=None,
     undo_btn=None,
@@ -61,4 +68,5 @@ demo = gr.ChatInterface(
 
 
 if __name__ == "__main__":
-    demo.queue(api_open=False).launch(server_name="0.0.0.0", server_port=7860, share=False, show_api=False) #Launch the web app UI.
\ No newline at end of file
+    start_metrics_server(METRICS_PORT, METRICS_HOST) #Serve the prometheus metrics at /metrics next to the web app, if the port is free.
+    demo.queue(api_open=False, concurrency_count=API_GRADIO_CONCURRENCY_COUNT).launch(server_name="0.0.0.0", server_port=7860, share=False, show_api=False) #Launch the web app UI.
\ No newline at end of file
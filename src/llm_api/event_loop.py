@@ -0,0 +1,108 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import AsyncIterator, Awaitable, Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+_END_OF_STREAM = object()
+
+
+class BackgroundEventLoop:
+    """
+    An asyncio event loop running forever on a daemon thread. Async network clients are created and used only
+    on this loop, so that thier pooled keep-alive connections are reused by every request irrespective of the
+    event loop or the thread the request is served from.
+    """
+
+    def __init__(self, name: str = "llm-api-event-loop"):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name=name, daemon=True)
+        self._thread.start()
+
+
+    @property
+    def name(self) -> str:
+        """Name of the loop's thread."""
+
+        return self._thread.name
+
+
+    def submit(self, coroutine: Awaitable[T]) -> Future:
+        """Schedule a coroutine on the background loop from any thread.
+
+        Returns:
+            Future: A concurrent future which resolves to the result of the coroutine.
+        """
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+
+    def run(self, coroutine: Awaitable[T]) -> T:
+        """Run a coroutine on the background loop and block untill its result is available."""
+
+        return self.submit(coroutine).result()
+
+
+    def iterate(self, stream_factory: Callable[[], AsyncIterator[T]]) -> Iterator[T]:
+        """Consume an async stream on the background loop from a synchronous caller.
+
+        Args:
+            stream_factory (Callable[[], AsyncIterator[T]]): Creates the stream.
+
+        Yields:
+            Iterator[T]: Items of the stream.
+        """
+
+        stream = stream_factory()
+
+        async def next_item():
+            try:
+                return await stream.__anext__()
+            except StopAsyncIteration:
+                return _END_OF_STREAM
+
+        try:
+            while True:
+                item = self.run(next_item())
+                if item is _END_OF_STREAM:
+                    break
+                yield item
+        finally:
+            self.submit(stream.aclose())
+
+
+    async def relay(self, stream_factory: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """Consume an async stream on the background loop and relay its items onto the caller's event loop.
+           The stream is cancelled on the background loop if the caller stops consuming it.
+
+        Args:
+            stream_factory (Callable[[], AsyncIterator[T]]): Creates the stream. Called on the background loop.
+
+        Yields:
+            AsyncIterator[T]: Items of the stream.
+        """
+
+        caller_loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+
+        async def pump():
+            try:
+                async for item in stream_factory():
+                    caller_loop.call_soon_threadsafe(items.put_nowait, (item, None))
+                caller_loop.call_soon_threadsafe(items.put_nowait, (_END_OF_STREAM, None))
+            except BaseException as error:
+                caller_loop.call_soon_threadsafe(items.put_nowait, (_END_OF_STREAM, error))
+                raise
+
+        pump_future = self.submit(pump())
+        try:
+            while True:
+                item, error = await items.get()
+                if error is not None:
+                    raise error
+                if item is _END_OF_STREAM:
+                    break
+                yield item
+        finally:
+            pump_future.cancel()
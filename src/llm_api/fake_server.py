@@ -0,0 +1,480 @@
+"""Fake mistral API server for reproducible performance tests of the API client.
+
+Speaks the chat completions streaming protocol used by the mistral client (server sent events over a chunked
+HTTP/1.1 response with keep-alive) and replays the recorded responses. The time to first token, the delay between
+the tokens, the jitter, the errors and the stalls are configurable, so that the same load can be replayed run after run.
+Built on asyncio streams alone so that hundreds of concurrent streams cost a task each.
+
+The responses are recorded by running the server in the record mode, where it proxies the requests to the real
+API and saves the chunks along with thier timings. Point the client at the server via MISTRAL_API_BASE_URL.
+
+Usage:
+    python -m src.llm_api.fake_server --record --recordings recordings/mistral.jsonl --upstream https://api.mistral.ai
+    python -m src.llm_api.fake_server --recordings recordings/mistral.jsonl --ttft-ms 300 --token-delay-ms 30 --jitter-ms 10
+    MISTRAL_API_BASE_URL=http://localhost:8001 python -m src.llm_api.app_ui
+"""
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import argparse
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.constants import *
+from src.utils import create_logger
+from src.response_cache import iter_response_chunks
+
+logger = create_logger(LOGFILE_PATH)
+
+#Response streamed for the requests without a recording.
+SYNTHETIC_RESPONSE = (
+    "Hello there! I'm Diya, Aakash's personal assistant. Aakash is currently working as a Junior Research Engineer "
+    "at BUDDI AI, Chennai, India. What else would you like to know about my boss?"
+)
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+def get_request_key(request: Dict[str, Any]) -> str:
+    """Key of a chat request to look up its recording. Only the model and the messages decide the response."""
+
+    content = json.dumps({"model": request.get("model"), "messages": request.get("messages")}, sort_keys=True)
+
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class Recording:
+    """
+    Chunks of a streamed response along with the delay of each chunk after the previous one. The delay of the
+    first chunk is the time to first token.
+
+    Args:
+        key (str): Key of the request the response was recorded for.
+        chunks (List[Tuple[float, Dict]]): Delay in seconds and the data of each chunk.
+    """
+
+    def __init__(self, key: str, chunks: List[Tuple[float, Dict[str, Any]]]):
+        self.key = key
+        self.chunks = chunks
+
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"key": self.key, "chunks": [{"delay_seconds": delay, "data": data} for delay, data in self.chunks]}
+
+
+    @classmethod
+    def from_dict(cls, record: Dict[str, Any]) -> "Recording":
+        return cls(record["key"], [(chunk["delay_seconds"], chunk["data"]) for chunk in record["chunks"]])
+
+
+def get_synthetic_recording(request: Dict[str, Any], token_delay_seconds: float = 0.03) -> Recording:
+    """Recording of SYNTHETIC_RESPONSE streamed word by word, with the usage reported on the last chunk like the API."""
+
+    model = request.get("model", API_ENDPOINT_NAME)
+    words = list(iter_response_chunks(SYNTHETIC_RESPONSE))
+    chunks = [(token_delay_seconds, {"choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})]
+    chunks += [(token_delay_seconds, {"choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}) for word in words]
+
+    prompt_tokens = len(json.dumps(request.get("messages", []))) // 4
+    chunks[-1][1]["choices"][0]["finish_reason"] = "stop"
+    chunks[-1][1]["usage"] = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+
+    for _, data in chunks:
+        data.update({"id": "", "object": "chat.completion.chunk", "model": model})
+
+    return Recording(get_request_key(request), chunks)
+
+
+class RecordingStore:
+    """
+    Recorded responses kept in a JSON lines file, one recording per line. A request without a recording of its
+    own is replayed with the recordings in turn, or with the synthetic response if there are none.
+
+    Args:
+        path (str, optional): Path of the recordings file. Only the synthetic response is replayed if None. Defaults to None.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._recordings: Dict[str, Recording] = {}
+        self._order: List[str] = []
+        self._next_index = 0
+
+        if path is not None and os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    if line.strip():
+                        self._add(Recording.from_dict(json.loads(line)))
+
+        logger.info(f"Loaded {len(self._order)} recordings for the fake mistral server")
+
+
+    def _add(self, recording: Recording):
+        if recording.key not in self._recordings:
+            self._order.append(recording.key)
+        self._recordings[recording.key] = recording
+
+
+    def lookup(self, request: Dict[str, Any]) -> Recording:
+        """Recording of the request. Falls back to the other recordings in turn and then to the synthetic response."""
+
+        recording = self._recordings.get(get_request_key(request))
+        if recording is not None:
+            return recording
+
+        if not self._order:
+            return get_synthetic_recording(request)
+
+        key = self._order[self._next_index % len(self._order)]
+        self._next_index += 1
+
+        return self._recordings[key]
+
+
+    def save(self, recording: Recording):
+        """Add the recording and append it onto the recordings file."""
+
+        self._add(recording)
+
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as file:
+                file.write(json.dumps(recording.to_dict()) + "\n")
+
+
+class ReplayProfile:
+    """
+    Timings and faults of the replayed streams. The recorded timings are used where a timing is None.
+
+    Args:
+        ttft_seconds (float, optional): Time to first token. Defaults to None.
+        token_delay_seconds (float, optional): Delay between the chunks after the first. Defaults to None.
+        jitter_seconds (float, optional): Upper bound of the random delay added to every chunk. Defaults to 0.
+        error_rate (float, optional): Fraction of the requests answered with error_status. Defaults to 0.
+        error_status (int, optional): HTTP status of the injected errors. Defaults to 503.
+        disconnect_rate (float, optional): Fraction of the streams whose connection is dropped midway. Defaults to 0.
+        stall_rate (float, optional): Fraction of the streams which stall midway for stall_seconds. Defaults to 0.
+        stall_seconds (float, optional): Length of a stall. Defaults to 10.
+        seed (int, optional): Seed of the random faults and jitter. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        ttft_seconds: Optional[float] = None,
+        token_delay_seconds: Optional[float] = None,
+        jitter_seconds: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        disconnect_rate: float = 0.0,
+        stall_rate: float = 0.0,
+        stall_seconds: float = 10.0,
+        seed: Optional[int] = None,
+    ):
+        self.ttft_seconds = ttft_seconds
+        self.token_delay_seconds = token_delay_seconds
+        self.jitter_seconds = jitter_seconds
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self._random = random.Random(seed)
+
+
+    def get_delay(self, index: int, recorded_delay: float) -> float:
+        """Delay before sending the chunk at the index."""
+
+        delay = self.ttft_seconds if not index else self.token_delay_seconds
+        if delay is None:
+            delay = recorded_delay
+
+        return delay + self._random.uniform(0, self.jitter_seconds)
+
+
+    def is_error(self) -> bool:
+        return self._random.random() < self.error_rate
+
+
+    def get_fault_index(self, rate: float, num_chunks: int) -> Optional[int]:
+        """Index of the chunk before which a fault of the given rate happens, or None."""
+
+        if num_chunks < 2 or self._random.random() >= rate:
+            return None
+
+        return self._random.randrange(1, num_chunks)
+
+
+class FakeMistralServer:
+    """
+    HTTP server replaying the recorded chat completion streams as per the replay profile. In the record mode the
+    requests are proxied onto the upstream API and the streams are recorded with thier timings instead.
+
+    Args:
+        store (RecordingStore): Recordings to replay or to record into.
+        profile (ReplayProfile, optional): Timings and faults of the replayed streams. Defaults to ReplayProfile().
+        upstream (str, optional): Base URL of the real API. The server records the responses if provided. Defaults to None.
+    """
+
+    def __init__(self, store: RecordingStore, profile: Optional[ReplayProfile] = None, upstream: Optional[str] = None):
+        self.store = store
+        self.profile = profile if profile is not None else ReplayProfile()
+        self.upstream = upstream
+        self._upstream_client = None
+
+        self.requests = 0
+        self.active_streams = 0
+        self.max_active_streams = 0
+        self.injected_errors = 0
+        self.injected_disconnects = 0
+        self.injected_stalls = 0
+
+
+    async def serve(self, host: str = "0.0.0.0", port: int = 8001):
+        """Serve the requests untill cancelled."""
+
+        server = await asyncio.start_server(self._handle_connection, host, port, backlog=4096)
+        logger.info(f"Fake mistral server listening on {host}:{port} in {'record' if self.upstream else 'replay'} mode")
+
+        async with server:
+            await server.serve_forever()
+
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "active_streams": self.active_streams,
+            "max_active_streams": self.max_active_streams,
+            "injected_errors": self.injected_errors,
+            "injected_disconnects": self.injected_disconnects,
+            "injected_stalls": self.injected_stalls,
+        }
+
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        """Read a HTTP/1.1 request. Returns None once the client closes the connection."""
+
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        return method, path, headers, body
+
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve the requests of a keep-alive connection one after the other."""
+
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if not await self._handle_request(writer, method, path, headers, body):
+                    break
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logger.exception("Fake mistral server failed to serve the request")
+        finally:
+            writer.close()
+
+
+    async def _handle_request(self, writer: asyncio.StreamWriter, method: str, path: str, headers: Dict[str, str], body: bytes) -> bool:
+        """Serve a request.
+
+        Returns:
+            bool: Whether the connection can be kept alive.
+        """
+
+        self.requests += 1
+        path = path.split("?", 1)[0].rstrip("/")
+
+        if method == "GET" and path == "/v1/models":
+            await self._write_json(writer, 200, {"object": "list", "data": [{"id": API_ENDPOINT_NAME, "object": "model", "created": 0, "owned_by": "mistralai"}]})
+        elif method == "GET" and path == "/stats":
+            await self._write_json(writer, 200, self.stats())
+        elif method == "POST" and path == "/v1/chat/completions":
+            request = json.loads(body or b"{}")
+            if not request.get("stream"):
+                await self._write_json(writer, 400, {"object": "error", "message": "Only the streaming chat completions are supported."})
+            elif self.upstream is not None:
+                await self._record_stream(writer, request, headers.get("authorization", ""))
+            else:
+                return await self._replay_stream(writer, request)
+        else:
+            await self._write_json(writer, 404, {"object": "error", "message": f"{method} {path} is not supported."})
+
+        return True
+
+
+    async def _write_json(self, writer: asyncio.StreamWriter, status: int, content: Dict[str, Any]):
+        body = json.dumps(content).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS.get(status, 'Error')}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+
+    async def _start_event_stream(self, writer: asyncio.StreamWriter):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+            b"Transfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n"
+        )
+        await writer.drain()
+
+
+    async def _write_event(self, writer: asyncio.StreamWriter, data: str):
+        """Send a server sent event as a chunk of the chunked response."""
+
+        event = f"data: {data}\n\n".encode("utf-8")
+        writer.write(f"{len(event):x}\r\n".encode("latin-1") + event + b"\r\n")
+        await writer.drain()
+
+
+    async def _end_event_stream(self, writer: asyncio.StreamWriter):
+        await self._write_event(writer, "[DONE]")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+    async def _replay_stream(self, writer: asyncio.StreamWriter, request: Dict[str, Any]) -> bool:
+        """Replay the recording of the request with the timings and faults of the profile.
+
+        Returns:
+            bool: Whether the connection can be kept alive. False if it was dropped on purpose.
+        """
+
+        if self.profile.is_error():
+            self.injected_errors += 1
+            await self._write_json(writer, self.profile.error_status, {"object": "error", "message": "Injected error", "type": "fake_server_error"})
+            return True
+
+        recording = self.store.lookup(request)
+        disconnect_index = self.profile.get_fault_index(self.profile.disconnect_rate, len(recording.chunks))
+        stall_index = self.profile.get_fault_index(self.profile.stall_rate, len(recording.chunks))
+
+        #Each stream has its own id and creation time just like the API.
+        stream_id, created = uuid.uuid4().hex, int(time.time())
+
+        self.active_streams += 1
+        self.max_active_streams = max(self.max_active_streams, self.active_streams)
+        try:
+            await self._start_event_stream(writer)
+
+            for index, (recorded_delay, data) in enumerate(recording.chunks):
+                if index == disconnect_index:
+                    self.injected_disconnects += 1
+                    writer.transport.abort()
+                    return False
+
+                if index == stall_index:
+                    self.injected_stalls += 1
+                    await asyncio.sleep(self.profile.stall_seconds)
+
+                await asyncio.sleep(self.profile.get_delay(index, recorded_delay))
+                await self._write_event(writer, json.dumps({**data, "id": stream_id, "created": created, "model": request.get("model", data.get("model"))}))
+
+            await self._end_event_stream(writer)
+        finally:
+            self.active_streams -= 1
+
+        return True
+
+
+    async def _record_stream(self, writer: asyncio.StreamWriter, request: Dict[str, Any], authorization: str):
+        """Proxy the request onto the upstream API, relay its stream and record the chunks with thier timings."""
+
+        import httpx
+
+        if self._upstream_client is None:
+            self._upstream_client = httpx.AsyncClient(base_url=self.upstream, timeout=API_REQUEST_DEADLINE_SECONDS)
+
+        chunks = []
+        self.active_streams += 1
+        try:
+            async with self._upstream_client.stream(
+                "POST",
+                "/v1/chat/completions",
+                json=request,
+                headers={"Authorization": authorization, "Accept": "text/event-stream"},
+            ) as response:
+                if response.status_code != 200:
+                    await self._write_json(writer, response.status_code, json.loads(await response.aread() or b"{}"))
+                    return
+
+                await self._start_event_stream(writer)
+                last_time = time.perf_counter()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: ") or line[6:].strip() == "[DONE]":
+                        continue
+                    now = time.perf_counter()
+                    chunks.append((now - last_time, json.loads(line[6:])))
+                    last_time = now
+                    await self._write_event(writer, line[6:].strip())
+
+                await self._end_event_stream(writer)
+        finally:
+            self.active_streams -= 1
+
+        self.store.save(Recording(get_request_key(request), chunks))
+        logger.info(f"Recorded a response of {len(chunks)} chunks")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--recordings", default=None, help="JSON lines file of the recordings to replay or to record into.")
+    parser.add_argument("--record", action="store_true", help="Proxy the requests onto the upstream API and record them.")
+    parser.add_argument("--upstream", default="https://api.mistral.ai")
+    parser.add_argument("--ttft-ms", type=float, default=None, help="Time to first token. The recorded one is used if not set.")
+    parser.add_argument("--token-delay-ms", type=float, default=None, help="Delay between the tokens. The recorded one is used if not set.")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    parser.add_argument("--stall-seconds", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.record and args.recordings is None:
+        parser.error("--recordings is required to record")
+
+    to_seconds = lambda milliseconds: None if milliseconds is None else milliseconds / 1000
+    profile = ReplayProfile(
+        ttft_seconds=to_seconds(args.ttft_ms),
+        token_delay_seconds=to_seconds(args.token_delay_ms),
+        jitter_seconds=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        disconnect_rate=args.disconnect_rate,
+        stall_rate=args.stall_rate,
+        stall_seconds=args.stall_seconds,
+        seed=args.seed,
+    )
+    server = FakeMistralServer(RecordingStore(args.recordings), profile, upstream=args.upstream if args.record else None)
+
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,28 @@
 import os
 import time
-import threading
+import asyncio
+import functools
 from typing import *
 
-from transformers import AutoTokenizer
 from mistralai.client import MistralClient
+from mistralai.async_client import MistralAsyncClient
 from mistralai.models.chat_completion import ChatMessage
+from mistralai.exceptions import MistralConnectionException
 
 from src.constants import *
-from src.utils import log_prompt, filter_old_messages, post_process_output, create_logger
+from src.utils import create_logger, get_token_usage
+from src.prompt_logger import get_prompt_logger
+from src.metrics import get_metrics, StreamTracker
+from src.profiler import profile_request, run_profiled
+from src.stop_sequences import StopStringMatcher, StopSequenceStats
+from src.streaming import ResponseFramer, iter_response_frames, aiter_response_frames
+from src.response_cache import ResponseCache, iter_response_chunks
+from src.facts import get_fact_retriever
+from src.prompt_memo import PromptMemo
+from src.conversation_store import ConversationStore
+from .event_loop import BackgroundEventLoop
+from .resilience import HedgedStreamCaller
+from .tokenizer import get_api_tokenizer
 
 #Instantiate a logger.
 logger = create_logger(LOGFILE_PATH)
@@ -24,7 +38,10 @@ class MistralAPIClient:
         self,
         model: str = API_ENDPOINT_NAME,
         temperature: float = TEMPERATURE,
-        api_key:Optional[str]=None
+        api_key:Optional[str]=None,
+        endpoint: str = API_BASE_URL,
+        frame_interval_seconds: float = STREAM_FRAME_INTERVAL_SECONDS,
+        frame_max_chars: int = STREAM_FRAME_MAX_CHARS
         ):
         """Initialize the MistralAPIClient members and methogs
 
@@ -34,12 +51,38 @@ class MistralAPIClient:
             temperature (float, optional): Temperature to use for response 
                                            generation. Defaults to TEMPERATURE.
             api_key (str, optional): API Key for LLM endpoint. Defaults to None.
+            endpoint (str, optional): Base URL of the mistral API. Defaults to API_BASE_URL.
+            frame_interval_seconds (float, optional): Minimum time between the streamed frames. Tokens arriving in between
+                                                      are coalesced. Defaults to STREAM_FRAME_INTERVAL_SECONDS.
+            frame_max_chars (int, optional): Characters which sends a streamed frame before the interval. Defaults to STREAM_FRAME_MAX_CHARS.
         """
         
         self.model_name = model #Mistral model to use for generating response via API client.
+        self.endpoint = endpoint #Base URL of the API. Can point at the fake server for performance tests.
         self.client = self._get_client(api_key) #get mistral llm api client.
+        
+        #Async client lives on its own event loop so that its pooled keep-alive connections are reused by every request.
+        self._event_loop = BackgroundEventLoop()
+        self.async_client = self._event_loop.run(self._get_async_client(api_key))
+        self._event_loop.submit(self._warmup_async_client())
+        
+        #Applies the deadline, hedging and retries on every call to the streaming endpoint.
+        self.stream_caller = HedgedStreamCaller(retryable_exceptions=(MistralConnectionException, ConnectionError))
         self.temperature = temperature # set temperature to control variance in the output.
-        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME) #Load Mistral tokenizer.
+        self.tokenizer = get_api_tokenizer(MODEL_NAME) #Load Mistral tokenizer. Pre-serialized tokenizer is used if available.
+        self.fact_retriever = get_fact_retriever() #Picks the facts of the bio relevant to each query.
+        self.prompt_memo = PromptMemo() #Prompt messages of the chat history memoized across the turns.
+        self.conversation_store = ConversationStore() #Conversations of the UI sessions. A request takes only the turn added to its history.
+        
+        #Counts the responses cut at the stop strings.
+        self.stop_stats = StopSequenceStats(backend="api")
+        self.frame_interval_seconds = frame_interval_seconds
+        self.frame_max_chars = frame_max_chars
+        
+        #Responses are deterministic only at temperature 0 and so only those are cached.
+        self.response_cache = ResponseCache(
+            model_id=self.model_name, instruction_template=self.fact_retriever.prompt_signature
+        ) if temperature == 0 else None
         
         #Set comet project name and API key for logging the prompts and responses.
         try:
@@ -74,7 +117,36 @@ class MistralAPIClient:
             except:
                 raise ValueError("Either pass the mistral API key while instantiating this class or set 'MISTRAL_API_KEY' environment variable.")
 
-        return MistralClient(api_key=api_key) # return a inintialized mistral client.
+        return MistralClient(api_key=api_key, endpoint=self.endpoint) # return a inintialized mistral client.
+    
+    
+    async def _get_async_client(
+        self,
+        api_key:Optional[str]=None
+        )->MistralAsyncClient:
+        """Instantiate a async MistralClient by passing the mistral API key. Must be run on the client's event loop.
+
+        Args:
+            api_key (Optional[str], optional): API Key for Mistral LLM Client. Defaults to None.
+
+        Returns:
+            MistralAsyncClient: Returns a initialized async mistral API client.
+        """
+        
+        if api_key is None:
+            api_key = os.environ['MISTRAL_API_KEY']
+        
+        return MistralAsyncClient(api_key=api_key, endpoint=self.endpoint, max_concurrent_requests=MAX_CONCURRENT_API_REQUESTS)
+    
+    
+    async def _warmup_async_client(self):
+        """Open a connection to the endpoint at startup, so that the first request doesn't pay for the connection setup."""
+        
+        try:
+            await self.async_client.list_models()
+            logger.info("Warmed up the connection of async API client")
+        except Exception:
+            logger.exception("Failed to warm up the connection of async API client")
 
     
     def _get_templated_query(
@@ -87,10 +159,30 @@ class MistralAPIClient:
         return f"""<<<\nQUESTION: {question} >>>.\n\n\n\n\n"""
 
 
+    def _get_history_pair(
+        self,
+        index: int,
+        past_question: str,
+        response_text: str
+        ) -> List[ChatMessage]:
+        """Convert a past (query, response) pair of the chat history into prompt messages."""
+        
+        #Attach the persona instructions as a prefix to the query template for first question alone to add general instructions.
+        #Else add only the question in the template format.
+        if not index:
+            prompt = self.fact_retriever.instructions + self._get_templated_query(past_question)
+        else:
+            prompt = self._get_templated_query(past_question)
+        
+        #Add the answer generated by LLM for the query after the query.
+        return [ChatMessage(role='user',content=prompt), ChatMessage(role='assistant',content=response_text)]
+
+
     def _get_inference_prompt(
         self,
         question:str,
-        chat_history:List[Tuple[str,str]]
+        chat_history:List[Tuple[str,str]],
+        session_id:Optional[str]=None
         ) -> List[ChatMessage]:
         
         """Convert the given query and past chat history into a prompt as per mistral's prompt template.
@@ -98,6 +190,8 @@ class MistralAPIClient:
         Args:
             question (str): Query for which the response has to be generated.
             chat_history (List): List containing the query & responses as a list of tuples.
+            session_id (str, optional): Id of the UI session. The session's conversation is kept by the conversation 
+                                        store and only the turn added to the chat history is taken. Defaults to None.
 
         Returns:
             List: List containing the chats as prompt messages as per mistral template.
@@ -105,106 +199,316 @@ class MistralAPIClient:
         
         logger.info(f"Preparing prompt for response generation")
         
-        messages = []
-        
-        #Iterate through the question & answer pair from the past chat history
-        for index,(past_question, response_text) in enumerate(chat_history):
+        with get_metrics().time_stage("prompt_building"):
+            #The session's conversation holds the history as interned pairs along with its rolling hash for the memo.
+            history_keys = None
+            conversation = self.conversation_store.sync(session_id, chat_history) if session_id is not None else None
+            if conversation is not None:
+                chat_history, history_keys = conversation.turns, conversation.history_keys
+            
+            #Template and trim only the pairs added to the history since its previous turn.
+            messages = self.prompt_memo.get_history_messages(chat_history, self._get_history_pair, self.tokenizer, history_keys)
+            
+            #Only the facts of the bio relevant to the current query are attached, right before it, so that the
+            #earlier messages stay the same across turns. The previous query helps with the follow up queries.
+            previous_question = chat_history[-1][0] if chat_history else None
+            facts_prompt = self.fact_retriever.get_facts_prompt(question, previous_question)
             
-            #Attach the instruction_template as a prefix to the query template for first question alone to add general instructions.
-            #Else add only the question in the template format.
-            if not index:
-                prompt = INSTRUCTION_TEMPLATE + self._get_templated_query(past_question)
+            #Add the current query to the messages list in the prompt format.
+            #Attach persona instructions as prefix to the query if current query is the first query.
+            if not messages:
+                prompt = self.fact_retriever.instructions + facts_prompt + self._get_templated_query(question)
                 messages.append(ChatMessage(role='user',content=prompt))
             else:
-                prompt = self._get_templated_query(past_question)
+                prompt = facts_prompt + self._get_templated_query(question)
                 messages.append(ChatMessage(role='user',content=prompt))
-                
-            #Add the answer generated by LLM for the query to the message list.
-            messages.append(ChatMessage(role='assistant',content=response_text))
-            messages = filter_old_messages(messages, self.tokenizer)
-        
-        #Add the current query to the messages list in the prompt format.
-        #Attach instruction template as prefix to the query if current query is the first query.
-        if not messages:
-            prompt = INSTRUCTION_TEMPLATE + self._get_templated_query(question)
-            messages.append(ChatMessage(role='user',content=prompt))
-        else:
-            prompt = self._get_templated_query(question)
-            messages.append(ChatMessage(role='user',content=prompt))
 
         return messages
     
     
-    def _log_prompt_data(
+    def _get_prompt_log_data(
         self,
         question: str,
         response: str,
         messages: List,
         chat_history: str,
-        time_taken: float
-        ):
-        
-        """Helper function which uses the comet_llm logger to log all the data and metadata related to the prompt."""
+        time_taken: float,
+        usage: Optional[Dict[str,int]] = None
+        )->Dict[str,Union[str,int]]:
         
-        logger.info(f"Logging the prompt data onto comet-ml")
+        """Helper function which prepares all the data and metadata related to the prompt for the comet_llm logger.
+           Runs on the background prompt logger's thread. Token counts reported by the API are used when available
+           and the prompt is tokenized only as a fallback."""
         
-        #Convert the messages into prompt tokens for counting.
-        prompt_tokenids = self.tokenizer.apply_chat_template(messages)
+        #Render the messages into prompt text. Only the chat template is applied, nothing is tokenized.
+        prompt_text = self.tokenizer.apply_chat_template(messages, tokenize=False)
         
-        num_prompt_tokens = len(prompt_tokenids) #Get total prompt tokens
-        num_response_tokens = len(self.tokenizer(response)) #Get total response tokens
-        total_tokens = num_prompt_tokens + num_response_tokens #Get total number of tokens
+        if usage is None:
+            logger.info(f"Token usage is not reported by the API. Counting the tokens with the tokenizer")
+            usage = get_token_usage(
+                len(self.tokenizer.apply_chat_template(messages)),
+                len(self.tokenizer(response, add_special_tokens=False).input_ids),
+            )
         
         #Prepare a dictionary using all the necassary data & metadata related to the prompt.
         log_dict = {"project":self.comet_project_name,
                     "model": self.model_name,
-                    "prompt":self.tokenizer.decode(prompt_tokenids),
+                    "prompt":prompt_text,
                     "prompt_template_variables":{'question':question, 'chat_history':chat_history},
-                    "prompt_tokens": num_prompt_tokens,
-                    "total_tokens": total_tokens,
-                    "actual_new_tokens": num_response_tokens,
+                    **usage,
                     "duration": time_taken,
                     "output": response}
         
-        #log the dictionary onto comet-ml dashboard.
-        log_prompt(log_dict)
+        return log_dict
     
 
     def stream_answer(
         self,
         question: str,
-        chat_history: List[Tuple[str, str]]
+        chat_history: List[Tuple[str, str]],
+        stream_mode: str = STREAM_MODE,
+        profile: bool = False,
+        session_id: Optional[str] = None
         )->Iterator[str]:
-        """_summary_
+        """Generate the response to the query and stream it after post-processing. The tokens are coalesced into frames.
 
         Args:
             question (str): A query provided by the user.
             chat_history (list): Past conversation history as a list of (query, response) tuple pairs.
+            stream_mode (str, optional): 'cumulative' yields the whole response so far and 'delta' yields only the
+                                         new text of each frame. Defaults to STREAM_MODE.
+            profile (bool, optional): Profile this request with the sampling profiler. Requests are also picked
+                                      for profiling as per PROFILE_EVERY_N_REQUESTS. Defaults to False.
+            session_id (str, optional): Id of the UI session whose conversation is kept by the conversation store. Defaults to None.
 
         Yields:
             Iterator[str]: A iterator object containing response text as chunks.
         """
         
-        #Convert the query and past chats into a prompt message list
-        messages = self._get_inference_prompt(question, chat_history)
+        metrics = get_metrics()
+        with metrics.time_stage("stream_answer"), metrics.track_stream() as tracker, self._profile_request(profile):
+            #Convert the query and past chats into a prompt message list
+            messages = self._get_inference_prompt(question, chat_history, session_id)
+            
+            #Stream the cached response if the same query was answered before for the same history.
+            cache_key, cached_response = self._lookup_response_cache(question, messages)
+            if cached_response is not None:
+                deltas = self._stream_cached_response(cached_response, tracker)
+            else:
+                deltas = self._stream_deltas(question, messages, chat_history, cache_key, tracker)
+            
+            yield from iter_response_frames(deltas, self._create_framer(stream_mode))
+    
+    
+    async def astream_answer(
+        self,
+        question: str,
+        chat_history: List[Tuple[str, str]],
+        stream_mode: str = STREAM_MODE,
+        profile: bool = False,
+        session_id: Optional[str] = None
+        )->AsyncIterator[str]:
+        """Async version of stream_answer built on the async mistral client. Doesn't hold a thread while 
+           waiting for the remote stream, so a large number of requests can be streamed concurrently.
+
+        Args:
+            question (str): A query provided by the user.
+            chat_history (list): Past conversation history as a list of (query, response) tuple pairs.
+            stream_mode (str, optional): 'cumulative' yields the whole response so far and 'delta' yields only the
+                                         new text of each frame. Defaults to STREAM_MODE.
+            profile (bool, optional): Profile this request with the sampling profiler. Defaults to False.
+            session_id (str, optional): Id of the UI session whose conversation is kept by the conversation store. Defaults to None.
+
+        Yields:
+            AsyncIterator[str]: A async iterator object containing response text as chunks.
+        """
+        
+        metrics = get_metrics()
+        with metrics.time_stage("stream_answer"), metrics.track_stream() as tracker, self._profile_request(profile) as request_profile:
+            #Convert the query and past chats into a prompt message list. 
+            #Tokenization for trimming the history is run on a thread to not block the event loop.
+            messages = await asyncio.to_thread(run_profiled(request_profile, self._get_inference_prompt), question, chat_history, session_id)
+            
+            #Stream the cached response if the same query was answered before for the same history.
+            cache_key, cached_response = self._lookup_response_cache(question, messages)
+            if cached_response is not None:
+                for frame in iter_response_frames(self._stream_cached_response(cached_response, tracker), self._create_framer(stream_mode)):
+                    yield frame
+                return
+            
+            deltas = self._astream_deltas(question, messages, chat_history, cache_key, tracker)
+            async for frame in aiter_response_frames(deltas, self._create_framer(stream_mode)):
+                yield frame
+    
+    
+    def _profile_request(self, profile: bool):
+        """Profile the request if picked for profiling. The async client's event loop thread which runs 
+           the mistral client is sampled along with the request's thread. The event loop thread is shared by
+           every concurrent stream, so its samples include the work of the other requests streamed meanwhile."""
+        
+        return profile_request("api_stream_answer", force=profile, background_thread_prefixes=(self._event_loop.name,))
+    
+    
+    def _create_framer(self, stream_mode: str)->ResponseFramer:
+        """Create the framer which post-processes and coalesces the deltas of a single response."""
+        
+        return ResponseFramer(stream_mode, self.frame_interval_seconds, self.frame_max_chars)
+    
+    
+    def _stream_deltas(
+        self,
+        question: str,
+        messages: List[ChatMessage],
+        chat_history: List[Tuple[str, str]],
+        cache_key: Optional[str],
+        tracker: StreamTracker
+        )->Iterator[str]:
+        """Stream the new text of the response generated via the API. The response is completed once streamed."""
         
-        response = '' 
         start = time.time()
         logger.info(f"Calling the API Client for response generation")
         
-        #Get response to the prompt via mistral chat completion endpoint.
-        stream_response = self.client.chat_stream(model=self.model_name, messages=messages, temperature=self.temperature)
+        with get_metrics().time_stage("generation"):
+            #Get response to the prompt via mistral chat completion endpoint.
+            stream_response = self._event_loop.iterate(lambda: self._chat_stream(messages))
+            
+            #Iterate though each generated token in streaming mode and pass the new text onto the user.
+            #The stream is closed at a stop string, which cancels the rest of the generation.
+            usage = None
+            stop_matcher = StopStringMatcher()
+            for chunk in stream_response:
+                self._track_chunk(chunk, tracker)
+                usage = self._get_stream_usage(chunk) or usage
+                yield stop_matcher.update(chunk.choices[0].delta.content)
+                if stop_matcher.is_stopped:
+                    break
+            stream_response.close()
+        yield stop_matcher.flush()
         
-        #Iterate though each generated token in streaming mode
-        #Post-process it and pass the response to the user.
-        for chunk in stream_response:
-            text = chunk.choices[0].delta.content
-            response += text
-            yield post_process_output(response)
+        response = self._get_stopped_response(stop_matcher)
+        self._complete_response(question, response, messages, chat_history, time.time() - start, cache_key, usage)
+    
+    
+    async def _astream_deltas(
+        self,
+        question: str,
+        messages: List[ChatMessage],
+        chat_history: List[Tuple[str, str]],
+        cache_key: Optional[str],
+        tracker: StreamTracker
+        )->AsyncIterator[str]:
+        """Async version of _stream_deltas."""
+        
+        start = time.time()
+        logger.info(f"Calling the async API Client for response generation")
+        
+        with get_metrics().time_stage("generation"):
+            #Get response to the prompt via mistral chat completion endpoint on the client's event loop.
+            stream_response = self._event_loop.relay(lambda: self._chat_stream(messages))
             
-        response_time = time.time() - start
+            #Iterate though each generated token in streaming mode and pass the new text onto the user.
+            #The stream is closed at a stop string, which cancels the rest of the generation.
+            usage = None
+            stop_matcher = StopStringMatcher()
+            async for chunk in stream_response:
+                self._track_chunk(chunk, tracker)
+                usage = self._get_stream_usage(chunk) or usage
+                yield stop_matcher.update(chunk.choices[0].delta.content)
+                if stop_matcher.is_stopped:
+                    break
+            await stream_response.aclose()
+        yield stop_matcher.flush()
+        
+        response = self._get_stopped_response(stop_matcher)
+        self._complete_response(question, response, messages, chat_history, time.time() - start, cache_key, usage)
+    
+    
+    def _chat_stream(self, messages: List[ChatMessage])->AsyncIterator:
+        """Stream the chat completion chunks from the endpoint with deadline, hedging and retries.
+           Must be consumed on the client's event loop."""
+        
+        return self.stream_caller.stream(
+            lambda: self.async_client.chat_stream(model=self.model_name, messages=messages, temperature=self.temperature)
+        )
+    
+    
+    def _track_chunk(self, chunk, tracker: StreamTracker):
+        """Record the arrival of a stream chunk. Each chunk with content carries a single generated token."""
+        
+        if chunk.choices[0].delta.content:
+            tracker.on_token()
+            get_metrics().record_tokens(1)
+    
+    
+    def _get_stopped_response(self, stop_matcher: StopStringMatcher)->str:
+        """The complete response of the stream. Counts the hit if it was cut at a stop string."""
+        
+        if stop_matcher.is_stopped:
+            logger.info(f"Response stopped at the stop string {stop_matcher.stop_string!r}")
+            self.stop_stats.record(stop_matcher.stop_string)
+            logger.info(f"Stop string hits: {self.stop_stats.stats()['hits']}")
+        
+        return stop_matcher.text
+    
+    
+    def _get_stream_usage(self, chunk)->Optional[Dict[str,int]]:
+        """Token usage reported by the API on a stream chunk. Only the last chunk of the stream carries it."""
+        
+        if getattr(chunk, "usage", None) is None:
+            return None
+        
+        return get_token_usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+    
+    
+    def _lookup_response_cache(
+        self,
+        question: str,
+        messages: List[ChatMessage]
+        )->Tuple[Optional[str], Optional[str]]:
+        """Look up the response cache for the prompt messages.
+
+        Returns:
+            Tuple[Optional[str], Optional[str]]: The cache key and the cached response. Both are None if caching is disabled.
+        """
+        
+        if self.response_cache is None:
+            return None, None
+        
+        cache_key = self.response_cache.make_key(question, [message.content for message in messages[:-1]])
+        
+        return cache_key, self.response_cache.get(cache_key)
+    
+    
+    def _stream_cached_response(self, cached_response: str, tracker: StreamTracker)->Iterator[str]:
+        """Stream the cached response in chunks just like a generated response."""
+        
+        logger.info(f"Streaming the cached response")
+        
+        for chunk in iter_response_chunks(cached_response):
+            tracker.on_token()
+            yield chunk
+    
+    
+    def _complete_response(
+        self,
+        question: str,
+        response: str,
+        messages: List[ChatMessage],
+        chat_history: List[Tuple[str, str]],
+        response_time: float,
+        cache_key: Optional[str],
+        usage: Optional[Dict[str,int]] = None
+        ):
+        """Cache the generated response and log the prompt data once the response is completely streamed."""
+        
         logger.info(f"Response generation Completed..")
         
-        #Log the prompt details onto comet-ml dashboard. Run it as thread so that it don't have to wait till the logging is over.
-        logging_thread = threading.Thread(target=self._log_prompt_data, args=(question, response, messages, chat_history, response_time))
-        logging_thread.start() 
\ No newline at end of file
+        if cache_key is not None:
+            self.response_cache.put(cache_key, response)
+        
+        #Log the prompt details onto comet-ml dashboard via the background logger so that the response doesn't have to wait till the logging is over.
+        #The log data is prepared on the logger's thread as well.
+        logger.info(f"Queueing the prompt data for logging onto comet-ml")
+        get_prompt_logger().submit(
+            functools.partial(self._get_prompt_log_data, question, response, messages, chat_history, response_time, usage)
+        ) 
\ No newline at end of file
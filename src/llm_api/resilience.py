@@ -0,0 +1,223 @@
+import random
+import asyncio
+import threading
+from typing import AsyncIterator, Callable, Dict, Tuple, Type, TypeVar
+
+from src.constants import *
+from src.utils import create_logger
+from src.metrics import get_metrics
+
+logger = create_logger(LOGFILE_PATH)
+
+T = TypeVar("T")
+
+_END_OF_STREAM = object()
+
+
+class DeadlineExceededError(TimeoutError):
+    """Raised when a request doesn't complete within its deadline."""
+
+
+class FirstTokenTimeoutError(TimeoutError):
+    """Raised when a stream doesn't yield its first item within the first token timeout."""
+
+
+async def _next_item(stream: AsyncIterator[T]):
+    """Get the next item of the stream or _END_OF_STREAM. StopAsyncIteration can't be raised through an asyncio task."""
+
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return _END_OF_STREAM
+
+
+async def _discard(task: asyncio.Task, stream: AsyncIterator[T]):
+    """Cancel the pending read of a stream and close the stream."""
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    try:
+        await stream.aclose()
+    except Exception:
+        pass
+
+
+class HedgedStreamCaller:
+    """
+    Calls a streaming endpoint with a per-request deadline, a hedged duplicate request when the first item
+    is not received within the first token timeout, and bounded retries with jitter for the connection errors
+    that happen before any output has been sent. Once the first item has been yielded the stream is never
+    retried, since the output can't be taken back.
+
+    Args:
+        deadline_seconds (float, optional): Time within which the whole stream should complete. Defaults to API_REQUEST_DEADLINE_SECONDS.
+        first_token_timeout_seconds (float, optional): Time to wait for the first item before hedging. Defaults to API_FIRST_TOKEN_TIMEOUT_SECONDS.
+        hedge (bool, optional): Whether to send a hedged duplicate request on first token timeout. The request is
+                                retried instead if False. Defaults to API_HEDGE_REQUESTS.
+        max_retries (int, optional): Maximum number of retries before any output is sent. Defaults to API_MAX_RETRIES.
+        retry_backoff_seconds (float, optional): Base delay of the exponential backoff between the retries. Defaults to API_RETRY_BACKOFF_SECONDS.
+        retryable_exceptions (Tuple[Type[Exception]], optional): Errors which are retried. Defaults to (ConnectionError,).
+    """
+
+    def __init__(
+        self,
+        deadline_seconds: float = API_REQUEST_DEADLINE_SECONDS,
+        first_token_timeout_seconds: float = API_FIRST_TOKEN_TIMEOUT_SECONDS,
+        hedge: bool = API_HEDGE_REQUESTS,
+        max_retries: int = API_MAX_RETRIES,
+        retry_backoff_seconds: float = API_RETRY_BACKOFF_SECONDS,
+        retryable_exceptions: Tuple[Type[Exception], ...] = (ConnectionError,),
+    ):
+        self.deadline_seconds = deadline_seconds
+        self.first_token_timeout_seconds = first_token_timeout_seconds
+        self.hedge = hedge
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.retryable_exceptions = tuple(retryable_exceptions) + (FirstTokenTimeoutError,)
+
+        self._metrics = {
+            "requests": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "first_token_timeouts": 0,
+            "deadline_exceeded": 0,
+            "failures": 0,
+        }
+        self._lock = threading.Lock()
+
+
+    def _count(self, metric: str):
+        """Count the event and export it on the /metrics endpoint as diya_api_stream_events_total."""
+
+        with self._lock:
+            self._metrics[metric] += 1
+        get_metrics().api_stream_events.inc(1, metric)
+
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the counters of the requests, retries, hedges and timeouts."""
+
+        with self._lock:
+            return dict(self._metrics)
+
+
+    def _remaining(self, deadline: float) -> float:
+        return deadline - asyncio.get_running_loop().time()
+
+
+    async def _first_item(self, stream_factory: Callable[[], AsyncIterator[T]], deadline: float):
+        """Open the stream and wait for its first item. Opens a hedged duplicate stream if the first item
+           takes longer than the first token timeout and uses whichever stream yields first.
+
+        Returns:
+            Tuple[AsyncIterator[T], T]: The winning stream and its first item.
+        """
+
+        primary_stream = stream_factory()
+        primary_task = asyncio.ensure_future(_next_item(primary_stream))
+        pending = {primary_task: primary_stream}
+
+        done, _ = await asyncio.wait(
+            [primary_task], timeout=max(0.0, min(self.first_token_timeout_seconds, self._remaining(deadline)))
+        )
+
+        if not done:
+            self._count("first_token_timeouts")
+
+            if not self.hedge or self._remaining(deadline) <= 0:
+                await _discard(primary_task, primary_stream)
+                raise FirstTokenTimeoutError(f"No response within {self.first_token_timeout_seconds} seconds")
+
+            logger.info("First token timed out. Sending a hedged request")
+            self._count("hedges")
+            hedge_stream = stream_factory()
+            pending[asyncio.ensure_future(_next_item(hedge_stream))] = hedge_stream
+
+        errors = []
+        try:
+            while pending:
+                remaining = self._remaining(deadline)
+                if remaining <= 0:
+                    raise DeadlineExceededError(f"Request didn't complete within {self.deadline_seconds} seconds")
+
+                done, _ = await asyncio.wait(list(pending), timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    stream = pending.pop(task)
+
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                        await _discard(task, stream)
+                        continue
+
+                    #First stream to yield wins. The other stream is cancelled in finally.
+                    if stream is not primary_stream:
+                        self._count("hedge_wins")
+
+                    return stream, task.result()
+        finally:
+            for task, stream in pending.items():
+                await _discard(task, stream)
+
+        raise errors[0]
+
+
+    async def stream(self, stream_factory: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """Stream the items from the endpoint with deadline, hedging and retries.
+
+        Args:
+            stream_factory (Callable[[], AsyncIterator[T]]): Opens a new stream to the endpoint on every call.
+
+        Yields:
+            AsyncIterator[T]: Items of the stream.
+        """
+
+        self._count("requests")
+        deadline = asyncio.get_running_loop().time() + self.deadline_seconds
+
+        attempt = 0
+        while True:
+            try:
+                stream, item = await self._first_item(stream_factory, deadline)
+                break
+            except DeadlineExceededError:
+                self._count("deadline_exceeded")
+                self._count("failures")
+                raise
+            except self.retryable_exceptions as error:
+                remaining = self._remaining(deadline)
+                if attempt >= self.max_retries or remaining <= 0:
+                    self._count("failures")
+                    raise
+
+                #Exponential backoff with full jitter so that the retries of concurrent requests don't align.
+                delay = min(random.uniform(0, self.retry_backoff_seconds * 2**attempt), remaining)
+                logger.warning(f"Retrying the request in {delay:.2f} seconds after error: {error!r}")
+                self._count("retries")
+                attempt += 1
+
+                await asyncio.sleep(delay)
+
+        try:
+            while item is not _END_OF_STREAM:
+                yield item
+
+                remaining = self._remaining(deadline)
+                if remaining <= 0:
+                    raise DeadlineExceededError(f"Request didn't complete within {self.deadline_seconds} seconds")
+
+                try:
+                    item = await asyncio.wait_for(_next_item(stream), timeout=remaining)
+                except asyncio.TimeoutError:
+                    raise DeadlineExceededError(f"Request didn't complete within {self.deadline_seconds} seconds")
+        except DeadlineExceededError:
+            self._count("deadline_exceeded")
+            self._count("failures")
+            raise
+        finally:
+            try:
+                await stream.aclose()
+            except Exception:
+                pass
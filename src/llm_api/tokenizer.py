@@ -0,0 +1,118 @@
+import os
+from typing import Any, List, Union
+
+from src.constants import *
+from src.utils import create_logger
+
+logger = create_logger(LOGFILE_PATH)
+
+
+class TokenizerOutput:
+    """Token ids of a text, in the same attribute as the output of a huggingface tokenizer."""
+
+    def __init__(self, input_ids: List[int]):
+        self.input_ids = input_ids
+
+
+class MistralChatTokenizer:
+    """
+    Lightweight tokenizer for counting the prompt tokens of the mistral chat models. Loads a pre-serialized fast
+    tokenizer (tokenizer.json) via the `tokenizers` package and applies mistral's instruct chat template, so that
+    neither transformers nor torch has to be imported by the API client.
+
+    Only the parts of the huggingface tokenizer's interface used by the API client are provided.
+
+    Args:
+        tokenizer_path (str, optional): Path of the tokenizer.json file. Defaults to TOKENIZER_PATH.
+    """
+
+    bos_token = "<s>"
+    eos_token = "</s>"
+
+    def __init__(self, tokenizer_path: str = TOKENIZER_PATH):
+        from tokenizers import Tokenizer
+
+        self._tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.bos_token_id = self._tokenizer.token_to_id(self.bos_token)
+        self.eos_token_id = self._tokenizer.token_to_id(self.eos_token)
+
+
+    def __call__(self, text: str, add_special_tokens: bool = True) -> TokenizerOutput:
+        """Tokenize the text into token ids."""
+
+        return TokenizerOutput(self._tokenizer.encode(text, add_special_tokens=add_special_tokens).ids)
+
+
+    def apply_chat_template(self, messages: List[Any], tokenize: bool = True) -> Union[str, List[int]]:
+        """Convert the messages into the prompt text or its token ids as per mistral's instruct chat template.
+
+        Args:
+            messages (List[Any]): Messages as dictionaries or objects with role and content.
+            tokenize (bool, optional): Whether to return the token ids instead of the text. Defaults to True.
+
+        Returns:
+            Union[str, List[int]]: The prompt text or its token ids.
+        """
+
+        prompt = self.bos_token
+        for index, message in enumerate(messages):
+            role, content = _get_role_and_content(message)
+
+            if (role == "user") != (index % 2 == 0):
+                raise ValueError("Conversation roles must alternate user/assistant/user/assistant/...")
+
+            if role == "user":
+                prompt += f"[INST] {content} [/INST]"
+            elif role == "assistant":
+                prompt += content + self.eos_token
+            else:
+                raise ValueError("Only user and assistant roles are supported!")
+
+        if not tokenize:
+            return prompt
+
+        return self._tokenizer.encode(prompt, add_special_tokens=False).ids
+
+
+def _get_role_and_content(message: Any):
+    if isinstance(message, dict):
+        return message["role"], message["content"]
+
+    return message.role, message.content
+
+
+def get_api_tokenizer(model_name: str = MODEL_NAME, tokenizer_path: str = TOKENIZER_PATH):
+    """Load the tokenizer for counting the prompt tokens. The pre-serialized tokenizer shipped with the image is
+       preferred, the huggingface tokenizer is loaded only if it is not available.
+
+    Args:
+        model_name (str, optional): Huggingface name of the model whose tokenizer is loaded. Defaults to MODEL_NAME.
+        tokenizer_path (str, optional): Path of the pre-serialized tokenizer.json file. Defaults to TOKENIZER_PATH.
+
+    Returns:
+        Union[MistralChatTokenizer, AutoTokenizer]: The loaded tokenizer.
+    """
+
+    if os.path.exists(tokenizer_path):
+        return MistralChatTokenizer(tokenizer_path)
+
+    logger.warning(f"{tokenizer_path} not found. Loading the huggingface tokenizer of {model_name} instead")
+
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_name)
+
+
+def export_tokenizer(model_name: str = MODEL_NAME, tokenizer_path: str = TOKENIZER_PATH):
+    """Serialize the fast tokenizer of the model onto tokenizer_path. Run once while building the image."""
+
+    from transformers import AutoTokenizer
+
+    os.makedirs(os.path.dirname(tokenizer_path) or ".", exist_ok=True)
+    AutoTokenizer.from_pretrained(model_name).backend_tokenizer.save(tokenizer_path)
+
+    logger.info(f"Saved the tokenizer of {model_name} onto {tokenizer_path}")
+
+
+if __name__ == "__main__":
+    export_tokenizer()
@@ -1,23 +1,28 @@
 import warnings
 warnings.filterwarnings("ignore")
 
+import uuid
 import gradio as gr
 from typing import List
-from threading import Thread
 
+from src.constants import GRADIO_CONCURRENCY_COUNT, METRICS_PORT, METRICS_HOST
+from src.metrics import start_metrics_server
+from src.profiler import is_profile_requested
 from .chatbot import LangChainChatBot
 
 #Instantiate a llm chatbot client
 bot = LangChainChatBot()
 
 
-def predict(message: str, history: List[List[str]], about_me: str):
+def predict(message: str, history: List[List[str]], session_id: str, request: gr.Request):
     """
     Predicts a response to a given query using the LLM Client.
 
     Args:
         message (str): The query provdided by the user for response generation.
         history (List[List[str]]): A list of previous conversations.
+        session_id (str): Id of the browser session. The server keeps the session's conversation and takes only its new turn.
+        request (gr.Request): The HTTP request. The request is profiled if its PROFILE_REQUEST_HEADER is set to 1.
         
     Returns:
         str: The response generated by the model.
@@ -26,18 +31,17 @@ def predict(message: str, history: List[List[str]], about_me: str):
     kwargs = {
         "question": message,
         "chat_history": history,
+        "session_id": session_id,
+        "profile": is_profile_requested(request),
     }
     
     #If bot has streaming mode enabled then get the reponse to the query in streaming mode. 
-    #Else use normal mode.
+    #Else use normal mode. Each request has its own stream and runs on the bot's bounded pool of workers.
     if bot.is_streaming:
-        t = Thread(target=bot.answer, kwargs=kwargs)
-        t.start()
-
-        for partial_answer in bot.stream_answer():
+        for partial_answer in bot.stream(**kwargs):
             yield partial_answer
     else:
-        yield bot.answer(**kwargs)
+        yield bot.submit_answer(**kwargs).result()
 
 
 ############## === Gradio chat Interface ===
@@ -66,6 +70,7 @@ demo = gr.ChatInterface(
             "What does Aakash loves to do in his free time?"
         ]
     ],
+    additional_inputs=[gr.State(lambda: uuid.uuid4().hex)], #A new session id on every page load.
     cache_examples=False,
     retry_btn=None,
     undo_btn=None,
@@ -74,4 +79,5 @@ demo = gr.ChatInterface(
 
 
 if __name__ == "__main__":
-    demo.queue(api_open=False).launch(server_name="0.0.0.0", server_port=7860, share=False, show_api=False) #Launch the web app UI.
\ No newline at end of file
+    start_metrics_server(METRICS_PORT, METRICS_HOST) #Serve the prometheus metrics at /metrics next to the web app, if the port is free.
+    demo.queue(api_open=False, concurrency_count=GRADIO_CONCURRENCY_COUNT).launch(server_name="0.0.0.0", server_port=7860, share=False, show_api=False) #Launch the web app UI.
\ No newline at end of file
@@ -0,0 +1,230 @@
+"""Pre-quantized model artifacts for the local LLM.
+
+Quantizing the full precision checkpoint on every boot takes minutes and needs far more memory than the quantized
+model. The conversion is instead done once by this module, which saves the quantized weights as safetensors shards
+along with the config and a manifest onto a local artifact directory. get_model loads the weights from there
+memory-mapped, as long as the manifest's fingerprint matches the model, the quantization config and the dtype
+and the files match the manifest. The files are matched by thier size and modification time on every boot and
+by thier checksum only when opted in or when a file's modification time has changed.
+
+Usage:
+    python -m src.local_llm.artifacts --model-name mistralai/Mistral-7B-Instruct-v0.2 --artifact-dir artifacts/model
+"""
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from importlib import metadata
+from typing import Dict, Optional
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, BitsAndBytesConfig
+
+from src.constants import *
+from src.utils import create_logger
+
+logger = create_logger(LOGFILE_PATH)
+
+ARTIFACT_MANIFEST_NAME = "artifact_manifest.json"
+
+
+def get_quantization_config(device: str = DEVICE) -> Optional[BitsAndBytesConfig]:
+    """bnb 4-bit quantization config used for the model. bitsandbytes needs a GPU, so the model is not quantized on cpu."""
+
+    if device == "cpu":
+        return None
+
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_use_double_quant=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=getattr(torch, QUANTIZED_MODEL_DTYPE),
+    )
+
+
+def get_artifact_dtype(quantization_config: Optional[BitsAndBytesConfig]) -> torch.dtype:
+    """dtype of the modules which aren't quantized, Eg: the embeddings and the norms. Both the artifact and the model
+       quantized while loading use it, so that both produce the same outputs. The model is saved in full precision on cpu."""
+
+    return getattr(torch, QUANTIZED_MODEL_DTYPE) if quantization_config is not None else torch.float32
+
+
+def get_file_checksum(file_path: str, chunk_size: int = 16 * 1024**2) -> str:
+    """Returns the sha256 hex digest of the file's content."""
+
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def get_file_stat(file_path: str) -> Dict[str, int]:
+    """Size and modification time of the file, matched on every boot instead of its checksum."""
+
+    file_stat = os.stat(file_path)
+
+    return {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+
+
+def get_artifact_fingerprint(model_name: str, quantization_config: Optional[BitsAndBytesConfig]) -> str:
+    """Fingerprint of the inputs of the conversion. An artifact converted from a different checkpoint config,
+       quantization config, dtype or library version doesn't match the fingerprint and is treated as stale."""
+
+    fingerprint = {
+        "model_name": model_name,
+        "source_config": AutoConfig.from_pretrained(model_name).to_dict(),
+        "quantization_config": quantization_config.to_dict() if quantization_config is not None else None,
+        "torch_dtype": str(get_artifact_dtype(quantization_config)),
+        "transformers": metadata.version("transformers"),
+        "bitsandbytes": metadata.version("bitsandbytes") if quantization_config is not None else None,
+    }
+
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def save_model_artifact(
+    model_name: str = MODEL_NAME,
+    artifact_dir: str = MODEL_ARTIFACT_DIR,
+    device: str = DEVICE,
+    max_shard_size: str = "2GB",
+) -> Dict:
+    """Quantize the model and save it as a memory-mappable artifact. The artifact is written onto a temporary directory
+       and moved in place only once complete, so that a partially written artifact is never loaded.
+
+    Args:
+        model_name (str, optional): Huggingface name or path of the full precision model. Defaults to MODEL_NAME.
+        artifact_dir (str, optional): Directory to save the artifact onto. Defaults to MODEL_ARTIFACT_DIR.
+        device (str, optional): Device to quantize the model on. Defaults to DEVICE.
+        max_shard_size (str, optional): Maximum size of a safetensors shard. Defaults to "2GB".
+
+    Returns:
+        Dict: The manifest of the saved artifact.
+    """
+
+    quantization_config = get_quantization_config(device)
+
+    logger.info(f"Quantizing {model_name} for the artifact at {artifact_dir}")
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        quantization_config=quantization_config,
+        torch_dtype=get_artifact_dtype(quantization_config),
+        device_map=device,
+    )
+
+    temp_dir = f"{artifact_dir.rstrip(os.sep)}.tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    model.save_pretrained(temp_dir, safe_serialization=True, max_shard_size=max_shard_size)
+
+    manifest = {
+        "model_name": model_name,
+        "fingerprint": get_artifact_fingerprint(model_name, quantization_config),
+        "files": {
+            file_name: {
+                "sha256": get_file_checksum(os.path.join(temp_dir, file_name)),
+                **get_file_stat(os.path.join(temp_dir, file_name)),
+            }
+            for file_name in sorted(os.listdir(temp_dir))
+        },
+    }
+    with open(os.path.join(temp_dir, ARTIFACT_MANIFEST_NAME), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    shutil.rmtree(artifact_dir, ignore_errors=True)
+    os.replace(temp_dir, artifact_dir)
+
+    logger.info(f"Saved the model artifact of {model_name} at {artifact_dir}")
+
+    return manifest
+
+
+def is_model_artifact_valid(
+    artifact_dir: str,
+    model_name: str,
+    quantization_config: Optional[BitsAndBytesConfig],
+    verify_checksums: bool = MODEL_ARTIFACT_VERIFY_CHECKSUMS,
+) -> bool:
+    """Check whether the artifact exists and is up to date with the model and the quantization config. The files
+       are matched by thier size and modification time. The checksum of a file is verified only if opted in or if
+       its modification time has changed, Eg: after the artifact is copied onto another machine.
+
+    Args:
+        artifact_dir (str): Directory of the artifact.
+        model_name (str): Huggingface name or path of the full precision model.
+        quantization_config (Optional[BitsAndBytesConfig]): Quantization config the model is expected to be quantized with.
+        verify_checksums (bool, optional): Whether to verify the checksums of all the artifact's files. Defaults to MODEL_ARTIFACT_VERIFY_CHECKSUMS.
+
+    Returns:
+        bool: True if the artifact can be loaded.
+    """
+
+    manifest_path = os.path.join(artifact_dir, ARTIFACT_MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return False
+
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if manifest.get("model_name") != model_name:
+        logger.warning(f"Model artifact at {artifact_dir} is of {manifest.get('model_name')} and not of {model_name}.")
+        return False
+
+    try:
+        fingerprint = get_artifact_fingerprint(model_name, quantization_config)
+    except OSError:
+        #Source checkpoint's config is not available offline. The artifact is used as such since it is of the same model.
+        logger.warning(f"Couldn't load the config of {model_name} to check the staleness of the model artifact.")
+        fingerprint = manifest.get("fingerprint")
+
+    if manifest.get("fingerprint") != fingerprint:
+        logger.warning(f"Model artifact at {artifact_dir} is stale. Re-run the conversion to update it.")
+        return False
+
+    is_manifest_updated = False
+    for file_name, expected in manifest["files"].items():
+        file_path = os.path.join(artifact_dir, file_name)
+        if not os.path.exists(file_path):
+            logger.warning(f"Model artifact at {artifact_dir} is incomplete. {file_name} is missing.")
+            return False
+
+        #Manifests of the older artifacts only have the checksums.
+        expected = expected if isinstance(expected, dict) else {"sha256": expected}
+        file_stat = get_file_stat(file_path)
+
+        if "size" in expected and file_stat["size"] != expected["size"]:
+            logger.warning(f"Model artifact at {artifact_dir} is corrupted. {file_name} doesn't match its size.")
+            return False
+
+        if verify_checksums or file_stat["mtime_ns"] != expected.get("mtime_ns"):
+            if get_file_checksum(file_path) != expected["sha256"]:
+                logger.warning(f"Model artifact at {artifact_dir} is corrupted. {file_name} doesn't match its checksum.")
+                return False
+
+            #Record the verified file's stat, so that the checksum isn't computed again on the next boot.
+            manifest["files"][file_name] = {"sha256": expected["sha256"], **file_stat}
+            is_manifest_updated = True
+
+    if is_manifest_updated:
+        try:
+            with open(manifest_path, "w") as manifest_file:
+                json.dump(manifest, manifest_file, indent=2)
+        except OSError:
+            logger.warning(f"Couldn't update the manifest of the model artifact at {artifact_dir}. Its checksums are verified again on the next boot.")
+
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-name", default=MODEL_NAME)
+    parser.add_argument("--artifact-dir", default=MODEL_ARTIFACT_DIR)
+    parser.add_argument("--device", default=DEVICE)
+    args = parser.parse_args()
+
+    save_model_artifact(model_name=args.model_name, artifact_dir=args.artifact_dir, device=args.device)
+
+
+if __name__ == "__main__":
+    main()
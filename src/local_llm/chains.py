@@ -1,17 +1,37 @@
 import time
-from typing import Any, Dict, List, Optional, Union
+import hashlib
+import functools
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import torch
 
 from langchain import chains
 from langchain.callbacks.manager import CallbackManagerForChainRun
 from langchain.chains.base import Chain
-from langchain.llms import HuggingFacePipeline
-
-from src.constants import INSTRUCTION_TEMPLATE, MODEL_NAME, LOGFILE_PATH
+from langchain.memory import ChatMessageHistory
+from transformers import AutoTokenizer, TextIteratorStreamer
+
+from src.constants import MODEL_NAME, LOGFILE_PATH
+from src.facts import FactRetriever, get_fact_retriever, format_facts
+from src.prompt_memo import PromptMemo
+from src.conversation_store import Conversation
+from src.response_cache import ResponseCache, iter_response_chunks
+from src.metrics import get_metrics
 from src.utils import parse_chat_history_as_tuples, filter_old_messages, convert_chat_history_as_string, create_logger
 from .model import get_tokenizer
+from .engine import GenerationEngine
+from .prompt_encoder import PromptEncoder, PROMPT_PLACEHOLDER
 
 logger = create_logger(LOGFILE_PATH)
 
+
+@functools.lru_cache(maxsize=None)
+def get_prompt_encoder(model_name: str = MODEL_NAME) -> PromptEncoder:
+    """Load the tokenizer of the LLM as a prompt encoder. The tokenizer is loaded once on the first call instead of 
+       while importing the module."""
+    
+    return PromptEncoder(get_tokenizer(model_name))
+
 class StatelessMemorySequentialChain(chains.SequentialChain):
     """
     A sequential chain that uses a stateless memory to store context between calls.
@@ -26,19 +46,30 @@ class StatelessMemorySequentialChain(chains.SequentialChain):
         """
         Override _call to load history before calling the chain.
 
-        This method loads the history from the input dictionary and saves it to the
-        stateless memory. It then updates the inputs dictionary with the memory values
+        This method loads the history from the input dictionary and saves it to a copy of the
+        stateless memory which is private to the call. A Conversation of the conversation store is passed on as the 
+        chat history without the memory. It then updates the inputs dictionary with the memory values
         and removes the history input key. Finally, it calls the parent _call method
         with the updated inputs and returns the results.
         """
 
         to_load_history = inputs[self.history_input_key]
+        
+        #The conversation held by the conversation store is passed on as such, without copying it onto messages.
+        if isinstance(to_load_history, Conversation):
+            inputs[self.memory.memory_key] = to_load_history
+            del inputs[self.history_input_key]
+            return super()._call(inputs, **kwargs)
+        
+        #Load the history onto a memory of its own, so that the concurrent calls doesn't mix up thier histories.
+        memory = self.memory.copy(update={"chat_memory": ChatMessageHistory()})
+        
         for human,ai in to_load_history:
-            self.memory.save_context(
-                inputs={self.memory.input_key: human},
-                outputs={self.memory.output_key: ai},
+            memory.save_context(
+                inputs={memory.input_key: human},
+                outputs={memory.output_key: ai},
             )
-        memory_values = self.memory.load_memory_variables({})
+        memory_values = memory.load_memory_variables({})
         inputs.update(memory_values)
 
         del inputs[self.history_input_key]
@@ -72,8 +103,27 @@ class StatelessMemorySequentialChain(chains.SequentialChain):
 class LLMChain(Chain):
     """This custom chain handles LLM generation upon given prompt"""
 
-    hf_pipeline: HuggingFacePipeline
-    tokenizer = get_tokenizer(MODEL_NAME)   
+    llm_engine: GenerationEngine
+    response_cache: Optional[ResponseCache] = None
+    prompt_memo: Optional[PromptMemo] = None
+    
+    @property
+    def prompt_encoder(self) -> PromptEncoder:
+        """Encoder building the prompt token ids. Loaded on the first use and shared by every chain."""
+        
+        return get_prompt_encoder(MODEL_NAME)
+    
+    @property
+    def fact_retriever(self) -> FactRetriever:
+        """Picks the facts of the bio relevant to each query. Shared by every chain."""
+        
+        return get_fact_retriever()
+    
+    @property
+    def tokenizer(self) -> AutoTokenizer:
+        """Tokenizer of the LLM"""
+        
+        return self.prompt_encoder.tokenizer
     
     @property
     def input_keys(self) -> List[str]:
@@ -102,18 +152,40 @@ class LLMChain(Chain):
             }
         )
         
+        #Stream the cached response if the same query was answered before for the same history.
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = self.response_cache.make_key(
+                inputs["question"], [message["content"] for message in prompt["messages"][:-1]]
+            )
+            cached_response = self.response_cache.get(cache_key)
+            
+            if cached_response is not None:
+                logger.info(f"Streaming the cached response")
+                self._stream_cached_response(cached_response, inputs.get("streamer"))
+                return {"answer": cached_response}
+        
         logger.info(f"Preparing response for the prompt")
 
         start_time = time.time()
-        response = self.hf_pipeline(prompt["prompt"]) #Generate response to the prompt
+        with get_metrics().time_stage("generation"):
+            response, usage = self.llm_engine.generate(
+                prompt["input_ids"],
+                session_key=self._get_session_key(inputs),
+                streamer=inputs.get("streamer"),
+            ) #Generate response to the prompt
         end_time = time.time()
         
-        #Prepare metadata for logging the prompt
+        if cache_key is not None:
+            self.response_cache.put(cache_key, response)
+        
+        #Prepare metadata for logging the prompt. Token counts come from the generation's own token ids.
         duration_milliseconds = (end_time - start_time) * 1000
-        num_prompt_tokens = len(self.tokenizer(prompt["prompt"]))
-        num_response_tokens = len(self.tokenizer(response))
-        total_tokens = num_prompt_tokens + num_response_tokens
-        prompt['payload']['chat_history'] = convert_chat_history_as_string(prompt['payload']['chat_history'])
+        chat_history = prompt['payload']['chat_history']
+        if isinstance(chat_history, Conversation):
+            prompt['payload']['chat_history'] = chat_history.as_string()
+        else:
+            prompt['payload']['chat_history'] = convert_chat_history_as_string(chat_history)
 
         #Log the prompt, response and prepared metadata
         #onto comet-ml dashboard using initialized logging callback handler. 
@@ -128,9 +200,7 @@ class LLMChain(Chain):
                 metadata={
                     "prompt": prompt["prompt"],
                     "prompt_template_variables": prompt["payload"],
-                    "prompt_tokens": num_prompt_tokens,
-                    "total_tokens": total_tokens,
-                    "actual_new_tokens": num_response_tokens,
+                    **usage,
                     "duration": duration_milliseconds,
                 },
             )
@@ -138,6 +208,56 @@ class LLMChain(Chain):
         return {"answer": response}
     
     
+    def _stream_cached_response(
+        self,
+        response: str,
+        streamer: Optional[TextIteratorStreamer]
+        ):
+        """Push the cached response to the request's streamer in chunks just like the generated tokens."""
+        
+        if streamer is None:
+            return
+        
+        for text in iter_response_chunks(response):
+            streamer.on_finalized_text(text)
+        streamer.end()
+    
+    
+    def _get_session_key(self, inputs: Dict[str, Any]) -> Optional[str]:
+        """Key identifying the conversation across its turns. The id of the UI session is used when passed.
+           Otherwise the first (query, response) pair of the conversation is used, since it is never trimmed 
+           from the history and stays same on every turn. The first query alone isn't used as the conversations
+           opening with the same question, Eg: the example queries, would share the key.
+
+        Returns:
+            Optional[str]: The key. None for the first turn of a conversation without a session id.
+        """
+        
+        if inputs.get("session_id") is not None:
+            return f"session:{inputs['session_id']}"
+        
+        chat_history = inputs["chat_history"]
+        if isinstance(chat_history, Conversation):
+            first_pair = chat_history.turns[0] if len(chat_history) else None
+        else:
+            first_pair = (chat_history[0].content, chat_history[1].content) if len(chat_history) > 1 else None
+        
+        if first_pair is None:
+            return None
+        
+        return hashlib.sha256(f"{first_pair[0].strip()}\0{first_pair[1].strip()}".encode("utf-8")).hexdigest()
+    
+    
+    def get_prefix_probe_prompts(self) -> List[torch.LongTensor]:
+        """Prompt token ids prepared for two different first queries. The common leading part of these 
+           prompts is static for every request and so its past key values can be reused."""
+        
+        return [
+            self._get_inference_prompt({"question": question, "chat_history": []})["input_ids"]
+            for question in ("Hi", "Who")
+        ]
+    
+    
     def _get_templated_query(
         self,
         question:str
@@ -148,56 +268,125 @@ class LLMChain(Chain):
         return f"""<<<\nQUESTION: {question} >>>.\n\n\n\n\n"""
     
     
+    def get_prompt_probe_conversations(self) -> List[List[Dict[str, str]]]:
+        """Prompt messages built for placeholder queries and responses, for a first query and a follow up query,
+           with and without the facts of the bio. Every part of these prompts other than the placeholders is same 
+           for every request and each fact is a segment of its own."""
+        
+        pair = (PROMPT_PLACEHOLDER, PROMPT_PLACEHOLDER)
+        all_facts = format_facts(self.fact_retriever.facts)
+        
+        return [
+            self._get_prompt_messages(PROMPT_PLACEHOLDER, []),
+            self._get_prompt_messages(PROMPT_PLACEHOLDER, [pair, pair]),
+            self._get_prompt_messages(PROMPT_PLACEHOLDER, [], facts_prompt=all_facts),
+            self._get_prompt_messages(PROMPT_PLACEHOLDER, [pair, pair], facts_prompt=all_facts),
+        ]
+    
+    
+    def build_prompt_encoder(self):
+        """Pre-tokenize the fixed parts of the prompt, so that the prompts are built as token ids directly."""
+        
+        self.prompt_encoder.build(self.get_prompt_probe_conversations())
+    
+    
+    def _get_history_pair(
+        self,
+        index: int,
+        past_question: str,
+        response_text: str
+        ) -> List[Dict[str, str]]:
+        """Convert a past (query, response) pair of the chat history into prompt messages."""
+        
+        #Attach the persona instructions as a prefix to the query template for first question alone to add general instructions.
+        #Else add only the question in the template format.
+        if not index:
+            prompt = self.fact_retriever.instructions + self._get_templated_query(past_question)
+        else:
+            prompt = self._get_templated_query(past_question)
+        
+        #Add the answer generated by LLM for the query after the query.
+        return [{"role": "user", "content": prompt}, {"role": "assistant", "content": response_text}]
+    
+    
+    def _get_prompt_messages(
+        self,
+        current_query: str,
+        chat_history: List[Tuple[str, str]],
+        facts_prompt: Optional[str] = None,
+        history_keys: Optional[Tuple[bytes, bytes]] = None
+        ) -> List[Dict[str, str]]:
+        """Convert the given query and past (query, response) pairs into prompt messages after trimming the history.
+           The facts of the bio relevant to the current query are attached right before it.
+
+        Args:
+            current_query (str): Query for which the response has to be generated.
+            chat_history (List[Tuple[str, str]]): Past conversation as (query, response) pairs.
+            facts_prompt (str, optional): Bio section with the facts to attach. Retrieved for the current query if None. Defaults to None.
+            history_keys (Tuple[bytes, bytes], optional): Rolling hash of the history for the prompt memo if already known. Defaults to None.
+        """
+        
+        if self.prompt_memo is not None:
+            #Template and trim only the pairs added to the history since its previous turn.
+            messages = self.prompt_memo.get_history_messages(chat_history, self._get_history_pair, self.tokenizer, history_keys)
+        else:
+            messages = [
+                message
+                for index, (past_question, response_text) in enumerate(chat_history)
+                for message in self._get_history_pair(index, past_question, response_text)
+            ]
+            
+            #Filter out the old conversations from the history if the prompt exceeds the token limit.
+            messages = filter_old_messages(messages, self.tokenizer)
+        
+        #The previous query helps with the follow up queries.
+        if facts_prompt is None:
+            previous_query = chat_history[-1][0] if chat_history else None
+            facts_prompt = self.fact_retriever.get_facts_prompt(current_query, previous_query)
+        
+        #Add the current query to the messages list in the prompt format.
+        #Attach persona instructions as prefix to the query if current query is the first query.
+        if not messages:
+            prompt = self.fact_retriever.instructions + facts_prompt + self._get_templated_query(current_query)
+            messages.append({"role": "user", "content": prompt})
+        else:
+            prompt = facts_prompt + self._get_templated_query(current_query)
+            messages.append({"role": "user", "content": prompt})
+        
+        return messages
+    
+    
     def _get_inference_prompt(
         self,
         sample: Dict[str, str]
-        ) -> Dict[str, Union[str, Dict]]:
+        ) -> Dict[str, Union[str, Dict, List, torch.LongTensor]]:
         """Convert the given query and past chat history into a prompt as per mistral's prompt template.
 
         Args:
             sample (Dict[str, str]): A Dict containing query and chat_history as key-value pairs.
 
         Returns:
-            Dict[str, Union[str, Dict]]: A Dictionary containing the prepared prompt text and the 
-                                         input sample used to create the prompt.
+            Dict[str, Union[str, Dict, List, torch.LongTensor]]: A Dictionary containing the prepared prompt text, its token ids, 
+                                                                the input sample used to create the prompt and the prompt messages.
         """
         
         logger.info(f"Preparing prompt for response generation")
         
-        current_query = sample['question']
-        
-        #Convert a chat history list into tuples of (query, response) pair
-        chat_history = parse_chat_history_as_tuples(sample['chat_history'])
-        
-        messages = []
-        
-        #Iterate through the question & answer pair from the past chat history
-        for index,(past_question, response_text) in enumerate(chat_history):
-            
-            #Attach the instruction_template as a prefix to the query template for first question alone to add general instructions.
-            #Else add only the question in the template format.
-            if not index:
-                prompt = INSTRUCTION_TEMPLATE + self._get_templated_query(past_question)
-                messages.append({"role": "user", "content": prompt})
+        metrics = get_metrics()
+        with metrics.time_stage("prompt_building"):
+            #Convert a chat history list into tuples of (query, response) pair.
+            #The conversation store already holds them as pairs along with the rolling hash of the history.
+            conversation = sample['chat_history'] if isinstance(sample['chat_history'], Conversation) else None
+            if conversation is not None:
+                chat_history, history_keys, segments = conversation.turns, conversation.history_keys, conversation.segments
             else:
-                prompt = self._get_templated_query(past_question)
-                messages.append({"role": "user", "content": prompt})
-
-            #Add the answer generated by LLM for the query to the message list.
-            messages.append({"role": "assistant", "content": response_text})
-            messages = filter_old_messages(messages, self.tokenizer)
-        
-        #Add the current query to the messages list in the prompt format.
-        #Attach instruction template as prefix to the query if current query is the first query.
-        if not messages:
-            prompt = INSTRUCTION_TEMPLATE + self._get_templated_query(current_query)
-            messages.append({"role": "user", "content": prompt})
-        else:
-            prompt = self._get_templated_query(current_query)
-            messages.append({"role": "user", "content": prompt})
+                chat_history, history_keys, segments = parse_chat_history_as_tuples(sample['chat_history']), None, None
+            
+            messages = self._get_prompt_messages(sample['question'], chat_history, history_keys=history_keys)
 
-        #Conver the message template into prompt text.
-        model_inputs = self.tokenizer.apply_chat_template(messages, return_tensors="pt")[0]
-        prompt = self.tokenizer.decode(model_inputs)
+            #Build the prompt token ids from the pre-tokenized fixed parts and the prompt text for logging.
+            #Segments of the conversation tokenized on its earlier turns aren't tokenized again.
+            with metrics.time_stage("tokenization"):
+                prompt, input_ids = self.prompt_encoder.encode(messages, segments)
 
-        return {"prompt": prompt, "payload": sample}
\ No newline at end of file
+        return {"prompt": prompt, "input_ids": input_ids, "payload": sample, "messages": messages}
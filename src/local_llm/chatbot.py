@@ -1,12 +1,22 @@
 import os
-from typing import List, Tuple, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Tuple, Iterable, Optional
 
 from langchain import chains
 from langchain.callbacks import FileCallbackHandler
 from langchain.memory import ConversationBufferMemory
+from transformers import TextIteratorStreamer
 
 from src.constants import *
-from src.utils import create_logger, post_process_output
+from src.utils import create_logger
+from src.stop_sequences import StopStringMatcher
+from src.streaming import ResponseFramer, iter_response_frames
+from src.response_cache import ResponseCache
+from src.metrics import get_metrics, StreamTracker
+from src.profiler import profile_request
+from src.facts import get_fact_retriever
+from src.prompt_memo import PromptMemo
+from src.conversation_store import ConversationStore
 from .model import build_pipeline
 from .chains import LLMChain, StatelessMemorySequentialChain
 from .handlers import CometLLMMonitoringHandler
@@ -23,6 +33,14 @@ class LangChainChatBot:
         llm_inference_max_new_tokens (int, optional): The maximum number of new tokens to generate during inference. Defaults to MAX_NEW_TOKENS.
         llm_inference_temperature (float, optional): The temperature to use during inference. Defaults to TEMPERATURE.
         streaming (bool, optional): Whether to use the Hugging Face streaming API for inference. Defaults to streaming.
+        generation_workers (int, optional): Maximum number of requests processed concurrently. Defaults to GENERATION_WORKERS.
+        cpu_quantization (str, optional): 'int8' for dynamic quantization when the device is cpu or None. Defaults to CPU_QUANTIZATION.
+        cpu_num_threads (int, optional): Number of intra-op threads when the device is cpu. Defaults to CPU_NUM_THREADS.
+        draft_model_name (str, optional): Small model used as the draft model for speculative decoding. Disabled if None. Defaults to DRAFT_MODEL_NAME.
+        prompt_lookup_num_tokens (int, optional): Tokens proposed per step by prompt lookup decoding. Disabled if None. Defaults to PROMPT_LOOKUP_NUM_TOKENS.
+        frame_interval_seconds (float, optional): Minimum time between the streamed frames. Tokens generated in between
+                                                  are coalesced. Defaults to STREAM_FRAME_INTERVAL_SECONDS.
+        frame_max_chars (int, optional): Characters which sends a streamed frame before the interval. Defaults to STREAM_FRAME_MAX_CHARS.
         
     Attributes:
         bot_chain (Chain): The language chain that generates responses to user inputs.
@@ -35,25 +53,46 @@ class LangChainChatBot:
         llm_inference_max_new_tokens: int = MAX_NEW_TOKENS,
         llm_inference_temperature: float = TEMPERATURE,
         streaming: bool = True,
+        generation_workers: int = GENERATION_WORKERS,
+        cpu_quantization: Optional[str] = CPU_QUANTIZATION,
+        cpu_num_threads: Optional[int] = CPU_NUM_THREADS,
+        draft_model_name: Optional[str] = DRAFT_MODEL_NAME,
+        prompt_lookup_num_tokens: Optional[int] = PROMPT_LOOKUP_NUM_TOKENS,
+        frame_interval_seconds: float = STREAM_FRAME_INTERVAL_SECONDS,
+        frame_max_chars: int = STREAM_FRAME_MAX_CHARS,
     ):
         self._llm_model_id = llm_model_id
         self._llm_inference_max_new_tokens = llm_inference_max_new_tokens
         self._llm_inference_temperature = llm_inference_temperature
         self._device = device
+        self._frame_interval_seconds = frame_interval_seconds
+        self._frame_max_chars = frame_max_chars
 
         logger.info("Building a huggingface inference pipeline")
-        self._llm_agent, self._streamer, self._eos_token = build_pipeline(
+        self._llm_agent, self._eos_token = build_pipeline(
             model_name=self._llm_model_id,
             device=self._device,
             gradient_checkpointing=False,
-            use_streamer=streaming
+            use_streamer=streaming,
+            cpu_quantization=cpu_quantization,
+            cpu_num_threads=cpu_num_threads,
+            draft_model_name=draft_model_name,
+            prompt_lookup_num_tokens=prompt_lookup_num_tokens,
         )
         self.bot_chain = self.build_chain() #Build the chabot chain
         
+        #Conversations of the UI sessions, so that a request takes only the turn added to its history.
+        #The texts are stripped just like parse_chat_history_as_tuples does for the history passed as such.
+        self.conversation_store = ConversationStore(strip_texts=True)
+        
+        #Bounded pool of workers for running the chain. Requests beyond the limit waits in its queue.
+        self._executor = ThreadPoolExecutor(max_workers=generation_workers, thread_name_prefix="generation")
+        get_metrics().queue_depth.set(0, "generation_workers")
+        
         
     @property
     def is_streaming(self) -> bool:
-        return self._streamer is not None
+        return self._llm_agent.is_streaming
     
     
     def _get_comet_project_name(self) -> str:
@@ -95,11 +134,26 @@ class LangChainChatBot:
         ]
         
         #Instantiate a LLM chain for generating response.
+        #Responses are deterministic only at temperature 0 and so only those are cached.
+        self.response_cache = ResponseCache(
+            model_id=self._llm_model_id, instruction_template=get_fact_retriever().prompt_signature
+        ) if self._llm_inference_temperature == 0 else None
+        
         llm_generator_chain = LLMChain(
-            hf_pipeline=self._llm_agent,
+            llm_engine=self._llm_agent,
+            response_cache=self.response_cache,
+            prompt_memo=PromptMemo(),
             callbacks=callbacks,
         )
         
+        #Tokenize the fixed parts of the prompt once so that the prompts are built as token ids.
+        logger.info("Pre-tokenizing the fixed parts of the prompt")
+        llm_generator_chain.build_prompt_encoder()
+        
+        #Prefill the instruction template once so that it is not prefilled again for every request.
+        logger.info("Building the KV cache for the static prompt prefix")
+        self._llm_agent.build_prefix_cache(llm_generator_chain.get_prefix_probe_prompts())
+        
         logger.info("Building 2/2 - Connecting chains into SequentialChain")
         log_handler = FileCallbackHandler(LOGFILE_PATH)
         
@@ -111,7 +165,7 @@ class LangChainChatBot:
                 return_messages=True
             ),
             chains=[llm_generator_chain],
-            input_variables=["question", "to_load_history"],
+            input_variables=["question", "to_load_history", "streamer", "session_id"],
             output_variables=["answer"],
             verbose=True,
             callbacks=[log_handler]
@@ -126,6 +180,9 @@ class LangChainChatBot:
         self,
         question: str,
         chat_history: List[Tuple[str, str]] = None,
+        streamer: Optional[TextIteratorStreamer] = None,
+        profile: bool = False,
+        session_id: Optional[str] = None,
     ) -> str:
         """Given a question and past chat messages, generates a response
            to the current query using the initialized LLM Chain.
@@ -134,29 +191,148 @@ class LangChainChatBot:
             question (str): A question provided by the user.
             chat_history (List[Tuple[str, str]], optional): List containing the past conversation's
                          query & responses as a list of tuples. Defaults to None.
+            streamer (TextIteratorStreamer, optional): Streamer to push the tokens of this request to. Defaults to None.
+            profile (bool, optional): Profile this request with the sampling profiler. Requests are also picked
+                                      for profiling as per PROFILE_EVERY_N_REQUESTS. Defaults to False.
+            session_id (str, optional): Id of the UI session. The session's conversation is kept by the conversation
+                                        store and only the turn added to the chat history is taken. Defaults to None.
 
         Returns:
             str: A reponse generated for the query.
         """
 
+        chat_history = chat_history if chat_history else []
+        conversation = self.conversation_store.sync(session_id, chat_history) if session_id is not None else None
+        
         inputs = {
             "question": question,
-            "to_load_history": chat_history if chat_history else [],
+            "to_load_history": conversation if conversation is not None else chat_history,
+            "streamer": streamer,
+            "session_id": session_id,
         }
-        response = self.bot_chain.run(inputs) #Generate response using the llm chain.
+        
+        #Batched decoding runs on the scheduler's thread and so it is sampled along with the request's thread.
+        with profile_request("chatbot_answer", force=profile, background_thread_prefixes=("generation-scheduler",)):
+            response = self.bot_chain.run(inputs) #Generate response using the llm chain.
+        
+        #Account for the token ids of the conversation's segments added while building the prompt.
+        if conversation is not None:
+            self.conversation_store.update(conversation)
 
         return response
     
 
-    def stream_answer(self) -> Iterable[str]:
-        """Stream the answer from the LLM after each token is generated"""
+    def submit_answer(
+        self,
+        question: str,
+        chat_history: List[Tuple[str, str]] = None,
+        streamer: Optional[TextIteratorStreamer] = None,
+        profile: bool = False,
+        session_id: Optional[str] = None,
+    ) -> Future:
+        """Generate the response to the query on the bounded pool of workers.
+
+        Args:
+            question (str): A question provided by the user.
+            chat_history (List[Tuple[str, str]], optional): List containing the past conversation's
+                         query & responses as a list of tuples. Defaults to None.
+            streamer (TextIteratorStreamer, optional): Streamer to push the tokens of this request to. Defaults to None.
+            profile (bool, optional): Profile this request with the sampling profiler. Defaults to False.
+            session_id (str, optional): Id of the UI session whose conversation is kept by the conversation store. Defaults to None.
 
-        partial_answer = ""
+        Returns:
+            Future: A future which resolves to the generated response.
+        """
+        
+        get_metrics().queue_depth.inc(1, "generation_workers")
+        
+        return self._executor.submit(self._answer_and_end_stream, question, chat_history, streamer, profile, session_id)
+    
+    
+    def _answer_and_end_stream(
+        self,
+        question: str,
+        chat_history: List[Tuple[str, str]] = None,
+        streamer: Optional[TextIteratorStreamer] = None,
+        profile: bool = False,
+        session_id: Optional[str] = None,
+    ) -> str:
+        """Generate the response and end the stream if the generation fails, so that its reader doesn't wait forever."""
+        
+        get_metrics().queue_depth.dec(1, "generation_workers")
         
-        #Iterate through each streamed token,
-        #Return the token after post-processing untill eos-token is generated.
-        for new_token in self._streamer:
-            if new_token != self._eos_token:
-                partial_answer += new_token
+        try:
+            return self.answer(question, chat_history, streamer, profile, session_id)
+        except Exception:
+            if streamer is not None:
+                streamer.end()
+            raise
+    
+    
+    def stream(
+        self,
+        question: str,
+        chat_history: List[Tuple[str, str]] = None,
+        stream_mode: str = STREAM_MODE,
+        profile: bool = False,
+        session_id: Optional[str] = None,
+    ) -> Iterable[str]:
+        """Generate the response to the query with its own streamer and stream the answer as it is generated.
+
+        Args:
+            question (str): A question provided by the user.
+            chat_history (List[Tuple[str, str]], optional): List containing the past conversation's
+                         query & responses as a list of tuples. Defaults to None.
+            stream_mode (str, optional): 'cumulative' yields the whole answer so far and 'delta' yields only the
+                                         new text of each frame. Defaults to STREAM_MODE.
+            profile (bool, optional): Profile the generation of this request with the sampling profiler. Defaults to False.
+            session_id (str, optional): Id of the UI session whose conversation is kept by the conversation store. Defaults to None.
 
-                yield post_process_output(partial_answer)
\ No newline at end of file
+        Yields:
+            Iterable[str]: The post-processed frames of the answer.
+        """
+        
+        metrics = get_metrics()
+        with metrics.time_stage("stream_answer"), metrics.track_stream() as tracker:
+            streamer = self._llm_agent.create_streamer()
+            future = self.submit_answer(question, chat_history, streamer, profile, session_id)
+            
+            yield from self.stream_answer(streamer, stream_mode, tracker)
+            
+            future.result() #Raise the error if the generation has failed.
+    
+
+    def stream_answer(
+        self,
+        streamer: TextIteratorStreamer,
+        stream_mode: str = STREAM_MODE,
+        tracker: Optional[StreamTracker] = None,
+    ) -> Iterable[str]:
+        """Stream the answer from the LLM as it is generated. The tokens are post-processed incrementally
+           and coalesced into frames.
+
+        Args:
+            streamer (TextIteratorStreamer): Streamer of the request passed to answer. 
+            stream_mode (str, optional): 'cumulative' or 'delta'. Defaults to STREAM_MODE.
+            tracker (StreamTracker, optional): Records the token latencies of the stream. Defaults to None.
+        """
+
+        framer = ResponseFramer(stream_mode, self._frame_interval_seconds, self._frame_max_chars)
+        
+        yield from iter_response_frames(self._stream_deltas(streamer, tracker), framer)
+    
+    
+    def _stream_deltas(self, streamer: TextIteratorStreamer, tracker: Optional[StreamTracker] = None) -> Iterable[str]:
+        """Stream the new text of the answer untill eos-token or a stop string is generated. The tail which
+           may be the start of a stop string is held back untill the next token."""
+
+        stop_matcher = StopStringMatcher()
+        
+        #The streamer is still drained after a stop string so that the generation ends it.
+        for new_token in streamer:
+            if tracker is not None:
+                tracker.on_token()
+            if new_token != self._eos_token and not stop_matcher.is_stopped:
+                yield stop_matcher.update(new_token)
+        
+        yield stop_matcher.flush()
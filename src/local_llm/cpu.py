@@ -0,0 +1,82 @@
+from typing import Optional
+
+import torch
+from transformers import AutoModelForCausalLM
+
+from src.constants import *
+from src.utils import create_logger
+
+logger = create_logger(LOGFILE_PATH)
+
+
+def is_bf16_supported() -> bool:
+    """Whether the cpu has native bf16 instructions (Eg: AVX512-BF16 or AMX). bf16 is emulated and slower than fp32 otherwise."""
+
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def get_cpu_dtype(dtype: str = CPU_DTYPE) -> torch.dtype:
+    """Resolve the dtype of the model on cpu. 'auto' uses bf16 where the cpu supports it and fp32 otherwise.
+
+    Args:
+        dtype (str, optional): One of 'auto', 'bfloat16' or 'float32'. Defaults to CPU_DTYPE.
+
+    Returns:
+        torch.dtype: The dtype to load the model in.
+    """
+
+    if dtype == "auto":
+        return torch.bfloat16 if is_bf16_supported() else torch.float32
+
+    if dtype not in ("bfloat16", "float32"):
+        raise ValueError(f"Invalid cpu dtype {dtype}. Use one of 'auto', 'bfloat16' or 'float32'.")
+
+    return getattr(torch, dtype)
+
+
+def set_cpu_threads(num_threads: Optional[int] = CPU_NUM_THREADS):
+    """Set the number of intra-op threads used by torch on cpu. torch's default is used if None."""
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    logger.info(f"Using {torch.get_num_threads()} intra-op threads on cpu")
+
+
+def get_cpu_load_dtype(quantization: Optional[str] = CPU_QUANTIZATION, dtype: str = CPU_DTYPE) -> torch.dtype:
+    """dtype to load the model in on cpu. int8 dynamic quantization needs the model in fp32."""
+
+    if quantization is None:
+        return get_cpu_dtype(dtype)
+
+    if quantization != "int8":
+        raise ValueError(f"Invalid cpu quantization {quantization}. Use 'int8' or None.")
+
+    return torch.float32
+
+
+def prepare_cpu_model(
+    model: AutoModelForCausalLM,
+    quantization: Optional[str] = CPU_QUANTIZATION,
+) -> AutoModelForCausalLM:
+    """Prepare a model loaded on cpu for inference. With 'int8' the weights of the linear layers are quantized
+       to int8 and the activations are quantized dynamically on every forward pass.
+
+    Args:
+        model (AutoModelForCausalLM): Model loaded on cpu via get_cpu_load_dtype.
+        quantization (str, optional): 'int8' for dynamic quantization or None. Defaults to CPU_QUANTIZATION.
+
+    Returns:
+        AutoModelForCausalLM: The model ready for inference.
+    """
+
+    model.eval()
+
+    if quantization == "int8":
+        logger.info("Applying int8 dynamic quantization on the linear layers")
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    return model
@@ -0,0 +1,345 @@
+from typing import Dict, List, Optional, Tuple, Union
+
+import threading
+
+import torch
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
+
+from src.constants import *
+from src.utils import create_logger, get_token_usage
+from src.stop_sequences import StopSequenceStats, truncate_at_stop_string
+from src.metrics import get_metrics
+from .kv_cache import PrefixKVCache, SessionKVCache, get_common_prefix_length, to_dynamic_cache
+from .scheduler import GenerationScheduler, GenerationRequest
+from .stopping import StopSequenceCriteria, StopSequenceMatcher, get_stop_token_sequences
+from .speculative import SpeculativeDecodingStats
+
+logger = create_logger(LOGFILE_PATH)
+
+
+class GenerationEngine:
+    """
+    Generates response for a prompt text using a huggingface causal LM. Replaces the huggingface text-generation
+    pipeline so that the past key values of the static prompt prefix can be reused across the generations and
+    the past key values of each conversation can be retained between its turns. Concurrent generations are decoded
+    together by a continuous batching scheduler.
+
+    Args:
+        model (AutoModelForCausalLM): Model used for the generation.
+        tokenizer (AutoTokenizer): Tokenizer of the model.
+        model_name (str, optional): Name of the model. Defaults to MODEL_NAME.
+        max_new_tokens (int, optional): The maximum number of new tokens to generate. Defaults to MAX_NEW_TOKENS.
+        temperature (float, optional): The temperature to use during generation. Greedy decoding is used for 0. Defaults to TEMPERATURE.
+        use_streamer (bool, optional): Whether each request streams its generated tokens via its own text streamer. Defaults to False.
+        stop_ids (List[int], optional): Token ids which stops the generation of a request. Defaults to None.
+        stop_strings (List[str], optional): Strings which stops the generation of a request. They are matched as token id
+                                            sequences while generating and the response text is cut at them. Defaults to STOP_STRINGS.
+        session_cache (SessionKVCache, optional): Cache to retain the conversation's key values. A cache with the
+                                                  default memory budget is created if None. Defaults to None.
+        max_batch_size (int, optional): Maximum number of generations decoded together. Huggingface generate is
+                                        used one request at a time if 1. Defaults to MAX_BATCH_SIZE.
+        draft_model (AutoModelForCausalLM, optional): Small model sharing the tokenizer which proposes the tokens for
+                                                      speculative decoding. The proposed tokens are verified by the model
+                                                      in a single forward pass, so the greedy output stays the same.
+                                                      Requests are generated one at a time if provided. Defaults to None.
+        num_draft_tokens (int, optional): Number of tokens the draft model proposes in each step. Defaults to SPECULATIVE_NUM_DRAFT_TOKENS.
+        prompt_lookup_num_tokens (int, optional): Number of tokens proposed in each step by prompt lookup decoding, a draft
+                                                  free speculative decoding which copies the continuation of the latest
+                                                  n-gram's match in the prompt. Responses copy phrases from the bio in the
+                                                  instructions and so many of them are accepted. Requests are generated one
+                                                  at a time if provided. Disabled if None. Defaults to PROMPT_LOOKUP_NUM_TOKENS.
+        max_matching_ngram_size (int, optional): Longest n-gram matched against the prompt in prompt lookup decoding. 
+                                                 Defaults to PROMPT_LOOKUP_MAX_NGRAM_SIZE.
+    """
+
+    def __init__(
+        self,
+        model: AutoModelForCausalLM,
+        tokenizer: AutoTokenizer,
+        model_name: str = MODEL_NAME,
+        max_new_tokens: int = MAX_NEW_TOKENS,
+        temperature: float = TEMPERATURE,
+        use_streamer: bool = False,
+        stop_ids: Optional[List[int]] = None,
+        stop_strings: Optional[List[str]] = STOP_STRINGS,
+        session_cache: Optional[SessionKVCache] = None,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        draft_model: Optional[AutoModelForCausalLM] = None,
+        num_draft_tokens: int = SPECULATIVE_NUM_DRAFT_TOKENS,
+        prompt_lookup_num_tokens: Optional[int] = PROMPT_LOOKUP_NUM_TOKENS,
+        max_matching_ngram_size: int = PROMPT_LOOKUP_MAX_NGRAM_SIZE,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.is_streaming = use_streamer
+        self._stop_strings = stop_strings if stop_strings else []
+        self.stop_stats = StopSequenceStats()
+
+        #Stop ids and the token id sequences of the stop strings are matched together. Stop ids have no stop string.
+        stop_sequences = [(None, [stop_id]) for stop_id in (stop_ids if stop_ids else [])]
+        stop_sequences += get_stop_token_sequences(tokenizer, self._stop_strings)
+        self._stop_sequence_strings = [stop_string for stop_string, _ in stop_sequences]
+        self.stop_matcher = StopSequenceMatcher([ids for _, ids in stop_sequences]) if stop_sequences else None
+        self.prefix_cache = PrefixKVCache(model, model_name)
+        self.session_cache = session_cache if session_cache is not None else SessionKVCache()
+        self._cache_lock = threading.Lock() #Caches are shared by the concurrent generations.
+
+        if draft_model is not None and prompt_lookup_num_tokens is not None:
+            raise ValueError("Use either a draft model or prompt lookup decoding for speculative decoding, not both.")
+
+        #Huggingface's speculative decoding generates a single sequence at a time and so it is not batched.
+        is_speculative = draft_model is not None or prompt_lookup_num_tokens is not None
+        if is_speculative and max_batch_size > 1:
+            logger.info("Speculative decoding generates one request at a time. Disabling the batching scheduler")
+            max_batch_size = 1
+
+        self.scheduler = None
+        if max_batch_size > 1:
+            self.scheduler = GenerationScheduler(
+                model=model,
+                eos_token_id=tokenizer.eos_token_id,
+                max_batch_size=max_batch_size,
+                temperature=temperature,
+                stop_matcher=self.stop_matcher,
+            )
+            get_metrics().register_queue("generation_scheduler", lambda: self.scheduler.queue_depth)
+
+        self._max_new_tokens = max_new_tokens
+        self._generation_kwargs = {
+            "max_new_tokens": max_new_tokens,
+            "do_sample": temperature > 0,
+            "pad_token_id": tokenizer.pad_token_id,
+        }
+        if temperature > 0:
+            self._generation_kwargs["temperature"] = temperature
+
+        self.speculative_stats = None
+        if draft_model is not None:
+            #The default 'heuristic' schedule writes its adapted number of tokens back onto the draft model's
+            #generation config after every generation, which is shared by the concurrent requests. Keep it constant.
+            draft_model.generation_config.num_assistant_tokens = num_draft_tokens
+            draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+            self._generation_kwargs["assistant_model"] = draft_model
+            self.speculative_stats = SpeculativeDecodingStats(model, draft_model)
+        elif prompt_lookup_num_tokens is not None:
+            self._generation_kwargs["prompt_lookup_num_tokens"] = prompt_lookup_num_tokens
+            self._generation_kwargs["max_matching_ngram_size"] = max_matching_ngram_size
+            self.speculative_stats = SpeculativeDecodingStats(model)
+
+
+    def create_streamer(self) -> Optional[TextIteratorStreamer]:
+        """Create a text streamer for a single request. Returns None if streaming is not enabled."""
+
+        if not self.is_streaming:
+            return None
+
+        #Requests may wait in the queue before thier generation starts. So the streamer doesn't timeout,
+        #instead it is always ended by the generation even when it fails.
+        return TextIteratorStreamer(self.tokenizer, timeout=None, skip_prompt=True, skip_special_tokens=True)
+
+
+    def create_stopping_criteria(self, prompt_length: int) -> StoppingCriteriaList:
+        """Create the stopping criteria of huggingface generate for a single request with a prompt of prompt_length tokens."""
+
+        if self.stop_matcher is None:
+            return StoppingCriteriaList([])
+
+        return StoppingCriteriaList([StopSequenceCriteria(self.stop_matcher, prompt_length)])
+
+
+    def _record_stop_sequence(self, stop_sequence_index: Optional[int], num_new_tokens: int):
+        """Count the response stopped by a stop string along with the tokens it saved out of the maximum new tokens."""
+
+        if stop_sequence_index is None or stop_sequence_index < 0:
+            return
+
+        stop_string = self._stop_sequence_strings[stop_sequence_index]
+        if stop_string is None:
+            return
+
+        self.stop_stats.record(stop_string, saved_tokens=self._max_new_tokens - num_new_tokens)
+
+        stop_stats = self.stop_stats.stats()
+        logger.info(f"Stop string hits: {stop_stats['hits']}, Tokens saved: {stop_stats['saved_tokens']}")
+
+
+    def encode(self, prompt: Union[str, torch.LongTensor]) -> torch.LongTensor:
+        """Tokenize the prompt text into a 1D tensor of token ids. Prompts which are already token ids are used as such."""
+
+        if not isinstance(prompt, str):
+            return torch.as_tensor(prompt, dtype=torch.long)
+
+        return self.tokenizer(prompt, return_tensors="pt").input_ids[0]
+
+
+    def build_prefix_cache(self, probe_prompts: List[Union[str, torch.LongTensor]]):
+        """Prefill the static prefix shared by every prompt. The prefix is found as the common
+           leading tokens of prompts that differ only by their query.
+
+        Args:
+            probe_prompts (List[Union[str, torch.LongTensor]]): Atleast two prompt texts or token ids prepared for different queries.
+        """
+
+        probe_ids = [self.encode(prompt) for prompt in probe_prompts]
+
+        prefix_length = len(probe_ids[0])
+        for ids in probe_ids[1:]:
+            prefix_length = min(prefix_length, get_common_prefix_length(probe_ids[0], ids))
+
+        if prefix_length:
+            self.prefix_cache.build(probe_ids[0][:prefix_length])
+            
+        #A conversation's key values are worth reusing only if they cover more than the static prefix.
+        self.session_cache.min_reuse_tokens = self.prefix_cache.prefix_length + 1
+
+
+    def _get_past_key_values(self, input_ids: torch.LongTensor, session_key: Optional[str]):
+        """Get the past key values to start the generation with. The conversation's retained key values
+           are preferred over the static prefix's key values."""
+
+        past_key_values = None
+        if session_key is not None:
+            past_key_values = self.session_cache.lookup(session_key, input_ids, self.model.device)
+
+        if past_key_values is None:
+            past_key_values = self.prefix_cache.lookup(input_ids)
+
+        return past_key_values
+
+
+    @torch.no_grad()
+    def _generate(
+        self,
+        input_ids: torch.LongTensor,
+        past_key_values,
+        streamer: Optional[TextIteratorStreamer],
+        stopping_criteria: StoppingCriteriaList
+    ):
+        """Generate the response with huggingface generate for a single request.
+
+        Returns:
+            Tuple[torch.LongTensor, Optional[DynamicCache]]: A 1D tensor of the prompt and generated token ids and the key values of the sequence.
+        """
+
+        input_ids = input_ids.unsqueeze(0).to(self.model.device)
+
+        if self.speculative_stats is not None:
+            self.speculative_stats.start()
+
+        outputs = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            streamer=streamer,
+            stopping_criteria=stopping_criteria,
+            return_dict_in_generate=True,
+            **self._generation_kwargs,
+        )
+
+        if self.speculative_stats is not None:
+            self.speculative_stats.finish(outputs.sequences.shape[1] - input_ids.shape[1])
+
+        past_key_values = None if outputs.past_key_values is None else to_dynamic_cache(outputs.past_key_values)
+
+        return outputs.sequences[0], past_key_values
+
+
+    def __call__(
+        self,
+        prompt: Union[str, torch.LongTensor],
+        session_key: Optional[str] = None,
+        streamer: Optional[TextIteratorStreamer] = None
+    ) -> str:
+        """Generate a response for the given prompt.
+
+        Args:
+            prompt (Union[str, torch.LongTensor]): Prompt text or its token ids prepared as per the LLM's template.
+            session_key (str, optional): Key identifying the conversation. The key values of the conversation
+                                         are retained for its next turn if provided. Defaults to None.
+            streamer (TextIteratorStreamer, optional): Streamer of this request created via create_streamer. Defaults to None.
+
+        Returns:
+            str: The generated response text.
+        """
+
+        return self.generate(prompt, session_key=session_key, streamer=streamer)[0]
+
+
+    def generate(
+        self,
+        prompt: Union[str, torch.LongTensor],
+        session_key: Optional[str] = None,
+        streamer: Optional[TextIteratorStreamer] = None
+    ) -> Tuple[str, Dict[str, int]]:
+        """Generate a response for the given prompt along with its token usage. The usage is counted from the
+           token ids of the generation itself, so the prompt and the response are never tokenized again for it.
+
+        Args:
+            prompt (Union[str, torch.LongTensor]): Prompt text or its token ids prepared as per the LLM's template.
+            session_key (str, optional): Key identifying the conversation. The key values of the conversation
+                                         are retained for its next turn if provided. Defaults to None.
+            streamer (TextIteratorStreamer, optional): Streamer of this request created via create_streamer. Defaults to None.
+
+        Returns:
+            Tuple[str, Dict[str, int]]: The generated response text and the prompt, completion and total token counts.
+        """
+
+        input_ids = self.encode(prompt)
+        with self._cache_lock:
+            past_key_values = self._get_past_key_values(input_ids, session_key)
+
+        if self.scheduler is not None:
+            request = self.scheduler.submit(
+                GenerationRequest(
+                    input_ids=input_ids,
+                    past_key_values=past_key_values,
+                    streamer=streamer,
+                    max_new_tokens=self._max_new_tokens,
+                )
+            )
+            sequence_ids, past_key_values = request.wait(), request.past_key_values
+            stop_sequence_index = request.stop_sequence_index
+        else:
+            stopping_criteria = self.create_stopping_criteria(len(input_ids))
+            sequence_ids, past_key_values = self._generate(input_ids, past_key_values, streamer, stopping_criteria)
+            get_metrics().record_tokens(len(sequence_ids) - len(input_ids)) #Scheduler records its tokens at every step.
+            matched_sequences = stopping_criteria[0].matched_sequences if stopping_criteria else None
+            stop_sequence_index = int(matched_sequences[0]) if matched_sequences is not None else None
+
+        #Retain the key values of the prompt and the generated tokens for the next turn of the conversation.
+        #The last generated token is never fed to the model and so it doesn't have key values.
+        with self._cache_lock:
+            if session_key is not None and past_key_values is not None:
+                self.session_cache.put(session_key, sequence_ids[:past_key_values.get_seq_length()], past_key_values)
+
+            prefix_stats, session_stats = self.prefix_cache.stats(), self.session_cache.stats()
+
+        logger.info(
+            f"Prefix cache hit rate: {prefix_stats['hit_rate']:.2%}, Prefill time saved: {prefix_stats['saved_milliseconds']:.0f} ms. "
+            f"Session cache hit rate: {session_stats['hit_rate']:.2%}, Reused tokens: {session_stats['reused_tokens']}, "
+            f"Memory: {session_stats['bytes'] / 1024**2:.0f} MB"
+        )
+
+        if self.speculative_stats is not None:
+            speculative_stats = self.speculative_stats.stats()
+            acceptance_rate = speculative_stats.get("acceptance_rate")
+            logger.info(
+                f"Speculative decoding tokens per step: {speculative_stats['tokens_per_step']:.2f}, "
+                f"Accepted tokens per step: {speculative_stats['accepted_tokens_per_step']:.2f}"
+                + (f", Acceptance rate: {acceptance_rate:.2%}" if acceptance_rate is not None else "")
+            )
+
+        response_ids = sequence_ids[len(input_ids):]
+        usage = get_token_usage(len(input_ids), len(response_ids))
+
+        self._record_stop_sequence(stop_sequence_index, len(response_ids))
+
+        #The stop string and anything after it is not part of the response.
+        response, _ = truncate_at_stop_string(self.tokenizer.decode(response_ids, skip_special_tokens=True), self._stop_strings)
+
+        return response, usage
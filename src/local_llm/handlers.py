@@ -2,7 +2,7 @@ from langchain.callbacks.base import BaseCallbackHandler
 from typing import Dict, Any
 
 from src.constants import *
-from src.utils import log_prompt
+from src.prompt_logger import get_prompt_logger
 
 class CometLLMMonitoringHandler(BaseCallbackHandler):
     """
@@ -23,7 +23,8 @@ class CometLLMMonitoringHandler(BaseCallbackHandler):
 
     def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
         """
-        A callback function that logs the prompt and output to Comet.ml.
+        A callback function that queues the prompt and output to be logged to Comet.ml by the 
+        background prompt logger, so that the chain doesn't wait for the network call.
 
         Args:
             outputs (Dict[str, Any]): The output of the LLM model.
@@ -36,4 +37,4 @@ class CometLLMMonitoringHandler(BaseCallbackHandler):
         log_data_dict['output'] = outputs["answer"]
         log_data_dict['model'] = self._llm_model_id
         
-        log_prompt(log_data_dict)
\ No newline at end of file
+        get_prompt_logger().submit(log_data_dict)
\ No newline at end of file
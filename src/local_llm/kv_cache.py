@@ -0,0 +1,320 @@
+import copy
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Dict, Union, Tuple
+
+import torch
+from transformers import AutoModelForCausalLM, DynamicCache
+
+from src.constants import *
+from src.utils import create_logger
+
+logger = create_logger(LOGFILE_PATH)
+
+
+def get_token_fingerprint(model_name: str, token_ids: torch.LongTensor) -> str:
+    """Compute a fingerprint which uniquely identifies a token sequence for a given model.
+
+    Args:
+        model_name (str): Name of the model for which the token sequence is processed.
+        token_ids (torch.LongTensor): A 1D tensor of token ids.
+
+    Returns:
+        str: A sha256 hex digest of the model name and the token ids.
+    """
+
+    hasher = hashlib.sha256(model_name.encode("utf-8"))
+    hasher.update(token_ids.detach().to("cpu", torch.int64).numpy().tobytes())
+
+    return hasher.hexdigest()
+
+
+def to_dynamic_cache(past_key_values: Union[DynamicCache, tuple]) -> DynamicCache:
+    """Convert the legacy tuple formatted past key values returned by few models into a DynamicCache."""
+
+    if isinstance(past_key_values, DynamicCache):
+        return past_key_values
+
+    return DynamicCache.from_legacy_cache(past_key_values)
+
+
+def get_cache_size_in_bytes(past_key_values: DynamicCache) -> int:
+    """Returns the memory occupied by the key and value tensors of all the layers."""
+
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for layer_tensors in (past_key_values.key_cache, past_key_values.value_cache)
+        for tensor in layer_tensors
+    )
+
+
+def move_cache(past_key_values: DynamicCache, device: Union[str, torch.device]) -> DynamicCache:
+    """Move the key and value tensors of all the layers onto the given device."""
+
+    return DynamicCache.from_legacy_cache(
+        tuple((key.to(device), value.to(device)) for key, value in past_key_values.to_legacy_cache())
+    )
+
+
+def get_common_prefix_length(first_ids: torch.LongTensor, second_ids: torch.LongTensor) -> int:
+    """Returns the number of leading tokens that are same on both the 1D token id tensors."""
+
+    length = min(len(first_ids), len(second_ids))
+    mismatches = (first_ids[:length].to("cpu") != second_ids[:length].to("cpu")).nonzero()
+
+    return int(mismatches[0]) if len(mismatches) else length
+
+
+class PrefixKVCache:
+    """
+    Holds the past key values of a static prompt prefix (Eg: the INSTRUCTION_TEMPLATE) which is same for every request.
+    The prefix is prefilled only once and a copy of its key values is handed over to every generation whose prompt
+    starts with the prefix, so that only the remaining tokens of the prompt has to be prefilled.
+
+    Args:
+        model (AutoModelForCausalLM): Model used for the generation.
+        model_name (str, optional): Name of the model. Used to invalidate the cache when the model changes. Defaults to MODEL_NAME.
+    """
+
+    def __init__(
+        self,
+        model: AutoModelForCausalLM,
+        model_name: str = MODEL_NAME
+    ):
+        self._model = model
+        self._model_name = model_name
+
+        self._prefix_ids = None
+        self._past_key_values = None
+        self._fingerprint = None
+        self._prefill_milliseconds = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_milliseconds = 0.0
+
+
+    @property
+    def prefix_length(self) -> int:
+        return 0 if self._prefix_ids is None else len(self._prefix_ids)
+
+
+    @property
+    def hit_rate(self) -> float:
+        total_lookups = self.hits + self.misses
+
+        return self.hits / total_lookups if total_lookups else 0.0
+
+
+    @torch.no_grad()
+    def build(self, prefix_ids: torch.LongTensor) -> bool:
+        """Prefill the prefix and store its past key values. Prefill is skipped if the
+           prefix and the model is same as the one that is already cached.
+
+        Args:
+            prefix_ids (torch.LongTensor): A 1D tensor of token ids of the static prefix.
+
+        Returns:
+            bool: True if the prefix was (re)computed, False if the cached one was reused.
+        """
+
+        fingerprint = get_token_fingerprint(self._model_name, prefix_ids)
+        if fingerprint == self._fingerprint:
+            return False
+
+        logger.info(f"Prefilling the static prompt prefix of {len(prefix_ids)} tokens")
+
+        start_time = time.time()
+        outputs = self._model(prefix_ids.unsqueeze(0).to(self._model.device), use_cache=True)
+        self._prefill_milliseconds = (time.time() - start_time) * 1000
+
+        self._prefix_ids = prefix_ids.to("cpu")
+        self._past_key_values = to_dynamic_cache(outputs.past_key_values)
+        self._fingerprint = fingerprint
+
+        return True
+
+
+    def lookup(self, input_ids: torch.LongTensor) -> Optional[DynamicCache]:
+        """Get the past key values to start the generation of the given prompt with.
+
+        Args:
+            input_ids (torch.LongTensor): A 1D tensor of prompt token ids.
+
+        Returns:
+            Optional[DynamicCache]: A copy of the prefix key values if the prompt starts with the prefix else None.
+                                    A copy is returned since the generation extends the cache in-place.
+        """
+
+        prefix_length = self.prefix_length
+
+        #Atleast one token of the prompt should be left out of the cache for the generation to start.
+        if (
+            not prefix_length
+            or len(input_ids) <= prefix_length
+            or not torch.equal(input_ids[:prefix_length].to("cpu"), self._prefix_ids)
+        ):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.saved_milliseconds += self._prefill_milliseconds
+
+        return copy.deepcopy(self._past_key_values)
+
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Returns the lookup counters and the prefill time saved by the cache."""
+
+        return {
+            "prefix_tokens": self.prefix_length,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "prefill_milliseconds": self._prefill_milliseconds,
+            "saved_milliseconds": self.saved_milliseconds,
+        }
+
+
+class SessionKVCache:
+    """
+    Retains the past key values of each conversation between the turns so that a new turn only has to
+    prefill the tokens that were not seen on the previous turn. The entries are evicted in least recently
+    used order when the total memory occupied by them exceeds the budget.
+
+    An entry is reused only upto the longest common prefix of its token ids and the new prompt, so the
+    cache stays correct even when the history trimming or post-processing changes the earlier part of the prompt.
+
+    Args:
+        max_bytes (int, optional): Memory budget for all the retained key values. Defaults to SESSION_KV_CACHE_MAX_BYTES.
+        device (str, optional): Device to retain the key values on. Uses the model's device if None. Defaults to SESSION_KV_CACHE_DEVICE.
+        min_reuse_tokens (int, optional): Minimum number of reusable tokens for an entry to be used. Defaults to 1.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = SESSION_KV_CACHE_MAX_BYTES,
+        device: Optional[str] = SESSION_KV_CACHE_DEVICE,
+        min_reuse_tokens: int = 1
+    ):
+        self.max_bytes = max_bytes
+        self.device = device
+        self.min_reuse_tokens = min_reuse_tokens
+
+        self._entries = OrderedDict() #session_key -> (token_ids, past_key_values, size_in_bytes)
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+    def _pop(self, session_key: str) -> Optional[Tuple[torch.LongTensor, DynamicCache, int]]:
+        """Remove an entry from the cache and release its memory from the budget."""
+
+        entry = self._entries.pop(session_key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+        return entry
+
+
+    def lookup(
+        self,
+        session_key: str,
+        input_ids: torch.LongTensor,
+        device: Union[str, torch.device]
+    ) -> Optional[DynamicCache]:
+        """Get the past key values retained for the session cropped to the part that is reusable for the prompt.
+           The entry is handed over to the caller and removed from the cache, since the generation extends it in-place.
+
+        Args:
+            session_key (str): Key identifying the conversation.
+            input_ids (torch.LongTensor): A 1D tensor of prompt token ids.
+            device (Union[str, torch.device]): Device on which the generation runs.
+
+        Returns:
+            Optional[DynamicCache]: The reusable past key values or None if nothing can be reused.
+        """
+
+        entry = self._pop(session_key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        cached_ids, past_key_values, _ = entry
+
+        #Atleast one token of the prompt should be left out of the cache for the generation to start.
+        reusable_length = min(get_common_prefix_length(cached_ids, input_ids), len(input_ids) - 1)
+        if reusable_length < self.min_reuse_tokens:
+            self.invalidations += 1
+            self.misses += 1
+            return None
+
+        #Drop the key values of the tokens which are not part of the new prompt.
+        #Eg: Post-processed response text or history trimmed from the middle of the conversation.
+        past_key_values.crop(reusable_length)
+
+        self.hits += 1
+        self.reused_tokens += reusable_length
+
+        if self.device is not None:
+            past_key_values = move_cache(past_key_values, device)
+
+        return past_key_values
+
+
+    def put(
+        self,
+        session_key: str,
+        token_ids: torch.LongTensor,
+        past_key_values: DynamicCache
+    ):
+        """Retain the past key values of the session and evict the least recently used entries if the budget is exceeded.
+
+        Args:
+            session_key (str): Key identifying the conversation.
+            token_ids (torch.LongTensor): A 1D tensor of the token ids whose key values are in past_key_values.
+            past_key_values (DynamicCache): Key values produced by the generation.
+        """
+
+        self._pop(session_key)
+
+        if self.device is not None:
+            past_key_values = move_cache(past_key_values, self.device)
+
+        size_in_bytes = get_cache_size_in_bytes(past_key_values)
+        if size_in_bytes > self.max_bytes:
+            return
+
+        self._entries[session_key] = (token_ids.to("cpu"), past_key_values, size_in_bytes)
+        self.total_bytes += size_in_bytes
+
+        while self.total_bytes > self.max_bytes:
+            self._pop(next(iter(self._entries)))
+            self.evictions += 1
+
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Returns the lookup counters and the memory occupied by the cache."""
+
+        total_lookups = self.hits + self.misses
+
+        return {
+            "sessions": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total_lookups if total_lookups else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+            "reused_tokens": self.reused_tokens,
+        }
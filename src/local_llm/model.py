@@ -1,85 +1,62 @@
-from typing import Tuple, Optional, List
+from typing import Optional, Tuple
 
-import torch
-from langchain.llms import HuggingFacePipeline
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
-    BitsAndBytesConfig,
-    StoppingCriteria,
-    StoppingCriteriaList,
-    TextIteratorStreamer,
-    pipeline
 )
 
 from src.constants import *
+from src.utils import create_logger
+from .engine import GenerationEngine
+from .artifacts import get_artifact_dtype, get_quantization_config, is_model_artifact_valid
+from .cpu import get_cpu_load_dtype, prepare_cpu_model, set_cpu_threads
 
-class StopOnTokens(StoppingCriteria):
-    """
-    A stopping criteria that stops generation when a specific token is generated.
-
-    Args:
-        stop_ids (List[int]): A list of token ids that will trigger the stopping criteria.
-    """
-
-    def __init__(self, stop_ids: List[int]):
-        super().__init__()
-
-        self._stop_ids = stop_ids
-
-    def __call__(
-        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
-    ) -> bool:
-        """
-        Check if the last generated token is in the stop_ids list.
-
-        Args:
-            input_ids (torch.LongTensor): The input token ids.
-            scores (torch.FloatTensor): The scores of the generated tokens.
-
-        Returns:
-            bool: True if the last generated token is in the stop_ids list, False otherwise.
-        """
-
-        for stop_id in self._stop_ids:
-            if input_ids[0][-1] == stop_id:
-                return True
-
-        return False
-
+logger = create_logger(LOGFILE_PATH)
 
 def get_model(
     model_name:str = 'mistralai/Mistral-7B-Instruct-v0.2',
     device: str = 'cuda:0',
     gradient_checkpointing: bool = True,
+    artifact_dir: Optional[str] = MODEL_ARTIFACT_DIR,
+    cpu_quantization: Optional[str] = CPU_QUANTIZATION,
+    cpu_dtype: str = CPU_DTYPE,
 ) -> AutoModelForCausalLM:
     """
     Build a 4-bit quantized LLM model based on the given HuggingFace's 
-    model name on the specified device.
+    model name on the specified device. The pre-quantized weights are loaded memory-mapped
+    from the model artifact if it is available and up to date. Else the model is quantized while loading.
+    On cpu the model is loaded in bf16 where supported or is quantized via int8 dynamic quantization instead.
 
     Args:
         model_name (str,optional): A pretrained huggingface model name. Defaults to mistralai/Mistral-7B-Instruct-v0.2
         device (str, optional): Device to use while loading the model. Defaults to cuda:0
         gradient_checkpointing (bool, optional): Whether or not to enable gradient checkpoint while training. Defults to True.
+        artifact_dir (str, optional): Directory of the pre-quantized model artifact. Not used if None. Defaults to MODEL_ARTIFACT_DIR.
+        cpu_quantization (str, optional): 'int8' for dynamic quantization on cpu or None. Defaults to CPU_QUANTIZATION.
+        cpu_dtype (str, optional): dtype of the unquantized model on cpu. One of 'auto', 'bfloat16' or 'float32'. Defaults to CPU_DTYPE.
 
     Returns:
         AutoModelForCausalLM: A built huggigface model.
     """
     
-    #Initialize a bnb 4-bit quantization config file 
-    bnb_config =  BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_use_double_quant=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.bfloat16,
-    )
+    #Initialize a bnb 4-bit quantization config file. bitsandbytes is not used on cpu.
+    bnb_config = get_quantization_config(device)
+    
+    #The modules which aren't quantized are loaded in the same dtype from the artifact and from the checkpoint on gpu.
+    torch_dtype = get_cpu_load_dtype(cpu_quantization, cpu_dtype) if device == "cpu" else get_artifact_dtype(bnb_config)
 
-    #Instantiate the LLM based on the created quantization config with using device specified.
-    model = AutoModelForCausalLM.from_pretrained(
-        model_name,
-        quantization_config=bnb_config,
-        device_map=device
-        )
+    if artifact_dir is not None and is_model_artifact_valid(artifact_dir, model_name, bnb_config, MODEL_ARTIFACT_VERIFY_CHECKSUMS):
+        #Quantization config is saved with the artifact and the weights are already quantized.
+        logger.info(f"Loading the pre-quantized model from {artifact_dir}")
+        model = AutoModelForCausalLM.from_pretrained(artifact_dir, device_map=device, torch_dtype=torch_dtype)
+    else:
+        #Instantiate the LLM based on the created quantization config with using device specified.
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            quantization_config=bnb_config,
+            device_map=device,
+            torch_dtype=torch_dtype,
+            )
     
     #Enable disble gradient_checkpointing to optimize memory usage.
     if gradient_checkpointing:
@@ -90,6 +67,9 @@ def get_model(
     else:
         model.gradient_checkpointing_disable()
         model.config.use_cache = True
+    
+    if device == "cpu":
+        model = prepare_cpu_model(model, cpu_quantization)
         
     return model
 
@@ -119,54 +99,75 @@ def build_pipeline(
     model_name:str = 'mistralai/Mistral-7B-Instruct-v0.2',
     device: str = 'cuda:0',
     gradient_checkpointing: bool = False,
-    use_streamer: bool = False
-) -> Tuple[HuggingFacePipeline, Optional[TextIteratorStreamer]]:
+    use_streamer: bool = False,
+    max_batch_size: int = MAX_BATCH_SIZE,
+    cpu_quantization: Optional[str] = CPU_QUANTIZATION,
+    cpu_num_threads: Optional[int] = CPU_NUM_THREADS,
+    draft_model_name: Optional[str] = DRAFT_MODEL_NAME,
+    prompt_lookup_num_tokens: Optional[int] = PROMPT_LOOKUP_NUM_TOKENS,
+) -> Tuple[GenerationEngine, str]:
     """
-    Builds a HuggingFace pipeline for text generation using a pretrained LLM.
+    Builds a generation pipeline for text generation using a pretrained LLM.
+    The pipeline reuses the past key values of the static prompt prefix once it is built via
+    GenerationEngine.build_prefix_cache.
 
     Args:
         model_name (str,optional): A pretrained huggingface model name. Defaults to mistralai/Mistral-7B-Instruct-v0.2
         device (str, optional): Device to use while loading the model. Defaults to 'cuda:0'
         gradient_checkpointing (bool, optional): Whether to use gradient checkpointing. Defaults to False.
-        use_streamer (bool, optional): Whether to use a text iterator streamer. Defaults to False.
+        use_streamer (bool, optional): Whether to use a text iterator streamer for each request. Defaults to False.
+        max_batch_size (int, optional): Maximum number of concurrent requests decoded together. Defaults to MAX_BATCH_SIZE.
+        cpu_quantization (str, optional): 'int8' for dynamic quantization on cpu or None. Defaults to CPU_QUANTIZATION.
+        cpu_num_threads (int, optional): Number of intra-op threads on cpu. torch's default is used if None. Defaults to CPU_NUM_THREADS.
+        draft_model_name (str, optional): Huggingface name of a small model sharing the tokenizer, used as the draft model for
+                                          speculative decoding. Disabled if None. Defaults to DRAFT_MODEL_NAME.
+        prompt_lookup_num_tokens (int, optional): Tokens proposed per step by prompt lookup decoding, which needs no draft model.
+                                                  Disabled if None. Defaults to PROMPT_LOOKUP_NUM_TOKENS.
 
     Returns:
-        Tuple[HuggingFacePipeline, Optional[TextIteratorStreamer]]: A tuple containing the HuggingFace pipeline
-            and the text iterator streamer (if used).
+        Tuple[GenerationEngine, str]: A tuple containing the generation engine and the eos token.
     """
 
+    if device == "cpu":
+        set_cpu_threads(cpu_num_threads)
+
     #Instantiate a LLM model
     model = get_model(
         model_name=model_name,
         device=device,
         gradient_checkpointing=gradient_checkpointing,
+        cpu_quantization=cpu_quantization,
     )
     model.eval() #Turn the model onto evaluation mode
     
     tokenizer = get_tokenizer(model_name) #Instantiate a tokenizer
 
-    #Initialize a Text Streamer based on args passed.
-    #Specify a stopping criteria using eos token if streamer is about to used.
-    if use_streamer:
-        streamer = TextIteratorStreamer(
-            tokenizer, timeout=10.0, skip_prompt=True, skip_special_tokens=True
+    #Instantiate the draft model for speculative decoding.
+    draft_model = None
+    if draft_model_name is not None:
+        draft_model = get_model(
+            model_name=draft_model_name,
+            device=device,
+            gradient_checkpointing=False,
+            artifact_dir=None,
+            cpu_quantization=cpu_quantization,
         )
-        stop_on_tokens = StopOnTokens(stop_ids=[tokenizer.eos_token_id])
-        stopping_criteria = StoppingCriteriaList([stop_on_tokens])
-    else:
-        streamer = None
-        stopping_criteria = StoppingCriteriaList([])
+        draft_model.eval()
 
-    #Initialize a hugginface text generation pipeline and specify the neccasary args
-    pipe = pipeline(
-        "text-generation",
+    #Initialize a generation engine and specify the neccasary args.
+    #Each request gets its own text streamer and stopping criteria from the engine.
+    #Specify a stopping criteria using eos token if streamer is about to used.
+    engine = GenerationEngine(
         model=model,
         tokenizer=tokenizer,
+        model_name=model_name,
         max_new_tokens=MAX_NEW_TOKENS,
         temperature=TEMPERATURE,
-        streamer=streamer,
-        stopping_criteria=stopping_criteria,
+        use_streamer=use_streamer,
+        stop_ids=[tokenizer.eos_token_id] if use_streamer else [],
+        max_batch_size=max_batch_size,
+        draft_model=draft_model,
+        prompt_lookup_num_tokens=prompt_lookup_num_tokens,
     )
-    hf = HuggingFacePipeline(pipeline=pipe)
 
-    return hf, streamer, tokenizer.eos_token
\ No newline at end of file
+    return engine, tokenizer.eos_token
\ No newline at end of file
@@ -0,0 +1,127 @@
+import re
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+import torch
+from transformers import AutoTokenizer
+
+from src.constants import *
+from src.utils import create_logger
+
+logger = create_logger(LOGFILE_PATH)
+
+if TYPE_CHECKING:
+    from src.conversation_store import TokenSegments
+
+#Prompt text is split right after a run of newlines. A newline is a byte fallback token for the sentencepiece
+#tokenizers and never merges with its neighbours, so each segment is tokenized the same as within the whole text.
+_SEGMENT_BOUNDARY = re.compile(r"(?<=\n)(?=[^\n])")
+
+#Used in place of the queries and responses of the probe conversations built for pre-tokenizing the fixed segments.
+PROMPT_PLACEHOLDER = "<<PROMPT_ENCODER_PLACEHOLDER>>"
+
+
+def split_prompt_segments(text: str) -> List[str]:
+    """Split the prompt text into segments which can be tokenized independently of each other."""
+
+    return _SEGMENT_BOUNDARY.split(text)
+
+
+class PromptEncoder:
+    """
+    Builds the token ids of the prompt messages as per the LLM's chat template without tokenizing the whole prompt.
+
+    The prompt text is split into segments at the newline boundaries. The segments of the fixed parts of the prompt,
+    i.e. the chat template, the instruction template and the query wrapper, are tokenized once by build and their
+    ids are concatenated with the ids of the segments holding the query and the past responses, which are the only
+    segments tokenized per request. The result is identical to tokenizing the templated prompt as a whole, which is
+    verified by build against the tokenizer's chat template. The chat template is used directly if it is not.
+
+    Args:
+        tokenizer (AutoTokenizer): Tokenizer of the LLM.
+    """
+
+    def __init__(self, tokenizer: AutoTokenizer):
+        self.tokenizer = tokenizer
+        self.is_verified = False
+
+        #Segments after the first are tokenized following a newline so that they aren't treated as the start of text.
+        self._anchor_ids = self.tokenizer("\n", add_special_tokens=False).input_ids
+        self._segment_ids: Dict[Tuple[bool, str], List[int]] = {}
+
+
+    def _tokenize_segment(self, segment: str, is_first: bool) -> List[int]:
+        """Tokenize a segment of the prompt as it would be tokenized within the whole prompt."""
+
+        if is_first:
+            return self.tokenizer(segment, add_special_tokens=False).input_ids
+
+        return self.tokenizer("\n" + segment, add_special_tokens=False).input_ids[len(self._anchor_ids):]
+
+
+    def _encode_text(self, text: str, segments: Optional['TokenSegments'] = None) -> List[int]:
+        """Concatenate the ids of the prompt segments. Only the segments which are not pre-tokenized are tokenized.
+           The conversation's segments are looked up and added to its segments if given."""
+
+        input_ids = []
+        for index, segment in enumerate(split_prompt_segments(text)):
+            key = (not index, segment)
+            segment_ids = self._segment_ids.get(key)
+            if segment_ids is None and segments is not None:
+                segment_ids = segments.get(key)
+            if segment_ids is None:
+                segment_ids = self._tokenize_segment(segment, not index)
+                if segments is not None:
+                    segments.put(key, segment_ids)
+            input_ids.extend(segment_ids)
+
+        return input_ids
+
+
+    def build(self, probe_conversations: List[List[Dict[str, str]]]):
+        """Pre-tokenize the fixed segments of the prompt and verify the token ids against the chat template.
+
+        Args:
+            probe_conversations (List[List[Dict[str, str]]]): Prompt messages built for the placeholder queries and
+                                                              responses. Every segment without a placeholder is fixed.
+        """
+
+        for messages in probe_conversations:
+            text = self.tokenizer.apply_chat_template(messages, tokenize=False)
+
+            for index, segment in enumerate(split_prompt_segments(text)):
+                if PROMPT_PLACEHOLDER not in segment:
+                    self._segment_ids[(not index, segment)] = self._tokenize_segment(segment, not index)
+
+        self.is_verified = all(
+            self._encode_text(self.tokenizer.apply_chat_template(messages, tokenize=False))
+            == self.tokenizer.apply_chat_template(messages)
+            for messages in probe_conversations
+        )
+
+        if not self.is_verified:
+            logger.warning("Pre-tokenized prompt segments don't match the chat template. Tokenizing the whole prompt instead.")
+
+        logger.info(f"Pre-tokenized {len(self._segment_ids)} fixed prompt segments")
+
+
+    def encode(self, messages: List[Dict[str, str]], segments: Optional['TokenSegments'] = None) -> Tuple[str, torch.LongTensor]:
+        """Convert the prompt messages into the prompt text and its token ids as per the LLM's chat template.
+
+        Args:
+            messages (List[Dict[str, str]]): Prompt messages with role and content.
+            segments (TokenSegments, optional): Token ids of the segments of the conversation tokenized on its earlier
+                                                turns. The new segments are added to it. Defaults to None.
+
+        Returns:
+            Tuple[str, torch.LongTensor]: The prompt text and its token ids as a 1D tensor.
+        """
+
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False)
+
+        if self.is_verified:
+            input_ids = self._encode_text(text, segments)
+        else:
+            input_ids = self.tokenizer.apply_chat_template(messages)
+
+        return text, torch.tensor(input_ids, dtype=torch.long)
+
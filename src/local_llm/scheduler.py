@@ -0,0 +1,467 @@
+import queue
+import threading
+from typing import List, Optional, Dict, Union
+
+import torch
+import torch.nn.functional as F
+from transformers import (
+    AutoModelForCausalLM,
+    DynamicCache,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
+
+from src.constants import *
+from src.utils import create_logger
+from src.metrics import get_metrics
+from .kv_cache import to_dynamic_cache
+from .stopping import StopSequenceMatcher
+
+logger = create_logger(LOGFILE_PATH)
+
+
+def is_stopping_criteria_met(
+    stopping_criteria: StoppingCriteriaList,
+    sequence_ids: torch.LongTensor,
+    scores: torch.FloatTensor
+) -> bool:
+    """Evaluate the stopping criteria for a single sequence. Handles both the bool and the
+       bool tensor returned by the different versions of huggingface stopping criteria."""
+
+    if not stopping_criteria:
+        return False
+
+    is_done = stopping_criteria(sequence_ids, scores)
+
+    return bool(is_done.any()) if isinstance(is_done, torch.Tensor) else bool(is_done)
+
+
+def pad_cache_left(past_key_values: DynamicCache, amount: int) -> tuple:
+    """Left pad the key and value tensors of every layer along the sequence dimension.
+
+    Returns:
+        tuple: Padded key values in the legacy tuple format. Tensors are of shape [batch, heads, sequence, head_dim].
+    """
+
+    return tuple(
+        (F.pad(key, (0, 0, amount, 0)), F.pad(value, (0, 0, amount, 0))) if amount else (key, value)
+        for key, value in past_key_values.to_legacy_cache()
+    )
+
+
+class GenerationRequest:
+    """
+    A single generation request submitted to the GenerationScheduler. Each request has its
+    own streamer and can be waited upon for its result.
+
+    Args:
+        input_ids (torch.LongTensor): A 1D tensor of prompt token ids.
+        past_key_values (DynamicCache, optional): Key values of the leading prompt tokens if already computed. Defaults to None.
+        streamer (TextIteratorStreamer, optional): Streamer to which the generated tokens of this request are pushed. Defaults to None.
+        stopping_criteria (StoppingCriteriaList, optional): Additional criteria to stop the generation of this request, evaluated
+                                                            per request on every step. The stop sequences of the scheduler are
+                                                            matched for the whole batch at once instead. Defaults to None.
+        max_new_tokens (int, optional): The maximum number of new tokens to generate. Defaults to MAX_NEW_TOKENS.
+    """
+
+    def __init__(
+        self,
+        input_ids: torch.LongTensor,
+        past_key_values: Optional[DynamicCache] = None,
+        streamer: Optional[TextIteratorStreamer] = None,
+        stopping_criteria: Optional[StoppingCriteriaList] = None,
+        max_new_tokens: int = MAX_NEW_TOKENS,
+    ):
+        self.input_ids = input_ids.to("cpu")
+        self.past_key_values = past_key_values
+        self.streamer = streamer
+        self.stopping_criteria = stopping_criteria if stopping_criteria is not None else StoppingCriteriaList([])
+        self.max_new_tokens = max_new_tokens
+
+        self.output_ids = []
+        self.stop_sequence_index = None #Index of the stop sequence of the scheduler which ended the generation, if any.
+        self.error = None
+        self._done = threading.Event()
+
+
+    @property
+    def sequence_ids(self) -> torch.LongTensor:
+        """Prompt and generated token ids as a 1D tensor."""
+
+        return torch.cat([self.input_ids, torch.tensor(self.output_ids, dtype=self.input_ids.dtype)])
+
+
+    def finish(self, past_key_values: Optional[DynamicCache] = None, error: Optional[Exception] = None):
+        """Mark the request as completed along with the key values of its sequence or the error raised."""
+
+        self.past_key_values = past_key_values
+        self.error = error
+
+        if self.streamer is not None:
+            self.streamer.end()
+
+        self._done.set()
+
+
+    def wait(self) -> torch.LongTensor:
+        """Block untill the request is completed.
+
+        Returns:
+            torch.LongTensor: A 1D tensor of the prompt and the generated token ids.
+        """
+
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+
+        return self.sequence_ids
+
+
+class GenerationScheduler:
+    """
+    Continuous batching scheduler for the local LLM. A single background thread runs the decode loop.
+    New requests are prefilled on thier own and admitted into the running decode batch at the token
+    boundaries, and the finished sequences are retired from the batch independently, so the concurrent
+    requests share every forward pass of the model instead of waiting for each other.
+
+    The rows are checked for the eos token, thier token budget and the stop sequences together with tensor ops.
+    A window of the latest generated tokens of each row is kept for matching the multi token stop sequences.
+
+    The batch's key values are kept left padded so that every row is extended by one token per step.
+    The batch cache is rebuilt only when a request is admitted or retired.
+
+    Args:
+        model (AutoModelForCausalLM): Model used for the generation.
+        eos_token_id (int): Token id which ends the generation of a sequence.
+        max_batch_size (int, optional): Maximum number of sequences decoded together. Defaults to MAX_BATCH_SIZE.
+        temperature (float, optional): The temperature to use during generation. Greedy decoding is used for 0. Defaults to TEMPERATURE.
+        stop_matcher (StopSequenceMatcher, optional): Matcher of the token id sequences which stop the generation of a request. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        model: AutoModelForCausalLM,
+        eos_token_id: int,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        temperature: float = TEMPERATURE,
+        stop_matcher: Optional[StopSequenceMatcher] = None,
+    ):
+        self._model = model
+        self._eos_token_id = eos_token_id
+        self.max_batch_size = max_batch_size
+        self._temperature = temperature
+        self._stop_matcher = stop_matcher
+
+        self._pending = queue.Queue()
+
+        #State of the running decode batch.
+        self._active = []
+        self._past_key_values = None
+        self._padding = []
+        self._lengths = []
+        self._next_tokens = []
+        self._remaining_tokens = None #Tokens each row can still generate.
+        self._stop_windows = None #Latest generated tokens of each row.
+
+        self.steps = 0
+        self.decoded_tokens = 0
+        self.generated_tokens = 0
+        self.completed_requests = 0
+
+        self._thread = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+        self._thread.start()
+
+
+    @property
+    def queue_depth(self) -> int:
+        return self._pending.qsize()
+
+
+    @property
+    def active_requests(self) -> int:
+        return len(self._active)
+
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """Queue a request for generation. Use GenerationRequest.wait to get its result."""
+
+        self._pending.put(request)
+
+        return request
+
+
+    def _select_tokens(self, logits: torch.FloatTensor) -> torch.LongTensor:
+        """Pick the next token of each row from the last position's logits."""
+
+        if self._temperature > 0:
+            return torch.multinomial(torch.softmax(logits / self._temperature, dim=-1), num_samples=1)[:, 0]
+
+        return logits.argmax(dim=-1)
+
+
+    def _emit(self, request: GenerationRequest, token: int):
+        """Append the generated token to the request and stream it."""
+
+        request.output_ids.append(token)
+        self.generated_tokens += 1
+
+        if request.streamer is not None:
+            request.streamer.put(torch.tensor([token]))
+
+
+    def _get_finished_rows(
+        self,
+        tokens: torch.LongTensor,
+        remaining_tokens: torch.LongTensor,
+        stop_windows: Optional[torch.LongTensor],
+        requests: List[GenerationRequest],
+        scores: torch.FloatTensor,
+    ) -> List[int]:
+        """Check every row for the eos token, its token budget and the stop sequences at once. The stop sequence
+           matched by a row is recorded on its request.
+
+        Args:
+            tokens (torch.LongTensor): Token generated by each row in this step.
+            remaining_tokens (torch.LongTensor): Tokens each row can still generate after this step.
+            stop_windows (torch.LongTensor, optional): Latest generated tokens of each row including this step's.
+            requests (List[GenerationRequest]): Request of each row.
+            scores (torch.FloatTensor): Scores of this step of shape [batch, vocab].
+
+        Returns:
+            List[int]: The rows which have finished thier generation.
+        """
+
+        is_finished = (tokens == self._eos_token_id) | (remaining_tokens <= 0)
+
+        if stop_windows is not None:
+            matched = self._stop_matcher.match(stop_windows)
+            is_finished |= matched >= 0
+            for row in torch.nonzero(matched >= 0)[:, 0].tolist():
+                requests[row].stop_sequence_index = int(matched[row])
+
+        #Requests with thier own stopping criteria are checked one at a time.
+        for row, request in enumerate(requests):
+            if request.stopping_criteria and not is_finished[row]:
+                is_finished[row] = is_stopping_criteria_met(
+                    request.stopping_criteria, request.sequence_ids.unsqueeze(0), scores[row:row+1]
+                )
+
+        return torch.nonzero(is_finished)[:, 0].tolist()
+
+
+    @torch.no_grad()
+    def _admit(self, request: GenerationRequest):
+        """Prefill the prompt of the request and add it to the running decode batch."""
+
+        device = self._model.device
+        input_ids = request.input_ids.to(device)
+
+        past_key_values = request.past_key_values if request.past_key_values is not None else DynamicCache()
+        num_cached_tokens = past_key_values.get_seq_length()
+
+        outputs = self._model(
+            input_ids=input_ids[num_cached_tokens:].unsqueeze(0),
+            attention_mask=torch.ones(1, len(input_ids), dtype=torch.long, device=device),
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        past_key_values = to_dynamic_cache(outputs.past_key_values)
+
+        #Prompt is pushed first to the streamer just like huggingface generate does, so that it can be skipped.
+        if request.streamer is not None:
+            request.streamer.put(request.input_ids.unsqueeze(0))
+
+        scores = outputs.logits[:, -1, :]
+        tokens = self._select_tokens(scores).cpu()
+        token = int(tokens[0])
+        self._emit(request, token)
+        get_metrics().record_tokens(1)
+
+        remaining_tokens = torch.tensor([request.max_new_tokens - 1])
+        stop_windows = None
+        if self._stop_matcher is not None:
+            stop_windows = self._stop_matcher.push(self._stop_matcher.empty_windows(1), tokens)
+
+        if self._get_finished_rows(tokens, remaining_tokens, stop_windows, [request], scores):
+            request.finish(past_key_values)
+            self.completed_requests += 1
+            return
+
+        self._merge(request, past_key_values, token, remaining_tokens, stop_windows)
+
+
+    def _merge(
+        self,
+        request: GenerationRequest,
+        past_key_values: DynamicCache,
+        token: int,
+        remaining_tokens: torch.LongTensor,
+        stop_windows: Optional[torch.LongTensor],
+    ):
+        """Add the prefilled sequence as a new row of the batch cache by left padding the shorter one."""
+
+        length = past_key_values.get_seq_length()
+
+        if self._past_key_values is None:
+            self._past_key_values = past_key_values
+            self._padding, self._lengths = [0], [length]
+            self._remaining_tokens, self._stop_windows = remaining_tokens, stop_windows
+        else:
+            batch_length = self._past_key_values.get_seq_length()
+            new_length = max(batch_length, length)
+
+            batch_layers = pad_cache_left(self._past_key_values, new_length - batch_length)
+            row_layers = pad_cache_left(past_key_values, new_length - length)
+            self._past_key_values = DynamicCache.from_legacy_cache(tuple(
+                (torch.cat([batch_key, row_key]), torch.cat([batch_value, row_value]))
+                for (batch_key, batch_value), (row_key, row_value) in zip(batch_layers, row_layers)
+            ))
+
+            self._padding = [padding + new_length - batch_length for padding in self._padding] + [new_length - length]
+            self._lengths.append(length)
+            self._remaining_tokens = torch.cat([self._remaining_tokens, remaining_tokens])
+            if stop_windows is not None:
+                self._stop_windows = torch.cat([self._stop_windows, stop_windows])
+
+        self._active.append(request)
+        self._next_tokens.append(token)
+
+
+    def _retire(self, finished_rows: List[int]):
+        """Remove the finished rows from the batch and hand over thier own key values to the requests."""
+
+        layers = self._past_key_values.to_legacy_cache()
+
+        for row in finished_rows:
+            padding = self._padding[row]
+            row_cache = DynamicCache.from_legacy_cache(tuple(
+                (key[row:row+1, :, padding:].clone(), value[row:row+1, :, padding:].clone()) for key, value in layers
+            ))
+            self._active[row].finish(row_cache)
+            self.completed_requests += 1
+
+        keep_rows = [row for row in range(len(self._active)) if row not in finished_rows]
+        if not keep_rows:
+            self._reset()
+            return
+
+        #Drop the padding columns that are common for all the remaining rows.
+        common_padding = min(self._padding[row] for row in keep_rows)
+        index = torch.tensor(keep_rows, device=layers[0][0].device)
+        self._past_key_values = DynamicCache.from_legacy_cache(tuple(
+            (key.index_select(0, index)[:, :, common_padding:], value.index_select(0, index)[:, :, common_padding:])
+            for key, value in layers
+        ))
+
+        self._active = [self._active[row] for row in keep_rows]
+        self._padding = [self._padding[row] - common_padding for row in keep_rows]
+        self._lengths = [self._lengths[row] for row in keep_rows]
+        self._next_tokens = [self._next_tokens[row] for row in keep_rows]
+
+        keep_index = torch.tensor(keep_rows)
+        self._remaining_tokens = self._remaining_tokens.index_select(0, keep_index)
+        if self._stop_windows is not None:
+            self._stop_windows = self._stop_windows.index_select(0, keep_index)
+
+
+    def _reset(self):
+        """Clear the state of the decode batch."""
+
+        self._active, self._padding, self._lengths, self._next_tokens = [], [], [], []
+        self._past_key_values = None
+        self._remaining_tokens, self._stop_windows = None, None
+
+
+    @torch.no_grad()
+    def _step(self):
+        """Run a single decode step for all the rows of the batch."""
+
+        device = self._model.device
+        batch_length = self._past_key_values.get_seq_length()
+
+        #Mask the left padding of each row and continue each row from its own position.
+        padding = torch.tensor(self._padding, device=device)
+        attention_mask = (torch.arange(batch_length + 1, device=device).unsqueeze(0) >= padding.unsqueeze(1)).long()
+        position_ids = torch.tensor(self._lengths, device=device).unsqueeze(1)
+
+        outputs = self._model(
+            input_ids=torch.tensor(self._next_tokens, device=device).unsqueeze(1),
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._past_key_values,
+            use_cache=True,
+        )
+        self._past_key_values = to_dynamic_cache(outputs.past_key_values)
+        self._lengths = [length + 1 for length in self._lengths]
+        self.steps += 1
+
+        scores = outputs.logits[:, -1, :]
+        tokens = self._select_tokens(scores).cpu()
+        self._next_tokens = tokens.tolist()
+        self.decoded_tokens += len(self._next_tokens)
+        get_metrics().record_tokens(len(self._next_tokens))
+
+        for request, token in zip(self._active, self._next_tokens):
+            self._emit(request, token)
+
+        self._remaining_tokens = self._remaining_tokens - 1
+        if self._stop_windows is not None:
+            self._stop_windows = self._stop_matcher.push(self._stop_windows, tokens)
+
+        finished_rows = self._get_finished_rows(tokens, self._remaining_tokens, self._stop_windows, self._active, scores)
+        if finished_rows:
+            self._retire(finished_rows)
+
+
+    def _fail_all(self, error: Exception):
+        """Fail every request in the batch so that none of the callers waits forever."""
+
+        for request in self._active:
+            request.finish(error=error)
+        self._reset()
+
+
+    def _run(self):
+        """Decode loop. Admits the pending requests at every token boundary and steps the batch."""
+
+        while True:
+            #Block for a new request when there is nothing to decode.
+            if not self._active:
+                pending_requests = [self._pending.get()]
+            else:
+                pending_requests = []
+
+            while len(self._active) + len(pending_requests) < self.max_batch_size:
+                try:
+                    pending_requests.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            for request in pending_requests:
+                try:
+                    self._admit(request)
+                except Exception as error:
+                    logger.exception("Failed to prefill the generation request")
+                    request.finish(error=error)
+
+            if not self._active:
+                continue
+
+            try:
+                self._step()
+            except Exception as error:
+                logger.exception("Decode step of the generation batch failed")
+                self._fail_all(error)
+
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Returns the counters of the scheduler."""
+
+        return {
+            "queue_depth": self.queue_depth,
+            "active_requests": self.active_requests,
+            "steps": self.steps,
+            "generated_tokens": self.generated_tokens,
+            "completed_requests": self.completed_requests,
+            "average_batch_size": self.decoded_tokens / self.steps if self.steps else 0.0,
+        }
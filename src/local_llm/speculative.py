@@ -0,0 +1,92 @@
+import threading
+from typing import Dict, Optional
+
+from transformers import AutoModelForCausalLM
+
+
+class ForwardCounter:
+    """Counts the forward passes of a model made by the current thread. Each generation runs on its own thread
+       and so the count is of that generation alone, even when the model is shared by concurrent generations."""
+
+    def __init__(self, model: AutoModelForCausalLM):
+        self._local = threading.local()
+        model.register_forward_hook(self._hook)
+
+
+    def _hook(self, module, args, output):
+        self._local.count = self.count + 1
+
+
+    def reset(self):
+        self._local.count = 0
+
+
+    @property
+    def count(self) -> int:
+        return getattr(self._local, "count", 0)
+
+
+class SpeculativeDecodingStats:
+    """
+    Tracks how many tokens the speculative decoding gets out of each forward pass of the target model.
+
+    Every forward pass of the target model verifies the proposed tokens and adds the accepted ones along with one
+    token of its own. So the accepted draft tokens of a generation are its new tokens minus the target's forward passes.
+    The proposed draft tokens are counted as the forward passes of the draft model, each of which proposes one token.
+    Without a draft model (Eg: prompt lookup decoding) only the accepted tokens are tracked.
+
+    Args:
+        target_model (AutoModelForCausalLM): Model whose output is generated.
+        draft_model (AutoModelForCausalLM, optional): Model proposing the draft tokens, if any. Defaults to None.
+    """
+
+    def __init__(self, target_model: AutoModelForCausalLM, draft_model: Optional[AutoModelForCausalLM] = None):
+        self._target_counter = ForwardCounter(target_model)
+        self._draft_counter = ForwardCounter(draft_model) if draft_model is not None else None
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.steps = 0
+        self.generated_tokens = 0
+        self.draft_tokens = 0
+
+
+    def start(self):
+        """Start tracking a generation on the current thread."""
+
+        self._target_counter.reset()
+        if self._draft_counter is not None:
+            self._draft_counter.reset()
+
+
+    def finish(self, num_new_tokens: int):
+        """Record the generation started on the current thread once it has generated num_new_tokens."""
+
+        with self._lock:
+            self.requests += 1
+            self.steps += self._target_counter.count
+            self.generated_tokens += num_new_tokens
+            if self._draft_counter is not None:
+                self.draft_tokens += self._draft_counter.count
+
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the accepted tokens per step of the target model and the acceptance rate of the draft tokens.
+           The acceptance rate is left out when no draft tokens are counted, Eg: in prompt lookup decoding."""
+
+        with self._lock:
+            accepted_tokens = max(self.generated_tokens - self.steps, 0)
+
+            stats = {
+                "requests": self.requests,
+                "steps": self.steps,
+                "generated_tokens": self.generated_tokens,
+                "tokens_per_step": self.generated_tokens / self.steps if self.steps else 0.0,
+                "accepted_draft_tokens": accepted_tokens,
+                "accepted_tokens_per_step": accepted_tokens / self.steps if self.steps else 0.0,
+            }
+            if self.draft_tokens:
+                stats["draft_tokens"] = self.draft_tokens
+                stats["acceptance_rate"] = accepted_tokens / self.draft_tokens
+
+            return stats
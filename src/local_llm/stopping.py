@@ -0,0 +1,159 @@
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from transformers import AutoTokenizer, StoppingCriteria
+
+from src.constants import *
+
+#Fills the positions of a window which are not generated tokens. Never matches a token id.
+_NO_TOKEN = -1
+
+
+def get_stop_token_sequences(tokenizer: AutoTokenizer, stop_strings: List[str] = STOP_STRINGS) -> List[Tuple[str, List[int]]]:
+    """Tokenize the stop strings into the token id sequences the model can generate them as. A string is tokenized
+       differently at the start of a line and after a word (Eg: 'QUEST' vs '▁QUEST'), so both forms are included.
+
+    Returns:
+        List[Tuple[str, List[int]]]: Each stop string along with one of its token id sequences.
+    """
+
+    anchor_ids = tokenizer("\n", add_special_tokens=False).input_ids
+
+    sequences = []
+    for stop_string in stop_strings:
+        for text in ("\n" + stop_string, "\n " + stop_string):
+            ids = tokenizer(text, add_special_tokens=False).input_ids[len(anchor_ids):]
+            if ids and (stop_string, ids) not in sequences:
+                sequences.append((stop_string, ids))
+
+    return sequences
+
+
+class StopSequenceMatcher:
+    """
+    Matches the stop sequences of token ids at the end of many windows of tokens at once with tensor ops.
+
+    The sequences are kept right aligned in a [num_sequences, window] table along with a mask of thier positions,
+    so a window matches a sequence when all of the masked positions are equal. The windows are of the length of the
+    longest sequence and hold only the generated tokens, with the rest filled by -1.
+
+    Args:
+        stop_sequences (List[List[int]]): Token id sequences which stop the generation. Single stop ids are sequences of length 1.
+    """
+
+    def __init__(self, stop_sequences: List[List[int]]):
+        if not stop_sequences or not all(stop_sequences):
+            raise ValueError("Atleast one non empty stop sequence is required.")
+
+        self.window = max(len(sequence) for sequence in stop_sequences)
+
+        self._ids = torch.zeros(len(stop_sequences), self.window, dtype=torch.long)
+        self._mask = torch.zeros(len(stop_sequences), self.window, dtype=torch.bool)
+        for index, sequence in enumerate(stop_sequences):
+            self._ids[index, self.window - len(sequence):] = torch.tensor(sequence)
+            self._mask[index, self.window - len(sequence):] = True
+
+        self._tables = {}
+
+
+    def _get_table(self, device: torch.device) -> Tuple[torch.LongTensor, torch.BoolTensor]:
+        """The sequence table and its mask on the device. Copied once per device."""
+
+        if device not in self._tables:
+            self._tables[device] = (self._ids.to(device), self._mask.to(device))
+
+        return self._tables[device]
+
+
+    def match(self, windows: torch.LongTensor) -> torch.LongTensor:
+        """Match the stop sequences at the end of each window.
+
+        Args:
+            windows (torch.LongTensor): Tensor of shape [..., window] with the latest tokens at the end.
+
+        Returns:
+            torch.LongTensor: Tensor of shape [...] with the index of the matched stop sequence or -1 if none.
+        """
+
+        ids, mask = self._get_table(windows.device)
+
+        #[..., num_sequences, window] -> [..., num_sequences]
+        is_matched = ((windows.unsqueeze(-2) == ids) | ~mask).all(dim=-1)
+
+        return torch.where(is_matched.any(dim=-1), is_matched.int().argmax(dim=-1), _NO_TOKEN)
+
+
+    def empty_windows(self, batch_size: int, device: Optional[torch.device] = None) -> torch.LongTensor:
+        """Windows of the sequences which haven't generated a token yet."""
+
+        return torch.full((batch_size, self.window), _NO_TOKEN, dtype=torch.long, device=device)
+
+
+    @staticmethod
+    def push(windows: torch.LongTensor, tokens: torch.LongTensor) -> torch.LongTensor:
+        """Slide the windows of shape [batch, window] by a new token of each row."""
+
+        return torch.cat([windows[:, 1:], tokens.to(windows.device).unsqueeze(1)], dim=1)
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """
+    A stopping criteria for huggingface generate which stops each row of the batch independently once it generates
+    a stop sequence. Every call matches only the tokens added since the previous call, which is a single token per
+    step or the accepted tokens of a step in speculative decoding, so the cost per step doesn't grow with the sequence.
+    The prompt tokens are never matched.
+
+    Args:
+        matcher (StopSequenceMatcher): Matcher of the stop sequences.
+        prompt_length (int): Number of prompt tokens at the start of each row.
+    """
+
+    def __init__(self, matcher: StopSequenceMatcher, prompt_length: int):
+        super().__init__()
+
+        self._matcher = matcher
+        self._prompt_length = prompt_length
+        self._checked_length = prompt_length
+
+        #Index of the stop sequence matched by each row or -1.
+        self.matched_sequences: Optional[torch.LongTensor] = None
+
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        """
+        Check if the tokens added to each row since the last call complete a stop sequence.
+
+        Args:
+            input_ids (torch.LongTensor): The prompt and generated token ids of shape [batch, sequence].
+            scores (torch.FloatTensor): The scores of the generated tokens.
+
+        Returns:
+            torch.BoolTensor: Whether each row has generated a stop sequence.
+        """
+
+        batch_size, length = input_ids.shape
+        if self.matched_sequences is None:
+            self.matched_sequences = torch.full((batch_size,), _NO_TOKEN, dtype=torch.long, device=input_ids.device)
+
+        if length <= self._checked_length:
+            return torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+
+        #Window of every new position. The prompt tokens in them are replaced so they never match.
+        start = max(self._checked_length - self._matcher.window + 1, 0)
+        tokens = input_ids[:, start:].masked_fill(
+            torch.arange(start, length, device=input_ids.device) < self._prompt_length, _NO_TOKEN
+        )
+        tokens = F.pad(tokens, (self._matcher.window - 1 - (self._checked_length - start), 0), value=_NO_TOKEN)
+        self._checked_length = length
+
+        #[batch, new tokens, window] -> [batch, new tokens]
+        matched = self._matcher.match(tokens.unfold(1, self._matcher.window, 1))
+        is_matched = matched >= 0
+        is_done = is_matched.any(dim=1)
+
+        #Record the stop sequence at the earliest matched position of the rows stopping now.
+        first_match = matched.gather(1, is_matched.int().argmax(dim=1, keepdim=True))[:, 0]
+        self.matched_sequences = torch.where(self.matched_sequences < 0, first_match, self.matched_sequences)
+
+        return is_done
@@ -0,0 +1,438 @@
+import time
+import bisect
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from src.constants import *
+
+#Buckets in seconds of the stage latencies and the time to first token. From sub millisecond prompt building to slow generations.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#Buckets in seconds of the latency between the streamed tokens.
+TOKEN_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """
+    Base of the metric families. A family holds a series for every combination of its label values.
+
+    Args:
+        name (str): Name of the metric.
+        documentation (str): Help text of the metric.
+        labelnames (Sequence[str], optional): Names of the labels. Defaults to ().
+    """
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+
+    def _check_labels(self, labelvalues: LabelValues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {labelvalues}")
+
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """Yields the name suffix, the formatted labels and the value of every sample."""
+
+        raise NotImplementedError
+
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(f"{self.name}{suffix}{labels} {_format_value(value)}" for suffix, labels, value in self.samples())
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing count. Its rate() gives the throughput, Eg: the tokens per second."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+
+    def inc(self, amount: float = 1.0, *labelvalues: str):
+        self._check_labels(labelvalues)
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        with self._lock:
+            values = list(self._values.items())
+
+        for labelvalues, value in values:
+            yield "_total", _format_labels(self.labelnames, labelvalues), value
+
+
+class Gauge(Metric):
+    """Value which goes up and down. A series is either set directly or read from a function at every scrape."""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._functions: Dict[LabelValues, Callable[[], float]] = {}
+
+
+    def set(self, value: float, *labelvalues: str):
+        self._check_labels(labelvalues)
+        with self._lock:
+            self._values[labelvalues] = value
+
+
+    def inc(self, amount: float = 1.0, *labelvalues: str):
+        self._check_labels(labelvalues)
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+
+    def dec(self, amount: float = 1.0, *labelvalues: str):
+        self.inc(-amount, *labelvalues)
+
+
+    def set_function(self, function: Callable[[], float], *labelvalues: str):
+        """Read the value of the series from the function at every scrape. Eg: the depth of a queue."""
+
+        self._check_labels(labelvalues)
+        with self._lock:
+            self._functions[labelvalues] = function
+
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        with self._lock:
+            values = dict(self._values)
+            functions = list(self._functions.items())
+
+        for labelvalues, function in functions:
+            try:
+                values[labelvalues] = function()
+            except Exception:
+                continue
+
+        for labelvalues, value in values.items():
+            yield "", _format_labels(self.labelnames, labelvalues), value
+
+
+class Histogram(Metric):
+    """
+    Distribution of the observed values over fixed buckets. An observation costs a binary search and a locked
+    increment, so it can be recorded on every request and every token.
+
+    Args:
+        buckets (Sequence[float], optional): Upper bounds of the buckets. Defaults to LATENCY_BUCKETS.
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, List] = {} #Count of each bucket along with the +Inf bucket, the sum and the count.
+
+
+    def observe(self, value: float, *labelvalues: str):
+        self._check_labels(labelvalues)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        with self._lock:
+            series = [(labelvalues, list(counts), total, count) for labelvalues, (counts, total, count) in self._series.items()]
+
+        for labelvalues, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ("le",), labelvalues + (_format_value(bound),))
+                yield "_bucket", labels, cumulative
+
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+class RateMeter:
+    """
+    Rate of the recorded amounts over a sliding window, Eg: the tokens generated per second. The amounts are
+    summed into one slot per second so that the memory doesn't grow with the throughput.
+
+    Args:
+        window_seconds (float, optional): Length of the window. Defaults to METRICS_RATE_WINDOW_SECONDS.
+        clock (Callable[[], float], optional): Source of the time in seconds. Defaults to time.monotonic.
+    """
+
+    def __init__(self, window_seconds: float = METRICS_RATE_WINDOW_SECONDS, clock: Callable[[], float] = time.monotonic):
+        self.window_seconds = window_seconds
+        self._clock = clock
+        self._slots = deque() #(second, amount) of the seconds with any amount recorded.
+        self._lock = threading.Lock()
+
+
+    def _expire(self, now: float):
+        while self._slots and self._slots[0][0] <= now - self.window_seconds:
+            self._slots.popleft()
+
+
+    def add(self, amount: float):
+        now = self._clock()
+        second = int(now)
+
+        with self._lock:
+            if self._slots and self._slots[-1][0] == second:
+                self._slots[-1][1] += amount
+            else:
+                self._slots.append([second, amount])
+            self._expire(now)
+
+
+    def rate(self) -> float:
+        with self._lock:
+            self._expire(self._clock())
+            return sum(amount for _, amount in self._slots) / self.window_seconds
+
+
+class StreamTracker:
+    """
+    Tracks a single streamed response from the arrival of its request. Records the time to first token and the
+    latency between the tokens, and keeps the in progress requests and the active streams up to date.
+    Closed once the response is complete or the client goes away.
+    """
+
+    def __init__(self, metrics: "ServingMetrics"):
+        self._metrics = metrics
+        self._start_time = time.perf_counter()
+        self._last_token_time = None
+        self._is_closed = False
+
+        metrics.requests_in_progress.inc()
+
+
+    def on_token(self):
+        """Record the arrival of the next token or chunk of tokens of the response."""
+
+        now = time.perf_counter()
+
+        if self._last_token_time is None:
+            self._metrics.time_to_first_token.observe(now - self._start_time)
+            self._metrics.active_streams.inc()
+        else:
+            self._metrics.inter_token_latency.observe(now - self._last_token_time)
+
+        self._last_token_time = now
+
+
+    def close(self):
+        if self._is_closed:
+            return
+
+        self._is_closed = True
+        self._metrics.requests_in_progress.dec()
+        if self._last_token_time is not None:
+            self._metrics.active_streams.dec()
+
+
+    def __enter__(self) -> "StreamTracker":
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ServingMetrics:
+    """
+    Metrics of the chatbot served in the prometheus text format:
+        - diya_stage_latency_seconds: Latency of each stage of a request. The stages are prompt_building,
+          history_trimming, tokenization, generation, stream_answer and prompt_logging.
+        - diya_time_to_first_token_seconds and diya_inter_token_latency_seconds of the streamed responses.
+        - diya_requests_in_progress, diya_active_streams and diya_queue_depth of each queue.
+        - diya_generated_tokens_total and diya_tokens_per_second over the last METRICS_RATE_WINDOW_SECONDS.
+        - diya_response_cache_lookups_total of each result, Eg: memory_hit, disk_hit or miss.
+        - diya_api_stream_events_total of each event of the API's streams, Eg: retries, hedges, hedge_wins,
+          first_token_timeouts and deadline_exceeded.
+        - diya_stop_string_hits_total of each backend and stop string and diya_stop_string_saved_tokens_total of
+          each backend.
+    """
+
+    def __init__(self):
+        self.stage_latency = Histogram("diya_stage_latency_seconds", "Latency of each stage of a request.", ("stage",))
+        self.time_to_first_token = Histogram("diya_time_to_first_token_seconds", "Time from the request to the first streamed token.")
+        self.inter_token_latency = Histogram(
+            "diya_inter_token_latency_seconds", "Time between the streamed tokens of a response.", buckets=TOKEN_LATENCY_BUCKETS
+        )
+        self.requests_in_progress = Gauge("diya_requests_in_progress", "Requests being answered, including the ones waiting for the first token.")
+        self.active_streams = Gauge("diya_active_streams", "Responses which are being streamed.")
+        self.queue_depth = Gauge("diya_queue_depth", "Items waiting in each queue.", ("queue",))
+        self.generated_tokens = Counter("diya_generated_tokens", "Tokens generated.")
+        self.tokens_per_second = Gauge("diya_tokens_per_second", f"Tokens generated per second over the last {METRICS_RATE_WINDOW_SECONDS:g} seconds.")
+        self.response_cache_lookups = Counter("diya_response_cache_lookups", "Lookups of the response cache by thier result.", ("result",))
+        self.api_stream_events = Counter("diya_api_stream_events", "Requests, retries, hedges and timeouts of the API's streams.", ("event",))
+        self.stop_string_hits = Counter("diya_stop_string_hits", "Responses stopped at each stop string.", ("backend", "stop_string"))
+        self.stop_string_saved_tokens = Counter("diya_stop_string_saved_tokens", "Tokens not generated since the responses were stopped early.", ("backend",))
+
+        self._token_rate = RateMeter()
+        self.tokens_per_second.set_function(self._token_rate.rate)
+
+        self._metrics: List[Metric] = [
+            self.stage_latency,
+            self.time_to_first_token,
+            self.inter_token_latency,
+            self.requests_in_progress,
+            self.active_streams,
+            self.queue_depth,
+            self.generated_tokens,
+            self.tokens_per_second,
+            self.response_cache_lookups,
+            self.api_stream_events,
+            self.stop_string_hits,
+            self.stop_string_saved_tokens,
+        ]
+
+
+    @contextmanager
+    def time_stage(self, stage: str) -> Iterator[None]:
+        """Time the block as the stage. Recorded even if the block fails or the generator it is in is closed."""
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_latency.observe(time.perf_counter() - start_time, stage)
+
+
+    def track_stream(self) -> StreamTracker:
+        """Start tracking a streamed response. Create it on the arrival of the request."""
+
+        return StreamTracker(self)
+
+
+    def record_tokens(self, num_tokens: int):
+        self.generated_tokens.inc(num_tokens)
+        self._token_rate.add(num_tokens)
+
+
+    def register_queue(self, queue_name: str, get_depth: Callable[[], int]):
+        """Report the depth of the queue read from get_depth at every scrape."""
+
+        self.queue_depth.set_function(get_depth, queue_name)
+
+
+    def render(self) -> str:
+        """Returns the metrics in the prometheus text exposition format."""
+
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    metrics: ServingMetrics = None
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format: str, *args):
+        """Scrapes are not logged."""
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+_metrics_server = None
+
+
+def get_metrics() -> ServingMetrics:
+    """Returns the metrics shared by the whole process."""
+
+    global _metrics
+
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = ServingMetrics()
+
+    return _metrics
+
+
+def start_metrics_server(port: Optional[int] = METRICS_PORT, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """Serve the metrics at /metrics from a background thread. The server is started only once per process.
+       The app runs without the metrics endpoint if the port can't be bound, Eg: when it is already taken.
+
+    Args:
+        port (int, optional): Port of the metrics endpoint. Disabled if None. Defaults to METRICS_PORT.
+        host (str, optional): Host to bind to. Defaults to METRICS_HOST.
+
+    Returns:
+        Optional[ThreadingHTTPServer]: The metrics server, None if disabled or if the port can't be bound.
+    """
+
+    global _metrics_server
+
+    if port is None:
+        return None
+
+    metrics = get_metrics()
+
+    with _metrics_lock:
+        if _metrics_server is None:
+            handler = type("MetricsRequestHandler", (_MetricsRequestHandler,), {"metrics": metrics})
+            try:
+                _metrics_server = ThreadingHTTPServer((host, port), handler)
+            except OSError:
+                #Imported here since src.utils imports this module.
+                from src.utils import create_logger
+                create_logger(LOGFILE_PATH).warning(f"Couldn't serve the metrics on {host}:{port}. Continuing without the metrics endpoint", exc_info=True)
+                return None
+            _metrics_server.daemon_threads = True
+            threading.Thread(target=_metrics_server.serve_forever, name="metrics-server", daemon=True).start()
+
+    return _metrics_server
@@ -0,0 +1,253 @@
+import os
+import sys
+import time
+import uuid
+import functools
+import itertools
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from types import FrameType
+from typing import Callable, ContextManager, Dict, Iterator, Optional, Set, Tuple, TypeVar, TYPE_CHECKING
+
+from src.constants import *
+from src.utils import create_logger
+
+if TYPE_CHECKING:
+    import gradio as gr
+
+logger = create_logger(LOGFILE_PATH)
+
+T = TypeVar("T")
+
+#Deepest frames kept of a stack. Deeper stacks are cut at the root.
+MAX_STACK_DEPTH = 128
+
+
+def get_frame_name(frame: FrameType) -> str:
+    """Name of a frame as 'function (package/module.py:line)'. Only the last two parts of the path are kept."""
+
+    code = frame.f_code
+    path = "/".join(code.co_filename.replace("\\", "/").rsplit("/", 2)[-2:])
+
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+def collapse_stack(thread_name: str, frame: Optional[FrameType]) -> str:
+    """Collapse the stack of a thread into a single line of frames from the root to the leaf separated by ';'."""
+
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        names.append(get_frame_name(frame).replace(";", ":"))
+        frame = frame.f_back
+    names.append(thread_name.replace(";", ":").replace(" ", "_"))
+
+    return ";".join(reversed(names))
+
+
+class RequestProfile:
+    """
+    Stacks sampled while a single request is served. Samples the threads serving the request along with the
+    background threads whose name starts with any of the given prefixes, Eg: the generation scheduler. Background
+    threads shared by the concurrent requests are sampled as a whole.
+
+    Args:
+        name (str): Name of the profiled entry point. Used in the name of the profile's file.
+        background_thread_prefixes (Tuple[str, ...], optional): Prefixes of the background threads to sample. Defaults to ().
+    """
+
+    def __init__(self, name: str, background_thread_prefixes: Tuple[str, ...] = ()):
+        self.name = name
+        self.background_thread_prefixes = tuple(background_thread_prefixes)
+        self.request_id = uuid.uuid4().hex[:8]
+        self.stacks = Counter()
+        self.num_samples = 0
+        self.start_time = time.perf_counter()
+
+        self._thread_ids: Set[int] = {threading.get_ident()}
+
+
+    def add_thread(self, thread_id: int):
+        self._thread_ids.add(thread_id)
+
+
+    def discard_thread(self, thread_id: int):
+        self._thread_ids.discard(thread_id)
+
+
+    def sample(self, frames: Dict[int, FrameType], thread_names: Dict[int, str]):
+        """Count the current stack of every profiled thread."""
+
+        for thread_id, frame in frames.items():
+            thread_name = thread_names.get(thread_id, str(thread_id))
+            if thread_id in self._thread_ids or (self.background_thread_prefixes and thread_name.startswith(self.background_thread_prefixes)):
+                self.stacks[collapse_stack(thread_name, frame)] += 1
+
+        self.num_samples += 1
+
+
+    def save(self, profile_dir: str = PROFILE_DIR) -> str:
+        """Write the stacks in the collapsed format read by flamegraph.pl, speedscope and the like.
+
+        Returns:
+            str: Path of the profile.
+        """
+
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, f"{time.strftime('%Y%m%d_%H%M%S')}_{self.name}_{self.request_id}.collapsed")
+
+        with open(path, "w") as file:
+            file.write("".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()))
+
+        return path
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the profiled requests from a single background thread at a fixed interval. The thread
+    runs only while there are requests being profiled, so nothing is sampled when profiling is idle.
+
+    Args:
+        interval_seconds (float, optional): Time between the samples. Defaults to PROFILE_INTERVAL_SECONDS.
+    """
+
+    def __init__(self, interval_seconds: float = PROFILE_INTERVAL_SECONDS):
+        self.interval_seconds = interval_seconds
+
+        self._profiles: Set[RequestProfile] = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+
+    def start(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+
+
+    def stop(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles.discard(profile)
+
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+                profiles = list(self._profiles)
+
+            frames = sys._current_frames()
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for profile in profiles:
+                profile.sample(frames, thread_names)
+            del frames
+
+            time.sleep(self.interval_seconds)
+
+
+def remove_old_profiles(profile_dir: str = PROFILE_DIR, max_files: int = PROFILE_MAX_FILES):
+    """Keep only the latest max_files profiles in the directory."""
+
+    try:
+        paths = [entry.path for entry in os.scandir(profile_dir) if entry.name.endswith(".collapsed")]
+    except FileNotFoundError:
+        return
+
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[max_files:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_profiler = SamplingProfiler()
+_request_counter = itertools.count(1)
+_NOT_PROFILED = nullcontext()
+
+
+def should_profile(force: bool = False) -> bool:
+    """Whether to profile the next request. Profiles every request if PROFILE_ALL_REQUESTS is set, one in
+       PROFILE_EVERY_N_REQUESTS requests if set and the requests which asks for it with force."""
+
+    if force or PROFILE_ALL_REQUESTS:
+        return True
+
+    return PROFILE_EVERY_N_REQUESTS > 0 and next(_request_counter) % PROFILE_EVERY_N_REQUESTS == 0
+
+
+def is_profile_requested(request: Optional['gr.Request']) -> bool:
+    """Whether the client asked for its request to be profiled by setting the PROFILE_REQUEST_HEADER to 1.
+
+    Args:
+        request (gr.Request, optional): Request gradio passes to the UI's predict function. None for the examples.
+    """
+
+    if request is None or request.headers is None:
+        return False
+
+    return request.headers.get(PROFILE_REQUEST_HEADER, "0").strip() == "1"
+
+
+def profile_request(
+    name: str,
+    force: bool = False,
+    background_thread_prefixes: Tuple[str, ...] = (),
+) -> ContextManager[Optional[RequestProfile]]:
+    """Profile the block if the request is picked for profiling. The profile is saved under PROFILE_DIR once
+       the block exits. When the request isn't picked nothing is sampled and None is given to the block.
+
+    Args:
+        name (str): Name of the profiled entry point.
+        force (bool, optional): Profile this request regardless of the sampling rate. Defaults to False.
+        background_thread_prefixes (Tuple[str, ...], optional): Prefixes of the background threads to sample along
+                                                                with the request's thread. Defaults to ().
+    """
+
+    #Requests which aren't profiled share a no-op context, so that profiling costs next to nothing when off.
+    if not should_profile(force):
+        return _NOT_PROFILED
+
+    return _profile(RequestProfile(name, background_thread_prefixes))
+
+
+@contextmanager
+def _profile(profile: RequestProfile) -> Iterator[RequestProfile]:
+    """Sample the stacks of the request while the block runs and save them once it exits."""
+
+    _profiler.start(profile)
+    try:
+        yield profile
+    finally:
+        _profiler.stop(profile)
+        try:
+            path = profile.save()
+            remove_old_profiles()
+            logger.info(
+                f"Saved the profile of {profile.num_samples} samples over {time.perf_counter() - profile.start_time:.2f} s onto {path}"
+            )
+        except OSError:
+            logger.exception("Failed to save the profile of the request")
+
+
+def run_profiled(profile: Optional[RequestProfile], function: Callable[..., T]) -> Callable[..., T]:
+    """Wrap the function so that the thread it runs on, Eg: a worker thread, is sampled into the profile while it runs.
+       The function is returned as is if the request isn't profiled."""
+
+    if profile is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        thread_id = threading.get_ident()
+        profile.add_thread(thread_id)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.discard_thread(thread_id)
+
+    return wrapper
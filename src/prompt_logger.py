@@ -0,0 +1,379 @@
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from src.constants import *
+from src.utils import create_logger, log_prompt
+from src.metrics import get_metrics
+
+logger = create_logger(LOGFILE_PATH)
+
+LogRecord = Union[Dict[str, Any], Callable[[], Dict[str, Any]]]
+
+
+class BackgroundPromptLogger:
+    """
+    Logs the prompts onto the sink (comet-ml by default) from a single background thread, so that
+    logging never adds latency to a response nor creates a thread per request.
+
+    Records are queued on a bounded queue and are taken off it in groups when the group is full or the flush
+    interval has elapsed. The sink logs a single record per call, so the records of a group are logged one at a time.
+    When the sink fails or is slow, the records are spooled onto a local file and are replayed once the sink is
+    healthy again. The pending records are flushed on shutdown.
+
+    When the queue is full the record is put on a bounded overflow buffer which the background thread drains,
+    either onto the spool file or onto the sink as per the overflow policy. The record is dropped if the overflow
+    buffer is full too. The caller never waits, prepares a record or touches the disk.
+
+    A record is either the log dictionary or a callable which builds it. Callables are run on the background thread,
+    so that the work needed to prepare a record is also kept out of the response path.
+
+    Args:
+        sink (Callable[[Dict[str, Any]], None], optional): Function which logs a single record. Defaults to log_prompt.
+        max_queue_size (int, optional): Maximum number of records waiting to be logged. Defaults to PROMPT_LOG_QUEUE_SIZE.
+        batch_size (int, optional): Maximum number of records taken off the queue at once. Defaults to PROMPT_LOG_BATCH_SIZE.
+        flush_interval_seconds (float, optional): Maximum time a record waits for its group to fill. Defaults to PROMPT_LOG_FLUSH_SECONDS.
+        overflow_policy (str, optional): One of 'spool', 'drop' or 'buffer'. Defaults to PROMPT_LOG_OVERFLOW_POLICY.
+        max_overflow_size (int, optional): Maximum number of records on the overflow buffer. Defaults to PROMPT_LOG_OVERFLOW_SIZE.
+        spool_path (str, optional): Path of the local spool file. Defaults to PROMPT_LOG_SPOOL_PATH.
+        slow_sink_seconds (float, optional): A sink call longer than this is treated as a slow sink. Defaults to PROMPT_LOG_SLOW_SINK_SECONDS.
+        retry_seconds (float, optional): Time to spool the records for before trying a failed or slow sink again. Defaults to PROMPT_LOG_RETRY_SECONDS.
+    """
+
+    def __init__(
+        self,
+        sink: Callable[[Dict[str, Any]], None] = log_prompt,
+        max_queue_size: int = PROMPT_LOG_QUEUE_SIZE,
+        batch_size: int = PROMPT_LOG_BATCH_SIZE,
+        flush_interval_seconds: float = PROMPT_LOG_FLUSH_SECONDS,
+        overflow_policy: str = PROMPT_LOG_OVERFLOW_POLICY,
+        max_overflow_size: int = PROMPT_LOG_OVERFLOW_SIZE,
+        spool_path: str = PROMPT_LOG_SPOOL_PATH,
+        slow_sink_seconds: float = PROMPT_LOG_SLOW_SINK_SECONDS,
+        retry_seconds: float = PROMPT_LOG_RETRY_SECONDS,
+    ):
+        if overflow_policy not in ("spool", "drop", "buffer"):
+            raise ValueError(f"Invalid overflow policy {overflow_policy}. Use one of 'spool', 'drop' or 'buffer'.")
+
+        self._sink = sink
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.overflow_policy = overflow_policy
+        self.max_overflow_size = max_overflow_size
+        self._overflow = deque() #Records which didn't fit in the queue, drained by the background thread.
+        self.spool_path = spool_path
+        self.slow_sink_seconds = slow_sink_seconds
+        self.retry_seconds = retry_seconds
+
+        self._spool_lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+        self._sink_retry_at = 0.0 #Sink is not called untill this time after a failure.
+        self._closed = threading.Event()
+
+        self._metrics = {
+            "enqueued": 0,
+            "overflowed": 0,
+            "logged": 0,
+            "dropped": 0,
+            "spooled": 0,
+            "replayed": 0,
+            "corrupt": 0,
+            "sink_errors": 0,
+            "slow_sink_calls": 0,
+            "flushes": 0,
+        }
+
+        self._thread = threading.Thread(target=self._run, name="prompt-logger", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+
+    def _count(self, metric: str, value: int = 1):
+        with self._counter_lock:
+            self._metrics[metric] += value
+
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the counters of the logged, dropped and spooled records."""
+
+        with self._counter_lock:
+            return {**self._metrics, "queue_depth": self.queue_depth}
+
+
+    def submit(self, record: LogRecord):
+        """Queue a record to be logged. Never waits, never prepares the record and never touches the disk, since
+           it is called on the response path.
+
+        Args:
+            record (LogRecord): The log dictionary or a callable which builds it.
+        """
+
+        if self._closed.is_set():
+            logger.warning("Prompt logger is closed. Dropping the prompt log record.")
+            self._count("dropped")
+            return
+
+        try:
+            self._queue.put_nowait(record)
+            self._count("enqueued")
+        except queue.Full:
+            #The length check races with the background thread draining the buffer, which only lets it shrink.
+            if self.overflow_policy != "drop" and len(self._overflow) < self.max_overflow_size:
+                self._overflow.append(record)
+                self._count("overflowed")
+            else:
+                self._count("dropped")
+
+
+    def _drain_overflow(self):
+        """Spool or log the records of the overflow buffer as per the overflow policy. Runs on the background thread."""
+
+        records = []
+        while self._overflow:
+            records.append(self._overflow.popleft())
+
+        if not records:
+            return
+
+        if self.overflow_policy == "spool":
+            self._spool(records)
+        else:
+            for start in range(0, len(records), self.batch_size):
+                self._flush(records[start:start+self.batch_size])
+
+
+    def _spool(self, records: List[LogRecord]):
+        """Append the records to the local spool file."""
+
+        lines = []
+        for record in records:
+            try:
+                lines.append(json.dumps(record() if callable(record) else record, default=str))
+            except Exception:
+                logger.exception("Failed to prepare the prompt log record. Dropping it.")
+                self._count("dropped")
+
+        if not lines:
+            return
+
+        with self._spool_lock:
+            os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+            with open(self.spool_path, "ab") as spool_file:
+                #A line left truncated by a crash is ended first, so that it doesn't swallow the next record.
+                if spool_file.tell() and not self._ends_with_newline():
+                    spool_file.write(b"\n")
+                spool_file.write(("\n".join(lines) + "\n").encode("utf-8"))
+
+        self._count("spooled", len(lines))
+
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.spool_path, "rb") as spool_file:
+            spool_file.seek(-1, os.SEEK_END)
+            return spool_file.read(1) == b"\n"
+
+
+    def _is_sink_available(self) -> bool:
+        return time.time() >= self._sink_retry_at
+
+
+    def _log_records(self, records: List[LogRecord]) -> List[LogRecord]:
+        """Log the records onto the sink untill it fails or turns slow.
+
+        Returns:
+            List[LogRecord]: Records which are not logged.
+        """
+
+        for index, record in enumerate(records):
+            if not self._is_sink_available():
+                return records[index:]
+
+            #Preparing the record and the sink call are timed together as the prompt logging.
+            with get_metrics().time_stage("prompt_logging"):
+                try:
+                    record = record() if callable(record) else record
+                except Exception:
+                    logger.exception("Failed to prepare the prompt log record. Dropping it.")
+                    self._count("dropped")
+                    continue
+
+                start_time = time.time()
+                try:
+                    self._sink(record)
+                except Exception:
+                    logger.exception("Failed to log the prompt. Spooling the records untill the sink recovers.")
+                    self._count("sink_errors")
+                    self._sink_retry_at = time.time() + self.retry_seconds
+                    return [record] + records[index+1:]
+
+            self._count("logged")
+
+            #Stop calling a slow sink for a while so that the queue doesn't back up behind it.
+            if time.time() - start_time > self.slow_sink_seconds:
+                logger.warning("Prompt logging sink is slow. Spooling the records for a while.")
+                self._count("slow_sink_calls")
+                self._sink_retry_at = time.time() + self.retry_seconds
+
+        return []
+
+
+    def _flush(self, records: List[LogRecord]):
+        """Log the records and spool the ones that couldn't be logged."""
+
+        self._count("flushes")
+        remaining_records = self._log_records(records)
+        if remaining_records:
+            self._spool(remaining_records)
+
+
+    def _read_spool(self) -> Tuple[List[Dict[str, Any]], int]:
+        """Parse the spooled records line by line. Lines which aren't valid records, Eg: a line left truncated by a
+           crash while spooling, are moved onto the quarantine file so that they don't hold back the other records.
+
+        Returns:
+            Tuple[List[Dict[str, Any]], int]: The records and the offset of the spool file upto which they are read.
+        """
+
+        records, corrupt_lines = [], []
+        with open(self.spool_path) as spool_file:
+            for line in spool_file:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    corrupt_lines.append(line if line.endswith("\n") else line + "\n")
+            spooled_offset = spool_file.tell()
+
+        if corrupt_lines:
+            logger.warning(f"Moving {len(corrupt_lines)} corrupt prompt log records onto {self.spool_path}.corrupt")
+            with open(self.spool_path + ".corrupt", "a") as corrupt_file:
+                corrupt_file.write("".join(corrupt_lines))
+            self._count("corrupt", len(corrupt_lines))
+
+        return records, spooled_offset
+
+
+    def _replay_spool(self):
+        """Log the spooled records once the sink is available again. The spool file is rewritten only after the
+           records are logged, so a crash during the replay logs them again on the next start instead of losing them.
+           The spool file is removed once all its records are logged."""
+
+        if not self._is_sink_available() or not os.path.exists(self.spool_path):
+            return
+
+        with self._spool_lock:
+            if not os.path.getsize(self.spool_path):
+                os.remove(self.spool_path)
+                return
+            records, replayed_offset = self._read_spool()
+
+        remaining_records = self._log_records(records)
+        self._count("replayed", len(records) - len(remaining_records))
+
+        #Keep the records which couldn't be logged and the ones spooled during the replay.
+        with self._spool_lock:
+            with open(self.spool_path) as spool_file:
+                spool_file.seek(replayed_offset)
+                spooled_lines = spool_file.read()
+
+            if not remaining_records and not spooled_lines:
+                os.remove(self.spool_path)
+                return
+
+            temporary_path = self.spool_path + ".tmp"
+            with open(temporary_path, "w") as spool_file:
+                spool_file.write("".join(json.dumps(record, default=str) + "\n" for record in remaining_records) + spooled_lines)
+            os.replace(temporary_path, self.spool_path)
+
+
+    def _collect_batch(self) -> List[LogRecord]:
+        """Wait for the records untill the group is full or the flush interval has elapsed."""
+
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval_seconds)]
+        except queue.Empty:
+            return []
+
+        deadline = time.time() + self.flush_interval_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+
+    def _run(self):
+        """Background loop which flushes the queued records, drains the overflow buffer and replays the spool."""
+
+        while not self._closed.is_set():
+            batch = self._collect_batch()
+            if batch:
+                self._flush(batch)
+
+            self._drain_overflow()
+
+            try:
+                self._replay_spool()
+            except Exception:
+                logger.exception("Failed to replay the spooled prompt logs")
+
+
+    def close(self, timeout: Optional[float] = PROMPT_LOG_SHUTDOWN_SECONDS):
+        """Stop the background thread and flush the pending records. Records which couldn't be
+           logged are spooled so that they are logged on the next start.
+
+        Args:
+            timeout (float, optional): Maximum time to wait for the background thread. Defaults to PROMPT_LOG_SHUTDOWN_SECONDS.
+        """
+
+        if self._closed.is_set():
+            return
+
+        self._closed.set()
+        self._thread.join(timeout)
+
+        pending_records = []
+        while True:
+            try:
+                pending_records.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if pending_records:
+            self._flush(pending_records)
+
+        self._drain_overflow()
+
+
+_prompt_logger = None
+_prompt_logger_lock = threading.Lock()
+
+
+def get_prompt_logger() -> BackgroundPromptLogger:
+    """Returns the background prompt logger shared by the whole process."""
+
+    global _prompt_logger
+
+    with _prompt_logger_lock:
+        if _prompt_logger is None:
+            _prompt_logger = BackgroundPromptLogger()
+            get_metrics().register_queue("prompt_logger", lambda: _prompt_logger.queue_depth)
+
+    return _prompt_logger
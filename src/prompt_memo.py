@@ -0,0 +1,229 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union, TYPE_CHECKING
+
+from src.constants import *
+from src.metrics import get_metrics
+from src.utils import MessagePairSelector, get_template_overhead, count_message_pair_tokens
+
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+
+#Approximate memory of a memoized pair apart from its text. Eg: the message objects and its token count.
+PAIR_OVERHEAD_BYTES = 512
+
+#Builds the prompt messages of the past (query, response) pair at the index of the conversation.
+PairTemplate = Callable[[int, str, str], List[Any]]
+
+
+def get_history_keys(chat_history: List[Tuple[str, str]], start: int = 0) -> List[bytes]:
+    """Rolling hash of the prefixes of the chat history with atleast start pairs. The key of a prefix is the
+       running sha256 of its pairs, so the key of the next prefix is computed by hashing the next pair alone.
+
+    Args:
+        chat_history (List[Tuple[str, str]]): Past conversation as (query, response) pairs.
+        start (int, optional): Number of pairs in the shortest prefix. The pairs before start are hashed in one go. Defaults to 0.
+
+    Returns:
+        List[bytes]: Keys of the prefixes of start pairs upto the whole history.
+    """
+
+    hasher = hashlib.sha256("".join(f"{question}\0{response}\0" for question, response in chat_history[:start]).encode("utf-8"))
+    keys = [hasher.digest()]
+
+    for question, response in chat_history[start:]:
+        hasher.update(f"{question}\0{response}\0".encode("utf-8"))
+        keys.append(hasher.digest())
+
+    return keys
+
+
+class PromptMemo:
+    """
+    Memoizes the prompt messages built for the chat history across the turns of a conversation. The UI sends the
+    whole history on every turn though only a single pair is added since the previous turn, so the messages built
+    for the history, the token count of each pair and the trimming decision are kept against the rolling hash of
+    the history. A new turn extends the entry of the longest memoized prefix of its history and so only the new
+    pairs are templated and tokenized.
+
+    The trimmed messages are the same as templating every pair and filtering them with filter_old_messages.
+    Entries are evicted in least recently used order when the memory of the memoized history exceeds the budget.
+    The messages of an entry are shared with the entries of the earlier turns but the size of an entry counts
+    all of its history, so the memo never holds more than the budget. A memo must be used with a single tokenizer
+    and pair template.
+
+    Args:
+        max_bytes (int, optional): Memory budget for all the memoized history. Defaults to PROMPT_MEMO_MAX_BYTES.
+        max_tokens (int, optional): Token budget for the chat history in the prompt. Defaults to MAX_ACCEPTED_TOKENS.
+    """
+
+    def __init__(self, max_bytes: int = PROMPT_MEMO_MAX_BYTES, max_tokens: int = MAX_ACCEPTED_TOKENS):
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+
+        self._entries = OrderedDict() #history key -> (messages, selector, size_in_bytes)
+        self._lock = threading.Lock()
+        self._template_overhead = None
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.extensions = 0
+        self.misses = 0
+        self.evictions = 0
+        self.templated_pairs = 0
+
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+    def _lookup(
+        self,
+        chat_history: List[Tuple[str, str]],
+        history_keys: Optional[Tuple[bytes, bytes]] = None
+    ) -> Tuple[bytes, int, Optional[Tuple[List[Any], MessagePairSelector, int]]]:
+        """Find the entry of the longest memoized prefix of the history. The whole history and the history of the
+           previous turn are looked up first and every other prefix is looked up only if both are missing.
+
+        Returns:
+            Tuple[bytes, int, Optional[Tuple]]: Key of the whole history, number of pairs in the memoized prefix
+                                                and its entry. The entry is None if nothing is memoized.
+        """
+
+        num_pairs = len(chat_history)
+        keys = history_keys if history_keys is not None else get_history_keys(chat_history, num_pairs - 1)
+        found = self._find([(num_pairs, keys[1]), (num_pairs - 1, keys[0])])
+
+        if found is None and num_pairs > 2:
+            #The history was edited or its latest prefixes were evicted. Look up the rest of its prefixes.
+            earlier_keys = get_history_keys(chat_history[:num_pairs - 2])
+            found = self._find([(index, earlier_keys[index]) for index in range(num_pairs - 2, 0, -1)])
+
+        num_memoized_pairs, entry = found if found is not None else (0, None)
+
+        return keys[-1], num_memoized_pairs, entry
+
+
+    def _find(self, candidates: List[Tuple[int, bytes]]) -> Optional[Tuple[int, Tuple[List[Any], MessagePairSelector, int]]]:
+        """The first memoized prefix among the (number of pairs, key) candidates and its entry."""
+
+        with self._lock:
+            for num_pairs, key in candidates:
+                entry = self._entries.get(key) if num_pairs else None
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    return num_pairs, entry
+
+        return None
+
+
+    def _put(self, key: bytes, messages: List[Any], selector: MessagePairSelector, size_in_bytes: int):
+        """Memoize the entry and evict the least recently used entries if the budget is exceeded."""
+
+        if size_in_bytes > self.max_bytes:
+            return
+
+        with self._lock:
+            previous_entry = self._entries.pop(key, None)
+            if previous_entry is not None:
+                self.total_bytes -= previous_entry[2]
+
+            self._entries[key] = (messages, selector, size_in_bytes)
+            self.total_bytes += size_in_bytes
+
+            while self.total_bytes > self.max_bytes:
+                _, (_, _, evicted_bytes) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+                self.evictions += 1
+
+
+    def get_history_messages(
+        self,
+        chat_history: List[Tuple[str, str]],
+        template_pair: PairTemplate,
+        tokenizer: 'AutoTokenizer',
+        history_keys: Optional[Tuple[bytes, bytes]] = None,
+    ) -> List[Any]:
+        """Prompt messages of the chat history after trimming it to the token budget. Only the pairs added since
+           the longest memoized prefix of the history are templated and tokenized.
+
+        Args:
+            chat_history (List[Tuple[str, str]]): Past conversation as (query, response) pairs.
+            template_pair (PairTemplate): Builds the (user, assistant) messages of a pair given its index, query and response.
+            tokenizer (AutoTokenizer): Tokenizer object to count the number of tokens of each pair.
+            history_keys (Tuple[bytes, bytes], optional): Keys of the history without its latest pair and of the whole
+                                                          history if already known. Eg: Kept by the ConversationStore. Defaults to None.
+
+        Returns:
+            List[Any]: The retained messages in the order of the conversation.
+        """
+
+        if not chat_history:
+            return []
+
+        metrics = get_metrics()
+        with metrics.time_stage("history_trimming"):
+            key, num_memoized_pairs, entry = self._lookup(chat_history, history_keys)
+
+            if num_memoized_pairs == len(chat_history):
+                self.hits += 1
+                messages, selector, _ = entry
+                return self._get_retained_messages(messages, selector)
+
+            if self._template_overhead is None:
+                self._template_overhead = get_template_overhead(tokenizer)
+
+            if entry is None:
+                self.misses += 1
+                messages, selector, size_in_bytes = [], MessagePairSelector(self._template_overhead, self.max_tokens), 0
+            else:
+                self.extensions += 1
+                messages, selector, size_in_bytes = entry
+                messages, selector = messages.copy(), selector.copy()
+
+            #Template and count the tokens of only the pairs which aren't memoized.
+            with metrics.time_stage("tokenization"):
+                for index in range(num_memoized_pairs, len(chat_history)):
+                    question, response = chat_history[index]
+                    pair_messages = template_pair(index, question, response)
+                    selector.add(count_message_pair_tokens(pair_messages, tokenizer, self._template_overhead)[0])
+                    messages.extend(pair_messages)
+                    size_in_bytes += len(question) + len(response) + PAIR_OVERHEAD_BYTES
+
+            self.templated_pairs += len(chat_history) - num_memoized_pairs
+            self._put(key, messages, selector, size_in_bytes)
+
+            return self._get_retained_messages(messages, selector)
+
+
+    def _get_retained_messages(self, messages: List[Any], selector: MessagePairSelector) -> List[Any]:
+        return [message for index in selector.retained_pairs for message in messages[2*index:2*index+2]]
+
+
+    def discard(self, chat_history: List[Tuple[str, str]]):
+        """Drop the entry memoized for the chat history, if any."""
+
+        key = get_history_keys(chat_history, len(chat_history))[-1]
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry[2]
+
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Returns the lookup counters and the memory occupied by the memo."""
+
+        total_lookups = self.hits + self.extensions + self.misses
+
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "extensions": self.extensions,
+            "misses": self.misses,
+            "reuse_rate": (self.hits + self.extensions) / total_lookups if total_lookups else 0.0,
+            "templated_pairs": self.templated_pairs,
+            "evictions": self.evictions,
+        }
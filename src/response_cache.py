@@ -0,0 +1,202 @@
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Dict, Iterator
+
+from src.constants import *
+from src.metrics import get_metrics
+
+
+def get_text_hash(text: str) -> str:
+    """Returns the sha256 hex digest of the text."""
+
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def normalize_question(question: str) -> str:
+    """Normalize the query so that the same query typed with different spacing maps to the same cache entry.
+       Only the whitespaces are collapsed. The casing and the punctuations are kept since the model sees them
+       and may answer the differently cased or punctuated query differently."""
+
+    return " ".join(question.split())
+
+
+def iter_response_chunks(response: str) -> Iterator[str]:
+    """Split a cached response into word sized chunks, so that it can be streamed just like a generated response."""
+
+    return iter(re.findall(r"\s*\S+\s*", response) or [response])
+
+
+class ResponseCache:
+    """
+    Exact response cache for the deterministic (temperature 0) responses. Entries are keyed on the normalized query,
+    the trimmed chat history that goes into the prompt, the model id and the hash of the INSTRUCTION_TEMPLATE.
+
+    Has an in-memory LRU tier and an optional on-disk (sqlite) tier which survives restarts. Entries older than
+    the TTL are treated as misses. Entries created with a different INSTRUCTION_TEMPLATE never match and are purged
+    from the disk tier when the cache is opened. The hits of each tier and the misses are counted on the /metrics
+    endpoint as diya_response_cache_lookups_total.
+
+    Args:
+        model_id (str): Id of the model that generates the responses.
+        instruction_template (str, optional): Instructions used for the prompt. Defaults to INSTRUCTION_TEMPLATE.
+        max_entries (int, optional): Maximum number of entries in the in-memory tier. Defaults to RESPONSE_CACHE_MAX_ENTRIES.
+        ttl_seconds (float, optional): Time to live of an entry. Defaults to RESPONSE_CACHE_TTL_SECONDS.
+        disk_path (str, optional): Path of the sqlite file for the on-disk tier. Disabled if None. Defaults to RESPONSE_CACHE_DISK_PATH.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        instruction_template: str = INSTRUCTION_TEMPLATE,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS,
+        disk_path: Optional[str] = RESPONSE_CACHE_DISK_PATH,
+    ):
+        self._model_id = model_id
+        self._template_hash = get_text_hash(instruction_template)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        self._memory = OrderedDict() #key -> (response, created_at)
+        self._lock = threading.Lock()
+
+        self._disk = None
+        if disk_path is not None:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, template_hash TEXT, response TEXT, created_at REAL)"
+            )
+            self._disk.execute(
+                "DELETE FROM responses WHERE template_hash != ? OR created_at < ?",
+                (self._template_hash, time.time() - self.ttl_seconds),
+            )
+            self._disk.commit()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+
+    def make_key(self, question: str, history: List[str]) -> str:
+        """Build the cache key of a request.
+
+        Args:
+            question (str): Query provided by the user.
+            history (List[str]): Contents of the chat history messages retained in the prompt after trimming.
+
+        Returns:
+            str: The cache key.
+        """
+
+        hasher = hashlib.sha256()
+        for part in [self._model_id, self._template_hash, normalize_question(question), *history]:
+            hasher.update(part.encode("utf-8"))
+            hasher.update(b"\0")
+
+        return hasher.hexdigest()
+
+
+    def _is_expired(self, created_at: float) -> bool:
+        return time.time() - created_at > self.ttl_seconds
+
+
+    def _put_in_memory(self, key: str, response: str, created_at: float):
+        """Add the entry to the in-memory tier and evict the least recently used entries beyond the limit."""
+
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+
+    def get(self, key: str) -> Optional[str]:
+        """Get the cached response for the key.
+
+        Returns:
+            Optional[str]: The cached response or None on a miss.
+        """
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._is_expired(entry[1]):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    get_metrics().response_cache_lookups.inc(1, "memory_hit")
+                    return entry[0]
+
+                del self._memory[key]
+                self.expirations += 1
+
+            if self._disk is not None:
+                row = self._disk.execute(
+                    "SELECT response, created_at FROM responses WHERE key = ? AND template_hash = ?",
+                    (key, self._template_hash),
+                ).fetchone()
+
+                if row is not None and not self._is_expired(row[1]):
+                    self._put_in_memory(key, row[0], row[1])
+                    self.disk_hits += 1
+                    get_metrics().response_cache_lookups.inc(1, "disk_hit")
+                    return row[0]
+
+            self.misses += 1
+            get_metrics().response_cache_lookups.inc(1, "miss")
+
+            return None
+
+
+    def put(self, key: str, response: str):
+        """Store the response of a completed generation on all the tiers."""
+
+        created_at = time.time()
+
+        with self._lock:
+            self._put_in_memory(key, response, created_at)
+
+            if self._disk is not None:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, self._template_hash, response, created_at),
+                )
+                self._disk.commit()
+
+            self.stores += 1
+
+
+    def invalidate(self):
+        """Remove all the entries from all the tiers."""
+
+        with self._lock:
+            self._memory.clear()
+
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM responses")
+                self._disk.commit()
+
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the hit and miss counters of the cache."""
+
+        hits = self.memory_hits + self.disk_hits
+        total_lookups = hits + self.misses
+
+        return {
+            "entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total_lookups if total_lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,165 @@
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+from src.constants import *
+from src.metrics import get_metrics
+
+
+def find_stop_string(text: str, stop_strings: List[str] = STOP_STRINGS, start: int = 0) -> Tuple[int, Optional[str]]:
+    """Find the earliest stop string in the text at or after the start index.
+
+    Returns:
+        Tuple[int, Optional[str]]: Index of the stop string in the text and the stop string. (-1, None) if not found.
+    """
+
+    index, found = -1, None
+    for stop_string in stop_strings:
+        position = text.find(stop_string, start)
+        if position != -1 and (index == -1 or position < index):
+            index, found = position, stop_string
+
+    return index, found
+
+
+def truncate_at_stop_string(text: str, stop_strings: List[str] = STOP_STRINGS) -> Tuple[str, Optional[str]]:
+    """Cut the text at the earliest stop string along with the whitespaces before it.
+
+    Returns:
+        Tuple[str, Optional[str]]: The truncated text and the stop string found, if any.
+    """
+
+    index, stop_string = find_stop_string(text, stop_strings)
+    if stop_string is None:
+        return text, None
+
+    return text[:index].rstrip(), stop_string
+
+
+class StopStringMatcher:
+    """
+    Cuts a text streamed in chunks at the first stop string and hands out the text in deltas. Only the new chunk
+    along with the held back tail of the text before it is searched on every update, so the work per chunk doesn't
+    grow with the text. The tail which could still turn out to be a stop string, along with the whitespaces before
+    it, is held back untill the next chunk decides it. So the deltas joined together are always the final text.
+
+    Args:
+        stop_strings (List[str], optional): Strings which ends the text. Defaults to STOP_STRINGS.
+    """
+
+    def __init__(self, stop_strings: List[str] = STOP_STRINGS):
+        self._stop_strings = [stop_string for stop_string in stop_strings if stop_string]
+        self._max_length = max((len(stop_string) for stop_string in self._stop_strings), default=0)
+
+        self._parts = [] #Deltas handed out so far.
+        self._pending = "" #Tail of the text which is held back.
+        self.stop_string = None
+
+
+    @property
+    def is_stopped(self) -> bool:
+        return self.stop_string is not None
+
+
+    @property
+    def text(self) -> str:
+        """The text so far, cut at the stop string if any."""
+
+        return "".join(self._parts) + self._pending
+
+
+    def _get_holdback_length(self, text: str) -> int:
+        """Length of the longest tail of the text which is the start of a stop string along with the whitespaces before it."""
+
+        length = 0
+        for prefix_length in range(min(self._max_length - 1, len(text)), 0, -1):
+            tail = text[-prefix_length:]
+            if any(stop_string.startswith(tail) for stop_string in self._stop_strings):
+                length = prefix_length
+                break
+
+        head = text[:len(text) - length]
+
+        return length + len(head) - len(head.rstrip())
+
+
+    def _emit(self, delta: str) -> str:
+        self._parts.append(delta)
+
+        return delta
+
+
+    def update(self, chunk: Optional[str]) -> str:
+        """Append the chunk to the text. Check is_stopped to know if a stop string was completed by it.
+
+        Returns:
+            str: The text which can be shown to the user now. Empty once stopped.
+        """
+
+        if self.is_stopped or not chunk:
+            return ""
+
+        text = self._pending + chunk
+        index, self.stop_string = find_stop_string(text, self._stop_strings)
+        if self.is_stopped:
+            self._pending = ""
+            return self._emit(text[:index].rstrip())
+
+        holdback_length = self._get_holdback_length(text)
+        self._pending = text[len(text) - holdback_length:]
+
+        return self._emit(text[:len(text) - holdback_length])
+
+
+    def flush(self) -> str:
+        """Release the held back tail once the text is complete.
+
+        Returns:
+            str: The rest of the text.
+        """
+
+        pending, self._pending = self._pending, ""
+
+        return self._emit(pending)
+
+
+class StopSequenceStats:
+    """
+    Counts the responses cut short by each stop string and the tokens saved by not generating the rest of them.
+    The saved tokens are counted against the maximum new tokens of the generation, which is only known for
+    the local LLM. The responses of the API are counted as hits alone. Both are exported on the /metrics endpoint
+    as diya_stop_string_hits_total and diya_stop_string_saved_tokens_total, labelled with the backend.
+
+    Args:
+        backend (str, optional): Name of the backend the responses are generated by. Eg: local or api. Defaults to "local".
+    """
+
+    def __init__(self, backend: str = "local"):
+        self.backend = backend
+        self._lock = threading.Lock()
+
+        self.hits: Dict[str, int] = {}
+        self.saved_tokens = 0
+
+
+    def record(self, stop_string: str, saved_tokens: Optional[int] = None):
+        """Record a response which was stopped at the stop string."""
+
+        with self._lock:
+            self.hits[stop_string] = self.hits.get(stop_string, 0) + 1
+            if saved_tokens is not None:
+                self.saved_tokens += max(saved_tokens, 0)
+
+        get_metrics().stop_string_hits.inc(1, self.backend, stop_string)
+        if saved_tokens is not None:
+            get_metrics().stop_string_saved_tokens.inc(max(saved_tokens, 0), self.backend)
+
+
+    def stats(self) -> Dict[str, Union[int, Dict[str, int]]]:
+        """Returns the number of stopped responses, the hits of each stop string and the tokens saved."""
+
+        with self._lock:
+            return {
+                "stopped_responses": sum(self.hits.values()),
+                "hits": dict(self.hits),
+                "saved_tokens": self.saved_tokens,
+            }
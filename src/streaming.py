@@ -0,0 +1,199 @@
+import time
+from typing import AsyncIterable, AsyncIterator, Callable, Iterable, Iterator, List, Optional
+
+from src.constants import *
+
+#Prefix the model sometimes starts its response with. Stripped once at the start just like post_process_output.
+RESPONSE_PREFIX = "Diya:"
+
+STREAM_MODES = ("cumulative", "delta")
+
+
+class IncrementalPostProcessor:
+    """
+    Applies post_process_output to a response streamed in deltas. The leading whitespaces and the 'Diya:' prefix can
+    only be at the start, so the deltas are held back untill the start of the response is decided and are passed
+    through as such after it. The deltas handed out joined together are the post-processed response.
+    """
+
+    def __init__(self):
+        self._head = ""
+        self._is_started = False
+
+
+    def feed(self, delta: str) -> str:
+        """Post-process the next delta of the response.
+
+        Returns:
+            str: The post-processed text which can be shown to the user now.
+        """
+
+        if self._is_started:
+            return delta
+
+        self._head = (self._head + delta).lstrip()
+
+        #The start is undecided while it can still turn out to be the prefix.
+        if len(self._head) < len(RESPONSE_PREFIX) and RESPONSE_PREFIX.startswith(self._head):
+            return ""
+
+        return self.flush()
+
+
+    def flush(self) -> str:
+        """Release the held back start of the response once the response is complete."""
+
+        if self._is_started:
+            return ""
+
+        head, self._head, self._is_started = self._head, "", True
+
+        return head[len(RESPONSE_PREFIX):] if head.startswith(RESPONSE_PREFIX) else head
+
+
+class FrameCoalescer:
+    """
+    Coalesces the deltas of a stream into frames. The first delta is sent right away and the later ones are
+    sent once the interval has passed since the previous frame or enough text has been collected. Frames are
+    only sent on the arrival of a delta, so a stall of the generation doesn't send empty frames.
+
+    Args:
+        interval_seconds (float, optional): Minimum time between the frames. Every delta is a frame if 0. Defaults to STREAM_FRAME_INTERVAL_SECONDS.
+        max_chars (int, optional): Collected characters which sends a frame before the interval. Defaults to STREAM_FRAME_MAX_CHARS.
+        clock (Callable[[], float], optional): Source of the time in seconds. Defaults to time.monotonic.
+    """
+
+    def __init__(
+        self,
+        interval_seconds: float = STREAM_FRAME_INTERVAL_SECONDS,
+        max_chars: int = STREAM_FRAME_MAX_CHARS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.interval_seconds = interval_seconds
+        self.max_chars = max_chars
+        self._clock = clock
+
+        self._parts: List[str] = []
+        self._num_chars = 0
+        self._last_frame_time = None
+
+
+    def add(self, delta: str) -> Optional[str]:
+        """Collect the delta.
+
+        Returns:
+            Optional[str]: A frame of the collected deltas if it is due, None otherwise.
+        """
+
+        if delta:
+            self._parts.append(delta)
+            self._num_chars += len(delta)
+
+        if not self._parts:
+            return None
+
+        now = self._clock()
+        if (
+            self._last_frame_time is None
+            or now - self._last_frame_time >= self.interval_seconds
+            or self._num_chars >= self.max_chars
+        ):
+            self._last_frame_time = now
+            return self.flush()
+
+        return None
+
+
+    def flush(self) -> Optional[str]:
+        """Returns the deltas collected so far as a frame or None if there are none."""
+
+        if not self._parts:
+            return None
+
+        frame = "".join(self._parts)
+        self._parts, self._num_chars = [], 0
+
+        return frame
+
+
+class ResponseFramer:
+    """
+    Turns the deltas of a response into the frames sent to the UI. The deltas are post-processed incrementally and
+    coalesced into frames. In the 'delta' mode each frame carries only its new text. In the 'cumulative' mode each
+    frame carries the whole response so far, as the gradio chat interface replaces the message with every yield.
+    The last frame always carries the complete post-processed response.
+
+    Args:
+        stream_mode (str, optional): 'cumulative' or 'delta'. Defaults to STREAM_MODE.
+        interval_seconds (float, optional): Minimum time between the frames. Defaults to STREAM_FRAME_INTERVAL_SECONDS.
+        max_chars (int, optional): Collected characters which sends a frame before the interval. Defaults to STREAM_FRAME_MAX_CHARS.
+        clock (Callable[[], float], optional): Source of the time in seconds. Defaults to time.monotonic.
+    """
+
+    def __init__(
+        self,
+        stream_mode: str = STREAM_MODE,
+        interval_seconds: float = STREAM_FRAME_INTERVAL_SECONDS,
+        max_chars: int = STREAM_FRAME_MAX_CHARS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if stream_mode not in STREAM_MODES:
+            raise ValueError(f"Invalid stream mode {stream_mode}. Use one of {STREAM_MODES}.")
+
+        self._is_cumulative = stream_mode == "cumulative"
+        self._post_processor = IncrementalPostProcessor()
+        self._coalescer = FrameCoalescer(interval_seconds, max_chars, clock)
+        self._text = ""
+
+
+    def _format(self, frame: Optional[str]) -> Optional[str]:
+        if frame is None or not self._is_cumulative:
+            return frame
+
+        self._text += frame
+
+        return self._text
+
+
+    def add(self, delta: str) -> Optional[str]:
+        """Add the next raw delta of the response.
+
+        Returns:
+            Optional[str]: The frame to send if one is due, None otherwise.
+        """
+
+        return self._format(self._coalescer.add(self._post_processor.feed(delta)))
+
+
+    def close(self) -> Optional[str]:
+        """Returns the last frame once the response is complete or None if there is nothing left to send."""
+
+        frame = (self._coalescer.flush() or "") + self._post_processor.flush()
+
+        return self._format(frame) if frame else None
+
+
+def iter_response_frames(deltas: Iterable[str], framer: ResponseFramer) -> Iterator[str]:
+    """Frame the deltas of a response streamed by a synchronous iterator."""
+
+    for delta in deltas:
+        frame = framer.add(delta)
+        if frame is not None:
+            yield frame
+
+    frame = framer.close()
+    if frame is not None:
+        yield frame
+
+
+async def aiter_response_frames(deltas: AsyncIterable[str], framer: ResponseFramer) -> AsyncIterator[str]:
+    """Frame the deltas of a response streamed by an async iterator."""
+
+    async for delta in deltas:
+        frame = framer.add(delta)
+        if frame is not None:
+            yield frame
+
+    frame = framer.close()
+    if frame is not None:
+        yield frame
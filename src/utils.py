@@ -1,11 +1,16 @@
 import yaml
 import logging
 from pathlib import Path
-from typing import List, Tuple, Union, Dict
+from collections import deque
+from typing import List, Tuple, Union, Dict, Optional, TYPE_CHECKING
 
-import comet_llm
-from transformers import AutoTokenizer
-from langchain.schema.messages import HumanMessage, AIMessage
+from src.constants import MAX_ACCEPTED_TOKENS
+from src.metrics import get_metrics
+
+#Heavy packages are imported only where they are used, so that importing the utils doesn't slow down the startup.
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+    from langchain.schema.messages import HumanMessage, AIMessage
 
 
 def create_logger(log_file_path:str)->logging.Logger:
@@ -43,7 +48,7 @@ def create_logger(log_file_path:str)->logging.Logger:
 
 
 def parse_chat_history_as_tuples(
-    message_list: List[Union[HumanMessage, AIMessage]]
+    message_list: List[Union['HumanMessage', 'AIMessage']]
     )->List[Tuple[str,str]]:
     
     """Helper function to parse the chat history's content 
@@ -55,12 +60,15 @@ def parse_chat_history_as_tuples(
         List[Tuple[str,str]]: Parsed chat Items as a List of tuples.[(human_query, ai_response)].
     """
     
+    from langchain.schema.messages import HumanMessage
+    
     parsed_messages_list = []  
     
     try:
         assert len(message_list)%2 == 0 #Each query should have a response and so the number of chat items should be even.
         
-        for index in range(0,len(message_list)-2,2): 
+        #Every pair is parsed, including the latest one. Both the local chain and the API client see the same history.
+        for index in range(0,len(message_list),2): 
             #Item at index is query and item and index+1 will its coresponding answer. Fetch the content and append the pair as a tuple after striping.
             parsed_messages_list.append((message_list[index].content.strip(), message_list[index+1].content.strip()))
             
@@ -73,7 +81,7 @@ def parse_chat_history_as_tuples(
             if type(message)==HumanMessage:
                 human_messages.append(message.content.strip())
             else:
-                ai_messages.append(ai_messages.content.strip())
+                ai_messages.append(message.content.strip())
         
         #Zip and pack the messages as tuples.
         for human,ai in zip(human_messages, ai_messages):
@@ -82,42 +90,190 @@ def parse_chat_history_as_tuples(
     return parsed_messages_list
 
 
-def filter_old_messages(messages: List, tokenizer: AutoTokenizer)->List:
+def get_template_overhead(tokenizer: 'AutoTokenizer')->int:
+    """Number of tokens the chat template adds once per prompt irrespective of the messages (Eg: the bos token).
+
+    Args:
+        tokenizer (AutoTokenizer): Tokenizer object whose chat template is used for building the prompt.
+
+    Returns:
+        int: Count of the tokens added by the chat template to an empty conversation.
+    """
+    
+    try:
+        return len(tokenizer.apply_chat_template([]))
+    except Exception:
+        #Few chat templates raises an error for an empty conversation. Only the bos token is added by them in general.
+        return int(tokenizer.bos_token_id is not None)
+
+
+def count_message_pair_tokens(
+    messages: List,
+    tokenizer: 'AutoTokenizer',
+    template_overhead: Optional[int] = None
+    )->List[int]:
+    """Count the tokens occupied by each (query, response) pair of messages in the templated prompt.
+       Each pair is templated and tokenized only once and the per prompt overhead of the template is excluded,
+       So that the token count of any subset of pairs is the sum of thier counts plus the template overhead.
+
+    Args:
+        messages (List): A list containing the chat prompts as (user, assistant) message pairs.
+        tokenizer (AutoTokenizer): Tokenizer object to count the number of tokens.
+        template_overhead (int, optional): Tokens added once per prompt by the template. Computed if not provided.
+
+    Returns:
+        List[int]: Token count of each message pair.
+    """
+    
+    if template_overhead is None:
+        template_overhead = get_template_overhead(tokenizer)
+    
+    return [
+        len(tokenizer.apply_chat_template(messages[index:index+2])) - template_overhead
+        for index in range(0, len(messages)-1, 2)
+    ]
+
+
+class MessagePairSelector:
+    """
+    Picks the (query, response) pairs to retain in the prompt within the token budget as the pairs are added one
+    at a time. Pairs are admitted in the order of the conversation and whenever the budget is exceeded the oldest
+    pair after the first 2 conversations is dropped (the second one once only those two are left). The very first
+    conversation which has the initial instructions is never dropped.
+
+    Args:
+        base_tokens (int): Tokens in the prompt apart from the message pairs. (Eg: template overhead)
+        max_tokens (int, optional): Maximum number of tokens accepted in the prompt. Defaults to MAX_ACCEPTED_TOKENS.
+    """
+
+    def __init__(self, base_tokens: int, max_tokens: int = MAX_ACCEPTED_TOKENS):
+        self.max_tokens = max_tokens
+        self.total_tokens = base_tokens
+        self.pair_tokens: List[int] = []
+        self.first_pairs: List[int] = []
+        self.middle_pairs = deque()
+
+
+    def add(self, num_tokens: int):
+        """Admit the next pair of the conversation and drop the pairs beyond the budget."""
+
+        index = len(self.pair_tokens)
+        self.pair_tokens.append(num_tokens)
+
+        if len(self.first_pairs) < 2:
+            self.first_pairs.append(index)
+        else:
+            self.middle_pairs.append(index)
+        self.total_tokens += num_tokens
+
+        #Remove the pairs from the middle untill the total token count is within the limit.
+        while self.total_tokens > self.max_tokens:
+            if self.middle_pairs:
+                self.total_tokens -= self.pair_tokens[self.middle_pairs.popleft()]
+            elif len(self.first_pairs) > 1:
+                self.total_tokens -= self.pair_tokens[self.first_pairs.pop()]
+            else:
+                break
+
+
+    def copy(self) -> 'MessagePairSelector':
+        """Copy of the selector which can admit further pairs without changing this one."""
+
+        selector = MessagePairSelector.__new__(MessagePairSelector)
+        selector.max_tokens = self.max_tokens
+        selector.total_tokens = self.total_tokens
+        selector.pair_tokens = self.pair_tokens.copy()
+        selector.first_pairs = self.first_pairs.copy()
+        selector.middle_pairs = self.middle_pairs.copy()
+
+        return selector
+
+
+    @property
+    def retained_pairs(self) -> List[int]:
+        """Indices of the retained pairs in ascending order."""
+
+        return self.first_pairs + list(self.middle_pairs)
+
+
+def select_message_pairs(
+    pair_tokens: List[int],
+    base_tokens: int,
+    max_tokens: int = MAX_ACCEPTED_TOKENS
+    )->List[int]:
+    """Pick the (query, response) pairs to retain in the prompt within the token budget in a single pass.
+       See MessagePairSelector for the pairs which are dropped.
+
+    Args:
+        pair_tokens (List[int]): Token count of each message pair in the order of the conversation.
+        base_tokens (int): Tokens in the prompt apart from the message pairs. (Eg: template overhead)
+        max_tokens (int, optional): Maximum number of tokens accepted in the prompt. Defaults to MAX_ACCEPTED_TOKENS.
+
+    Returns:
+        List[int]: Indices of the retained pairs in ascending order.
+    """
+    
+    selector = MessagePairSelector(base_tokens, max_tokens)
+    for num_tokens in pair_tokens:
+        selector.add(num_tokens)
+    
+    return selector.retained_pairs
+
+
+def filter_old_messages(
+    messages: List,
+    tokenizer: 'AutoTokenizer',
+    max_tokens: int = MAX_ACCEPTED_TOKENS
+    )->List:
     """Function to the filter out the old messages on history before preparing the prompt. 
-       Filters the past (query, response) pair from history when the total tokens count exceeds MAX_ACCEPTED_TOKENS.
-       Mistral Instruct model has a context length of 4096.
+       Filters the past (query, response) pair from history when the total tokens count exceeds max_tokens.
+       Always leaves the first conversation to preserve the initial instructions and removes the prompts 
+       from the middle for getting better response. 
+       
+       The result is same as trimming the messages after every pair is added to the conversation, 
+       But each pair is tokenized only once and the pairs to drop are picked in a single pass.
 
     Args:
-        messageList (List): A list containing the chat prompts. 
+        messages (List): A list containing the chat prompts as (user, assistant) message pairs. 
         tokenizer (AutoTokenizer): Tokenizer object to count the number of token in the processed prompt.
+        max_tokens (int, optional): Maximum number of tokens accepted in the prompt. Defaults to MAX_ACCEPTED_TOKENS.
 
     Returns:
         List: A list containing the filtered messages
     """
     
-    MAX_ACCEPTED_TOKENS = 3500
-    
-    #Convert the messages into prompt tokens.
-    tokens = tokenizer.apply_chat_template(messages)
+    metrics = get_metrics()
     
-    #Remove the question and answer pair from the messages untill the total token count in the prompt exceeds the limit.
-    #Always Leave the first 2 conversations to preserve the initial instructions. 
-    #Remove the prompts from the middle for getting better response. 
-    while len(tokens)>MAX_ACCEPTED_TOKENS:
-        
-        if len(messages)>4:
-            messages.pop(4)
-            messages.pop(4)
-        elif len(messages)>2:
-            messages.pop(2)
-            messages.pop(2)
-        else:
-            break
+    #Tokenization of the history is timed on its own as well as a part of the trimming.
+    with metrics.time_stage("history_trimming"):
+        with metrics.time_stage("tokenization"):
+            template_overhead = get_template_overhead(tokenizer)
+            pair_tokens = count_message_pair_tokens(messages, tokenizer, template_overhead)
         
-        #Recompute the new prompt tokens based on filtered messages.
-        tokens = tokenizer.apply_chat_template(messages)
-        
-    return messages
+        #Pick the pairs to retain and rebuild the message list. A trailing message without a pair is always retained.
+        retained_pairs = select_message_pairs(pair_tokens, template_overhead, max_tokens)
+        filtered_messages = [message for index in retained_pairs for message in messages[2*index:2*index+2]]
+        filtered_messages.extend(messages[2*len(pair_tokens):])
+    
+    return filtered_messages
+
+
+def get_token_usage(num_prompt_tokens: int, num_response_tokens: int)->Dict[str,int]:
+    """Prepare the token usage metadata of a prompt in the format used for logging the prompt.
+
+    Args:
+        num_prompt_tokens (int): Number of tokens in the prompt.
+        num_response_tokens (int): Number of tokens generated for the response.
+
+    Returns:
+        Dict[str,int]: A dictionary containing the prompt, new and total token counts.
+    """
+    
+    return {
+        "prompt_tokens": num_prompt_tokens,
+        "actual_new_tokens": num_response_tokens,
+        "total_tokens": num_prompt_tokens + num_response_tokens,
+    }
 
 
 def log_prompt(log_dict: Dict[str,Union[str,int]]):
@@ -127,6 +283,8 @@ def log_prompt(log_dict: Dict[str,Union[str,int]]):
         log_dict (Dict[str,Union[str,int]]): A dictionary containing all the necassary data and metadata for logging the prompt.
     """
     
+    import comet_llm
+    
     comet_llm.log_prompt(
         project=log_dict['project'],
         prompt=log_dict['prompt'],
@@ -162,7 +320,7 @@ def post_process_output(text: str)-> str:
     return text
 
 
-def convert_chat_history_as_string(messages: List[Union[HumanMessage, AIMessage]])-> str:
+def convert_chat_history_as_string(messages: List[Union['HumanMessage', 'AIMessage']])-> str:
     """Convert the chat_history list with conversations into a single string.
        This is necassary while logging the prompt details.
 
@@ -173,6 +331,8 @@ def convert_chat_history_as_string(messages: List[Union[HumanMessage, AIMessage]
         str: A concatenated string containing all the all the past queries and responses.
     """
     
+    from langchain.schema.messages import HumanMessage
+    
     result_string = ''
     
     #Iterate through each message and figure out whether the message is human provided or LLM generated.
@@ -0,0 +1,93 @@
+"""The model artifact cache of get_model must load the same model as the checkpoint and must be rejected once it is
+corrupted or stale. Runs on cpu with a tiny randomly initialized Mistral model, so that no download is needed.
+"""
+import os
+import json
+import shutil
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from src.benchmarks.model_artifact import save_tiny_checkpoint
+from src.local_llm.artifacts import save_model_artifact, is_model_artifact_valid, get_quantization_config
+from src.local_llm.model import get_model
+
+
+@pytest.fixture(scope="module")
+def tiny_checkpoint(tmp_path_factory) -> str:
+    checkpoint_dir = str(tmp_path_factory.mktemp("tiny") / "checkpoint")
+    save_tiny_checkpoint(checkpoint_dir, hidden_size=64, num_layers=2)
+
+    return checkpoint_dir
+
+
+@pytest.fixture
+def checkpoint_dir(tiny_checkpoint, tmp_path) -> str:
+    """Copy of the tiny checkpoint which a test may modify."""
+
+    return shutil.copytree(tiny_checkpoint, str(tmp_path / "checkpoint"))
+
+
+@pytest.fixture
+def artifact_dir(checkpoint_dir, tmp_path) -> str:
+    artifact_dir = str(tmp_path / "artifact")
+    save_model_artifact(model_name=checkpoint_dir, artifact_dir=artifact_dir, device="cpu")
+
+    return artifact_dir
+
+
+def get_logits(model, input_ids: 'torch.LongTensor') -> 'torch.Tensor':
+    with torch.no_grad():
+        return model(input_ids).logits
+
+
+def is_valid(artifact_dir: str, checkpoint_dir: str, verify_checksums: bool = False) -> bool:
+    return is_model_artifact_valid(artifact_dir, checkpoint_dir, get_quantization_config("cpu"), verify_checksums)
+
+
+def test_artifact_is_valid(artifact_dir, checkpoint_dir):
+    assert is_valid(artifact_dir, checkpoint_dir)
+    assert is_valid(artifact_dir, checkpoint_dir, verify_checksums=True)
+
+
+def test_artifact_logits_match_checkpoint(artifact_dir, checkpoint_dir):
+    checkpoint_model = get_model(checkpoint_dir, device="cpu", gradient_checkpointing=False, artifact_dir=None)
+    artifact_model = get_model(checkpoint_dir, device="cpu", gradient_checkpointing=False, artifact_dir=artifact_dir)
+    input_ids = torch.randint(0, 1000, (1, 32), generator=torch.Generator().manual_seed(0))
+
+    assert torch.equal(get_logits(checkpoint_model, input_ids), get_logits(artifact_model, input_ids))
+
+
+def get_weights_path(artifact_dir: str) -> str:
+    return os.path.join(artifact_dir, next(name for name in sorted(os.listdir(artifact_dir)) if name.endswith(".safetensors")))
+
+
+def test_corrupted_shard_fails_checksum(artifact_dir, checkpoint_dir):
+    with open(get_weights_path(artifact_dir), "r+b") as file:
+        file.seek(-1, os.SEEK_END)
+        last_byte = file.read(1)
+        file.seek(-1, os.SEEK_END)
+        file.write(bytes([last_byte[0] ^ 0xFF]))
+
+    assert not is_valid(artifact_dir, checkpoint_dir, verify_checksums=True)
+
+
+def test_truncated_shard_fails_size_check(artifact_dir, checkpoint_dir):
+    weights_path = get_weights_path(artifact_dir)
+    with open(weights_path, "r+b") as file:
+        file.truncate(os.path.getsize(weights_path) - 1)
+
+    assert not is_valid(artifact_dir, checkpoint_dir)
+
+
+def test_changed_config_makes_artifact_stale(artifact_dir, checkpoint_dir):
+    config_path = os.path.join(checkpoint_dir, "config.json")
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    config["rope_theta"] = config.get("rope_theta", 10000.0) * 2
+    with open(config_path, "w") as config_file:
+        json.dump(config, config_file)
+
+    assert not is_valid(artifact_dir, checkpoint_dir)
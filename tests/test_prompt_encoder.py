@@ -0,0 +1,153 @@
+"""The token ids assembled by the PromptEncoder must be identical to the ids of the tokenizer's chat template.
+
+A small sentencepiece style BPE tokenizer with byte fallback and Mistral's chat template is trained on the prompt
+text itself, so that the check runs offline without the gated Mistral tokenizer. Newlines are left out of its
+vocabulary and fall back to bytes, the same as in Mistral's tokenizer.
+"""
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("langchain")
+tokenizers = pytest.importorskip("tokenizers")
+transformers = pytest.importorskip("transformers")
+
+from src.constants import INSTRUCTION_TEMPLATE
+from src.prompt_memo import PromptMemo
+from src.conversation_store import Conversation
+from src.local_llm import chains
+from src.local_llm.chains import LLMChain
+from src.local_llm.prompt_encoder import PromptEncoder
+
+#Chat template of Mistral-7B-Instruct-v0.2.
+MISTRAL_CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}"
+    "{% if (message['role'] == 'user') != (loop.index0 % 2 == 0) %}"
+    "{{ raise_exception('Conversation roles must alternate user/assistant/user/assistant/...') }}{% endif %}"
+    "{% if message['role'] == 'user' %}{{ '[INST] ' + message['content'] + ' [/INST]' }}"
+    "{% elif message['role'] == 'assistant' %}{{ message['content'] + eos_token }}"
+    "{% else %}{{ raise_exception('Only user and assistant roles are supported!') }}{% endif %}{% endfor %}"
+)
+
+QUESTIONS = [
+    "Hi There! What is your name?",
+    "What is Aakash's current job?",
+    "What is his favourite food?",
+    "  What are his hobbies?\n\nAnd his favourite movie?",
+]
+
+ANSWERS = [
+    "Hi there! I'm Diya, Aakash's personal assistant.",
+    "Aakash currently works as a Junior Research Engineer.\n\nHe works on ML research and development.",
+    "KFC's chicken & Zinger burger, without a doubt!",
+    "Volleyball, Cricket and  vibing for songs.\n",
+]
+
+
+def get_fixture_tokenizer() -> 'transformers.PreTrainedTokenizerFast':
+    """Sentencepiece style BPE tokenizer trained on the prompt's text without its newlines."""
+
+    from tokenizers import Tokenizer, decoders, models, normalizers, trainers
+
+    byte_tokens = [f"<0x{byte:02X}>" for byte in range(256)]
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>", byte_fallback=True, fuse_unk=True))
+    tokenizer.normalizer = normalizers.Sequence([normalizers.Prepend("▁"), normalizers.Replace(" ", "▁")])
+    tokenizer.decoder = decoders.Sequence([
+        decoders.Replace("▁", " "), decoders.ByteFallback(), decoders.Fuse(), decoders.Strip(" ", 1, 0)
+    ])
+
+    corpus = [line for text in [INSTRUCTION_TEMPLATE, *QUESTIONS, *ANSWERS] for line in text.splitlines() if line.strip()]
+    trainer = trainers.BpeTrainer(vocab_size=1500, special_tokens=["<unk>", "<s>", "</s>", *byte_tokens], show_progress=False)
+    tokenizer.train_from_iterator(corpus, trainer)
+
+    return transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+        chat_template=MISTRAL_CHAT_TEMPLATE,
+    )
+
+
+@pytest.fixture(scope="module")
+def prompt_encoder():
+    return PromptEncoder(get_fixture_tokenizer())
+
+
+@pytest.fixture
+def chain(prompt_encoder, monkeypatch):
+    """Chain building its prompts with the fixture tokenizer."""
+
+    monkeypatch.setattr(chains, "get_prompt_encoder", lambda model_name=None: prompt_encoder)
+    chain = LLMChain.construct(prompt_memo=PromptMemo())
+    chain.build_prompt_encoder()
+
+    return chain
+
+
+def get_history(num_turns: int):
+    return [(QUESTIONS[index % len(QUESTIONS)], ANSWERS[index % len(ANSWERS)]) for index in range(num_turns)]
+
+
+def assert_identical_ids(chain, question, chat_history):
+    """Build the prompt via the chain and compare its ids against tokenizing it via the chat template."""
+
+    prompt = chain._get_inference_prompt({"question": question, "chat_history": chat_history})
+
+    assert prompt["input_ids"].tolist() == chain.tokenizer.apply_chat_template(prompt["messages"])
+
+    return prompt
+
+
+def test_prompt_encoder_is_verified(chain):
+    assert chain.prompt_encoder.is_verified
+
+
+@pytest.mark.parametrize("question", QUESTIONS)
+def test_single_turn_ids_match_chat_template(chain, question):
+    assert_identical_ids(chain, question, Conversation("single-turn"))
+
+
+@pytest.mark.parametrize("num_turns", [1, 2, 5])
+def test_multi_turn_ids_match_chat_template(chain, num_turns):
+    conversation = Conversation("multi-turn")
+    for question, answer in get_history(num_turns):
+        conversation.append(question, answer)
+
+    prompt = assert_identical_ids(chain, QUESTIONS[num_turns % len(QUESTIONS)], conversation)
+
+    assert len(prompt["messages"]) == 2 * num_turns + 1
+
+
+def test_message_history_ids_match_chat_template(chain):
+    """History passed as the memory's messages instead of a conversation of the conversation store."""
+
+    from langchain.schema.messages import AIMessage, HumanMessage
+
+    messages = [message for question, answer in get_history(3) for message in (HumanMessage(content=question), AIMessage(content=answer))]
+    prompt = assert_identical_ids(chain, QUESTIONS[3], messages)
+
+    assert len(prompt["messages"]) == 2 * 3 + 1
+
+
+def test_trimmed_history_ids_match_chat_template(chain):
+    #The instructions alone are ~900 tokens of the fixture tokenizer, so the history is trimmed from the middle.
+    chain.prompt_memo = PromptMemo(max_tokens=1200)
+    conversation = Conversation("trimmed")
+    for question, answer in get_history(30):
+        conversation.append(question, answer)
+
+    prompt = assert_identical_ids(chain, QUESTIONS[0], conversation)
+
+    assert 3 < len(prompt["messages"]) < 2 * 30 + 1
+
+
+def test_reused_conversation_segments_match_chat_template(chain):
+    """Segments tokenized on the earlier turns of a conversation are reused on its later turns."""
+
+    conversation = Conversation("reused")
+    for turn, (question, answer) in enumerate(get_history(8)):
+        assert_identical_ids(chain, question, conversation)
+        conversation.append(question, answer)
+
+        if turn:
+            assert len(conversation.segments)
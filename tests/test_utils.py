@@ -0,0 +1,20 @@
+"""parse_chat_history_as_tuples must keep every exchange of the history, the latest one included."""
+import pytest
+
+pytest.importorskip("langchain")
+
+from langchain.schema.messages import AIMessage, HumanMessage
+
+from src.utils import parse_chat_history_as_tuples
+
+
+def test_parse_chat_history_keeps_latest_exchange():
+    messages = [HumanMessage(content=" Hi "), AIMessage(content="Hello! "), HumanMessage(content="Job?"), AIMessage(content="Engineer.")]
+
+    assert parse_chat_history_as_tuples(messages) == [("Hi", "Hello!"), ("Job?", "Engineer.")]
+
+
+def test_parse_chat_history_without_a_response():
+    messages = [HumanMessage(content="Hi"), AIMessage(content="Hello!"), HumanMessage(content="Job?")]
+
+    assert parse_chat_history_as_tuples(messages) == [("Hi", "Hello!")]